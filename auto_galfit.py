@@ -7,29 +7,330 @@ import astropy.io.fits as pyfits
 
 import argparse
 import multiprocessing
+import threading
 import time
 import subprocess
+import asyncio
+import socket
 import queue
 import time
 
 import logging
 import shutil
+import tempfile
+import glob
+import concurrent.futures
+import functools
+import selectors
 logging.basicConfig(filename='debug.log',level=logging.DEBUG)
 
 import plot_galfit_results
+import cutouts
+import cutout_container
+import psf_store
+import galfit_ledger
+import galfit_scheduler
+import run_metrics
+import galfit_results
+import galfit_broker
+import galfit_retry
+import source_groups
+import coarse_fit
+import warm_start
+import galfit_layout
+import segmentation_index
+import galfit_monitor
+import initial_guess
+import sigma_maps
+import job_sizing
+import sersic_fit
 
 import astropy.table
 import shutil
 
 
+def write_galfit_input(fn, payload, container=None, src_id=cutout_container.SHARED):
+
+    #
+    # Store one of the files GALFIT needs, either as a regular file in the
+    # galfit directory or as a member of the per-image container
+    #
+    if (container is not None):
+        _, name = os.path.split(fn)
+        cutout_container.add_member(container, src_id, name, payload)
+    else:
+        with open(fn, "wb") as f:
+            f.write(payload)
+
+
+def write_job_inputs(files, container=None, src_id=cutout_container.SHARED):
+    for fn, payload in files:
+        write_galfit_input(fn, payload, container, src_id)
+
+
+def coarse_stage(galfit_job, factor):
+
+    # names of the coarse-stage files of a job
+    galfit_dir, _ = os.path.split(galfit_job['feedme'])
+    prefix = os.path.join(galfit_dir, "%s.%05d.coarse" % (galfit_job['basename'], galfit_job['src_id']))
+    return dict(factor=factor, feedme="%s.galfeed" % (prefix), galfit_output="%s.galfit.fits" % (prefix),
+                image="%s.image.fits" % (prefix), sigma="%s.sigma.fits" % (prefix),
+                segm="%s.segm.fits" % (prefix), constraints="%s.constraints" % (prefix))
+
+
+def store_coarse_psf(psf_file, factor, galfit_dir, container=None, n_shards=0):
+
+    # the PSF binned like the coarse cutouts, in the same store as the PSF itself
+    if (psf_file is None):
+        return 'none'
+    payload = cutout_container.fits_bytes(pyfits.PrimaryHDU(
+        data=coarse_fit.coarse_psf(pyfits.getdata(psf_file), factor).astype(numpy.float32)))
+    if (container is None):
+        return galfit_layout.shared_name(psf_store.store_psf_payload(payload, galfit_dir), n_shards)
+    name = psf_store.psf_payload_name(payload)
+    if (not cutout_container.has_member(container, cutout_container.SHARED, name)):
+        cutout_container.add_member(container, cutout_container.SHARED, name, payload)
+    return name
+
+
+def coarse_inputs(coarse, feedme, constraints, img, wht, segm, header, psf_option):
+
+    #
+    # Binned copies of the cutouts, constraints and feed-me file for the
+    # coarse stage of a large source, as (filename, content) pairs
+    #
+    factor = coarse['factor']
+    files = dict(A=coarse['image'], B=coarse['galfit_output'], C=None, D=psf_option,
+                 F=None, G=coarse['constraints'])
+    header = header.copy()
+    header['BINNING'] = factor
+    inputs = [(coarse['image'], cutout_container.fits_bytes(pyfits.PrimaryHDU(
+        data=coarse_fit.block_sum(img, factor), header=header)))]
+    if (wht is not None):
+        files['C'] = coarse['sigma']
+        inputs.append((coarse['sigma'], cutout_container.fits_bytes(pyfits.PrimaryHDU(
+            data=coarse_fit.block_sigma(wht, factor), header=header))))
+    if (segm is not None):
+        files['F'] = coarse['segm']
+        inputs.append((coarse['segm'], cutout_container.fits_bytes(pyfits.PrimaryHDU(
+            data=coarse_fit.block_mask(segm, factor), header=header))))
+    inputs.append((coarse['constraints'], coarse_fit.coarse_constraints(constraints, factor).encode()))
+
+    # the feed-me file refers to all files by their name only
+    for key in files:
+        files[key] = 'none' if files[key] is None else os.path.split(files[key])[1]
+    inputs.append((coarse['feedme'], coarse_fit.coarse_feedme(feedme, factor, files).encode()))
+    return inputs
+
+
+def get_psf_model(fn):
+
+    #
+    # construct the appropriate filename for the PSF
+    #
+    if (args.psf is not None):
+        if (args.psf.find(":") >= 0):
+            # we need to do some replacing here
+            _parts = args.psf.split(":")
+            _search = _parts[0]
+            _replace = _parts[1]
+            psf_file = fn.replace(_search, _replace)
+        else:
+            psf_file = args.psf
+        if (not os.path.isfile(psf_file)):
+            psf_file = None
+    else:
+        psf_file = None
+
+    #
+    # Read PSF supersampling from PSF-file if available or default to 1
+    #
+    psf_supersample = 1.
+    if (args.psf_supersample <= 0 and psf_file is not None):
+        try:
+            psf_hdu = pyfits.open(psf_file)
+            psf_supersample =  psf_hdu[0].header['SUPERSMP']  #1./psf_hdu[0].header['PSF_SAMP']
+            psf_hdu.close()
+            print("Setting PSF supersampling to %d based on data from %s" % (psf_supersample, psf_file))
+        except Exception as e:
+            print(e)
+            pass
+
+    return psf_file, psf_supersample
+
+
+# everything about a source needed to plan its fit, see plan_sources()
+SOURCE_PLAN_DTYPE = [('number', 'i8'), ('x', 'f8'), ('y', 'f8'),
+                     ('x1', 'i8'), ('x2', 'i8'), ('y1', 'i8'), ('y2', 'i8'),
+                     ('dx', 'f8'), ('dy', 'f8'),
+                     ('magnitude', 'f8'), ('halflight_radius', 'f8'),
+                     ('axis_ratio', 'f8'), ('position_angle', 'f8'), ('extent', 'f8')]
+
+
+def plan_sources(catalog, naxis1, naxis2, max_size, sizing='fixed'):
+
+    #
+    # Cutout box, position constraints and starting values of all sources in
+    # a catalog, computed column by column instead of source by source.
+    # Positions are 0-based; see job_sizing for the size of the cutouts.
+    #
+    plan = numpy.zeros(len(catalog), dtype=SOURCE_PLAN_DTYPE)
+    plan['number'] = catalog['NUMBER']
+    plan['x'] = numpy.asarray(catalog['X_IMAGE'], dtype=numpy.float64) - 1
+    plan['y'] = numpy.asarray(catalog['Y_IMAGE'], dtype=numpy.float64) - 1
+
+    size = job_sizing.cutout_half_size(catalog, sizing)
+    plan['extent'] = job_sizing.profile_extent(catalog)
+    if (max_size > 0):
+        size = numpy.minimum(size, max_size)
+    # (truncated towards zero when stored, like int())
+    plan['x1'] = numpy.maximum(0, plan['x'] - size)
+    plan['x2'] = numpy.minimum(plan['x'] + size, naxis1)
+    plan['y1'] = numpy.maximum(0, plan['y'] - size)
+    plan['y2'] = numpy.minimum(plan['y'] + size, naxis2)
+
+    # allowed range of the position in the fit
+    plan['dx'] = numpy.hypot(3., 3 * numpy.sqrt(numpy.asarray(catalog['ERRX2WIN_IMAGE'], dtype=numpy.float64)))
+    plan['dy'] = numpy.hypot(3., 3 * numpy.sqrt(numpy.asarray(catalog['ERRY2WIN_IMAGE'], dtype=numpy.float64)))
+
+    plan['magnitude'] = catalog['MAG_AUTO']
+    plan['halflight_radius'] = catalog['FLUX_RADIUS_50']
+    # sextractor uses a/b, galfit needs b/a
+    plan['axis_ratio'] = 1. / numpy.asarray(catalog['ELONGATION'], dtype=numpy.float64)
+    # sextractor measures THETA_IMAGE from +x towards +y, galfit's PA runs from up (+y) towards left (-x)
+    plan['position_angle'] = numpy.asarray(catalog['THETA_IMAGE'], dtype=numpy.float64) - 90
+    return plan
+
+
+def plan_boxes(plan):
+    return numpy.array([plan['x1'], plan['x2'], plan['y1'], plan['y2']]).T.reshape((-1, 4))
+
+
+def plan_groups(plan, boxes):
+
+    # sources with overlapping cutouts are fit together, as long as the group's cutout stays within --maxsize
+    max_width = 2 * args.max_size if args.max_size > 0 else None
+    return source_groups.find_groups(boxes, plan['magnitude'], args.max_group_size, max_width)
+
+
+def plan_group_job(plan, boxes, members, psf_nx, psf_ny, psf_supersample, cost_model):
+
+    #
+    # Fitting region, convolution box and predicted runtime of the fit of a
+    # group of sources (or a single source); the convolution box of a group
+    # covers the light of all its members
+    #
+    src = plan[members[0]]
+    box = source_groups.group_box(boxes, members)
+    x1, x2, y1, y2 = box
+    extent = src['extent']
+    if (len(members) > 1):
+        extent = source_groups.group_extent(plan['x'][members], plan['y'][members], plan['extent'][members], box)
+    conv_box = job_sizing.convolution_box(x2 - x1, y2 - y1, extent, psf_nx, psf_ny, args.sizing)
+    predicted_time = len(members) * galfit_scheduler.predict_runtime(
+        cost_model, (x2 - x1) * (y2 - y1), float(src['halflight_radius']), psf_supersample)
+    return box, conv_box, predicted_time
+
+
+def queue_new_job(galfit_queue, galfit_job, write_info, ledger=None, counters=None):
+
+    # all input files of a new job are written: record it, and queue it up
+    if (ledger is not None):
+        galfit_ledger.update_job(ledger, galfit_job['image'], galfit_job['members'], 'cut',
+                                 feedme=galfit_job['feedme'], galfit_output=galfit_job['galfit_output'],
+                                 npix=write_info['npix'], flux_radius=write_info['flux_radius'],
+                                 psf_supersample=write_info['psf_supersample'])
+        galfit_job['state'] = 'cut'
+
+    print(galfit_job['feedme'], galfit_job['galfit_output'], galfit_job['logfile'])
+
+    galfit_job['queued_time'] = time.time()
+    run_metrics.count(counters, [1, 1, 1], run_metrics.job_event(
+        'write', galfit_job, write_time=galfit_job['queued_time'] - write_info['start_time'],
+        npix=write_info['npix'], cost=float(galfit_job['cost']),
+        conv_box=write_info['conv_box'], fft_cost=write_info['fft_cost']))
+    galfit_queue.put(galfit_job)
+
+
+def job_inputs_exist(feedme_fn):
+
+    #
+    # The feed-me file of a job, and all per-source inputs it names (cutout,
+    # sigma image, mask and constraints) are on disk; the shared PSF is not
+    # checked
+    #
+    source_dir, _ = os.path.split(feedme_fn)
+    try:
+        with open(feedme_fn, "r") as ff:
+            lines = ff.readlines()
+    except IOError:
+        return False
+    for line in lines:
+        items = line.split("#")[0].split()
+        if (len(items) >= 2 and items[0] in ("A)", "C)", "F)", "G)") and items[1].lower() != "none"):
+            if (not os.path.isfile(os.path.join(source_dir, items[1]))):
+                return False
+    return True
+
+
+# writes each feed-me writer keeps in flight, per I/O thread
+WRITES_PER_IO_THREAD = 4
+
+
+def finished_writes(pending, wait=False, max_pending=None):
+
+    #
+    # New jobs whose input files the I/O threads are done with, in whatever
+    # order they finished; with wait, wait until all of them are done, with
+    # max_pending until at most that many are still being written (so the
+    # writer never holds more than a few jobs' cutouts in memory)
+    #
+    futures = [future for future, _ in pending]
+    if (wait):
+        concurrent.futures.wait(futures)
+    elif (max_pending is not None):
+        while (len(futures) > max_pending):
+            _, futures = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+
+    done, still_pending = [], []
+    for future, new_job in pending:
+        if (future.done()):
+            # passes on any error from writing the files
+            future.result()
+            done.append(new_job)
+        else:
+            still_pending.append((future, new_job))
+    pending[:] = still_pending
+    return done
+
+
 def parallel_config_writer(file_queue, galfit_queue,
                            n_galfeeds, n_galfit_queuesize, total_feed_count,
-                           workername=None):
+                           workername=None, cost_model=None, metrics_queue=None,
+                           input_slots=None):
 
-    time.sleep(1)
     if (workername is not None):
         print("Worker %s reporting for work" % (workername))
 
+    ledger = None
+    if (args.ledger_fn is not None):
+        ledger = galfit_ledger.open_ledger(args.ledger_fn)
+    warm_store = None
+    if (args.warm_start_fn is not None):
+        warm_store = warm_start.open_store(args.warm_start_fn)
+    if (cost_model is None):
+        cost_model = galfit_scheduler.default_model()
+    # cutouts and feed-me files are written in the background, the writer
+    # keeps working out the next ones in the meantime
+    io_pool = None
+    if (args.io_threads > 0):
+        io_pool = concurrent.futures.ThreadPoolExecutor(max_workers=args.io_threads)
+    pending_writes = []
+
+    # increments for n_galfit_queuesize, n_galfeeds and total_feed_count
+    counters = run_metrics.counter_batch(
+        [n_galfit_queuesize, n_galfeeds, total_feed_count], metrics_queue)
+
     counter = 0
     while (True):
 
@@ -39,8 +340,8 @@ def parallel_config_writer(file_queue, galfit_queue,
             # galfit_queue.put((None))
             break
 
-        # open input image
-        img_hdu = pyfits.open(fn)
+        # open input image; pixel data is only read cutout by cutout
+        img_hdu = cutouts.open_frame(fn)
         img_header = img_hdu[0].header
 
         try:
@@ -61,7 +362,9 @@ def parallel_config_writer(file_queue, galfit_queue,
 
         segm_hdu = None
         if (segmentation_fn is not None):
-            segm_hdu = pyfits.open(segmentation_fn)
+            segm_hdu = cutouts.open_frame(segmentation_fn)
+        # where all objects in the segmentation map are, built when first needed
+        segm_index = None
 
         # load catalog
         if (not os.path.isfile(catalog_fn)):
@@ -89,9 +392,12 @@ def parallel_config_writer(file_queue, galfit_queue,
 
         if (not os.path.isdir(galfit_dir)):
             print("Creating directory: %s" % (galfit_dir))
-            os.makedirs(galfit_dir)
+            # another writer may create the same directory at the same time
+            os.makedirs(galfit_dir, exist_ok=True)
         else:
             print("Careful -- Resuing existing galfit directory")
+        # per-source files go into shard directories, if so configured
+        n_shards = galfit_layout.save_layout(galfit_dir, args.n_shards)
 
         # also work out the appropriate weight filename
         if (args.weight_file.find(":") >= 0):
@@ -102,53 +408,103 @@ def parallel_config_writer(file_queue, galfit_queue,
         else:
             weight_file = args.weight_file
         # open the weight file
-        wht_hdu = None
+        wht_hdu, sigma_map = None, None
         if (weight_file is not None):
-            wht_hdu = pyfits.open(weight_file)
+            wht_hdu = cutouts.open_frame(weight_file)
+            # converted to sigma cutout by cutout, with the converted pixels cached
+            sigma_map = sigma_maps.open_sigma_map(wht_hdu, args.weight_type)
+
 
 
+        psf_file, psf_supersample = get_psf_model(fn)
 
         #
-        # also construct the appropriate filename for the PSF
+        # In container mode all cutouts for this image go into a single file
         #
-        if (args.psf is not None):
-            if (args.psf.find(":") >= 0):
-                # we need to do some replacing here
-                _parts = args.psf.split(":")
-                _search = _parts[0]
-                _replace = _parts[1]
-                psf_file = fn.replace(_search, _replace)
-            else:
-                psf_file = args.psf
-            if (not os.path.isfile(psf_file)):
-                psf_file = None
-        else:
-            psf_file = None
+        container = None
+        if (args.use_container):
+            container = cutout_container.open_container(galfit_dir, basename)
 
         #
-        # Read PSF supersampling from PSF-file if available or default to 1
+        # All sources share the same PSF model, so only store it once, under a
+        # name derived from its content, and have all feed-me files refer to it
         #
-        psf_supersample = 1.
-        if (args.psf_supersample <= 0 and psf_file is not None):
-            try:
-                psf_hdu = pyfits.open(psf_file)
-                psf_supersample =  psf_hdu[0].header['SUPERSMP']  #1./psf_hdu[0].header['PSF_SAMP']
-                psf_hdu.close()
-                print("Setting PSF supersampling to %d based on data from %s" % (psf_supersample, psf_file))
-            except Exception as e:
-                print(e)
-                pass
+        galfit_psf_option = 'none'
+        if (psf_file is not None and container is not None):
+            galfit_psf_option = psf_store.psf_store_name(psf_file)
+            if (not cutout_container.has_member(container, cutout_container.SHARED, galfit_psf_option)):
+                with open(psf_file, "rb") as pf:
+                    cutout_container.add_member(container, cutout_container.SHARED, galfit_psf_option, pf.read())
+        elif (psf_file is not None):
+            galfit_psf_option = galfit_layout.shared_name(psf_store.store_psf(psf_file, galfit_dir), n_shards)
+        # binned PSFs for coarse fits, by binning factor
+        coarse_psf_options = {}
 
         #
         # Now we'll feed the workers' queue
         #
         this_catalog_added = 0
-        for src in catalog:
-            src_id = int(src['NUMBER'])
+        catalog = cutouts.sort_by_row(catalog)
+
+        #
+        # Look up what we already know about all sources in this image
+        #
+        job_states = {}
+        if (ledger is not None):
+            galfit_ledger.plan_jobs(ledger, fn, catalog['NUMBER'])
+            job_states = galfit_ledger.image_states(ledger, fn)
+
+        #
+        # Start from earlier solutions for these sources, where we have them
+        #
+        warm_solutions = {}
+        if (warm_store is not None):
+            ra, dec = None, None
+            if (all([c in catalog.colnames for c in warm_start.POSITION_COLUMNS])):
+                ra, dec = [catalog[c] for c in warm_start.POSITION_COLUMNS]
+            warm_solutions = warm_start.load_solutions(
+                warm_store, basename, catalog['NUMBER'], ra, dec, args.warm_start_radius)
+            print("Found earlier solutions for %d of %d sources in %s" % (
+                len(warm_solutions), len(catalog), catalog_fn))
+
+        #
+        # Work out the cutouts of all sources, and merge sources with
+        # overlapping cutouts into groups that are fitted together
+        #
+        plan = plan_sources(catalog, img_header['NAXIS1'], img_header['NAXIS2'], args.max_size, args.sizing)
+        boxes = plan_boxes(plan)
+        psf_nx, psf_ny = job_sizing.psf_footprint(psf_file, psf_supersample)
+        # pixels and FFT operations of all jobs, for the report at the end of the image
+        job_npix, job_fft = [], []
+        groups = plan_groups(plan, boxes)
+        # so the results of all group members can be found later, e.g. by combine_sextractor_galfit.py
+        source_groups.write_groups(source_groups.groups_filename(galfit_dir, basename),
+                                   [[int(n) for n in plan['number'][members]] for members in groups])
+        if (args.max_group_size > 1):
+            print("Grouped %(n_sources)d sources into %(n_groups)d fits (largest group: %(largest)d sources, "
+                  "%(n_group_pixels)d instead of %(n_pixels)d pixels)" % (
+                source_groups.group_summary(groups, boxes)))
+
+        for members in groups:
+            src = plan[members[0]]
+            src_id = int(src['number'])
+            member_ids = [int(n) for n in plan['number'][members]]
+            if (numpy.all([job_states.get(m, None) == 'done' for m in member_ids])):
+                continue
+            job_state = job_states.get(src_id, None)
+
+            # in pipelined mode, wait until the job is among the next few to run
+            if (input_slots is not None and not input_slots.acquire(block=False)):
+                for _job, _info in finished_writes(pending_writes, wait=True):
+                    queue_new_job(galfit_queue, _job, _info, ledger, counters)
+                run_metrics.flush_counters(counters, force=True)
+                input_slots.acquire()
+            src_start_time = time.time()
+            source_dir = galfit_layout.source_dir(galfit_dir, src_id, n_shards)
             feedme_fullfn = "%s.%05d.galfeed" % (basename, src_id)
             print("inputfeed", feedme_fullfn)
 
-            feedme_fullfn = os.path.join(galfit_dir, feedme_fullfn)
+            feedme_fullfn = os.path.join(source_dir, feedme_fullfn)
             # print(feedme_fullfn)
 
             # _segmentation_cutout_fn = "%s.%05d.segment" % (basename, src_id)
@@ -157,11 +513,11 @@ def parallel_config_writer(file_queue, galfit_queue,
             # _segmenation_input_fn =
 
             galfit_fn = "%s.%05d.galfit.fits" % (basename, src_id)
-            galfit_fullfn = os.path.join(galfit_dir, galfit_fn)
+            galfit_fullfn = os.path.join(source_dir, galfit_fn)
 
 
             galfit_logfn = "%s.%05d.galfit.log" % (basename, src_id)
-            galfit_fulllogfn = os.path.join(galfit_dir, galfit_logfn)
+            galfit_fulllogfn = os.path.join(source_dir, galfit_logfn)
 
         #     src_queue.put((
         #         fn,                 # image_fn,
@@ -213,17 +569,68 @@ def parallel_config_writer(file_queue, galfit_queue,
             #     magzero,
             # )
 
+            #
+            # Work out the cutout, and from that the expected cost of the fit
+            #
+            # (groups are cut out around all their members, and fit one component per member)
+            x, y = src['x'], src['y']
+            (x1, x2, y1, y2), conv_box, predicted_time = plan_group_job(
+                plan, boxes, members, psf_nx, psf_ny, psf_supersample, cost_model)
+            npix = (x2 - x1) * (y2 - y1)
+            fft_cost = float(job_sizing.fft_cost(conv_box[0], conv_box[1], psf_supersample))
+            job_npix.append(npix)
+            job_fft.append(fft_cost)
+            flux_radius = float(src['halflight_radius'])
+
+            galfit_job = dict(
+                feedme=feedme_fullfn,
+                galfit_output=galfit_fullfn,
+                logfile=galfit_fulllogfn,
+                container=None if container is None else container['filename'],
+                src_id=src_id,
+                members=member_ids,
+                image=fn,
+                state=job_state,
+                cost=predicted_time,
+                timeout=galfit_scheduler.job_timeout(
+                    predicted_time, args.galfit_timeout, args.timeout_scale, args.max_timeout),
+                catalog=catalog_fn,
+                basename=basename,
+                results_table=galfit_results.results_table_filename(galfit_dir, basename),
+                cleanup=input_slots is not None,
+            )
+
+            # large sources are first fitted on binned cutouts
+            coarse = None
+            coarse_factor = coarse_fit.binning_factor(numpy.max([x2 - x1, y2 - y1]), args.coarse_size)
+            if (coarse_factor > 1):
+                coarse = coarse_stage(galfit_job, coarse_factor)
+
             # print(image_fn)
-            if (os.path.isfile(feedme_fullfn)):
+            # the ledger may list the inputs as written, but they could have
+            # been removed since, so always check (container members are
+            # always written together with their feed-me file)
+            if (container is not None):
+                _, _feedme = os.path.split(feedme_fullfn)
+                feedme_exists = cutout_container.has_member(container, src_id, _feedme)
+            else:
+                feedme_exists = job_inputs_exist(feedme_fullfn)
+            if (not feedme_exists and job_state in galfit_ledger.INPUT_READY):
+                print("Inputs of %s are missing, writing them again" % (feedme_fullfn))
+            if (feedme_exists):
                 print("Skipping existing feed-file %s" % (feedme_fullfn))
-
-                if (n_galfit_queuesize is not None):
-                    with n_galfit_queuesize.get_lock():
-                        n_galfit_queuesize.value += 1
-                if (n_galfeeds is not None):
-                    with n_galfeeds.get_lock():
-                        n_galfeeds.value += 1
-                galfit_queue.put((feedme_fullfn, galfit_fullfn, galfit_fulllogfn))
+                if (coarse is not None):
+                    if (container is not None):
+                        _, _coarse_feedme = os.path.split(coarse['feedme'])
+                        coarse_exists = cutout_container.has_member(container, src_id, _coarse_feedme)
+                    else:
+                        coarse_exists = os.path.isfile(coarse['feedme'])
+                    if (coarse_exists):
+                        galfit_job['coarse'] = coarse
+
+                galfit_job['queued_time'] = time.time()
+                run_metrics.count(counters, [1, 1, 0])
+                galfit_queue.put(galfit_job)
 
                 # queue.task_done()
                 continue
@@ -233,77 +640,82 @@ def parallel_config_writer(file_queue, galfit_queue,
             # image, weight-image, and segmentation mask
             #
             print("Creating feed-me file %s" % (feedme_fullfn))
-            fwhm = src['FWHM_IMAGE']
-            src_id = int(src['NUMBER'])
-            size = 3 * fwhm
-            if (args.max_size > 0 and size > args.max_size): size = args.max_size
-
-            x, y = src['X_IMAGE']-1, src['Y_IMAGE']-1
-            x1 = int(numpy.max([0, x - size]))
-            x2 = int(numpy.min([x + size, img_header['NAXIS1']]))
-            y1 = int(numpy.max([0, y - size]))
-            y2 = int(numpy.min([y + size, img_header['NAXIS2']]))
 
             # open the input images and create cutouts
-            img_out_fn = "%s/%s.%05d.image.fits" % (galfit_dir, basename, src_id)
-            segm_out_fn = "%s/%s.%05d.segm.fits" % (galfit_dir, basename, src_id)
-            weight_out_fn = "%s/%s.%05d.sigma.fits" % (galfit_dir, basename, src_id)
+            img_out_fn = "%s/%s.%05d.image.fits" % (source_dir, basename, src_id)
+            segm_out_fn = "%s/%s.%05d.segm.fits" % (source_dir, basename, src_id)
+            weight_out_fn = "%s/%s.%05d.sigma.fits" % (source_dir, basename, src_id)
             constraints_opt = "%s.%05d.constraints" % (basename, src_id)
-            constraints_fn = "%s/%s" % (galfit_dir, constraints_opt)
-            psf_out_fn = "%s/%s.%05d.psf.fits" % (galfit_dir, basename, src_id)
+            constraints_fn = "%s/%s" % (source_dir, constraints_opt)
 
             # img_hdu = pyfits.open(image_fn)
-            img = img_hdu[0].data[y1:y2, x1:x2]
+            img = cutouts.read_cutout(img_hdu, x1, x2, y1, y2)
             phdu = pyfits.PrimaryHDU(data=img)
             phdu.header['SRC_X1'] = x1
             phdu.header['SRC_Y1'] = y1
-            phdu.writeto(img_out_fn, overwrite=True)
+            # (filename, content) of all input files of this job, written all at once below
+            job_files = [(img_out_fn, cutout_container.fits_bytes(phdu))]
 
             _, _img = os.path.split(img_out_fn)
             _weight, _bpm = 'none', 'none'
             _, _out = os.path.split(galfit_fullfn)
 
-            if (wht_hdu is not None):
-                wht = wht_hdu[0].data[y1:y2, x1:x2]
-                pyfits.PrimaryHDU(data=wht, header=phdu.header).writeto(weight_out_fn, overwrite=True)
+            wht, segm, bad_pixels = None, None, None
+            if (sigma_map is not None):
+                wht, bad_pixels = sigma_maps.read_sigma(sigma_map, x1, x2, y1, y2)
+                job_files.append((weight_out_fn, cutout_container.fits_bytes(
+                    pyfits.PrimaryHDU(data=wht, header=phdu.header))))
                 _, _weight = os.path.split(weight_out_fn)
 
             if (segm_hdu is not None):
                 try:
-                    segm = segm_hdu[0].data[y1:y2, x1:x2].astype(numpy.int)
-                    segm[segm == src_id] = 0
-                    pyfits.PrimaryHDU(data=segm, header=phdu.header).writeto(segm_out_fn, overwrite=True)
-                    _, _bpm = os.path.split(segm_out_fn)
+                    if (segm_index is None):
+                        segm_index = segmentation_index.build_index(segm_hdu)
+                    segm = segmentation_index.cutout_mask(segm_index, segm_hdu, x1, x2, y1, y2, keep=member_ids)
                 except IOError:
-                    pass
+                    segm = None
             else:
                 print("Unable to generate source mask from segmentation file (%s)" % (segmentation_fn))
 
-            if (psf_file is not None):
-                # copy the PSF model
-                shutil.copyfile(psf_file, psf_out_fn)
-                _, galfit_psf_option = os.path.split(psf_out_fn)
-            else:
-                galfit_psf_option = 'none'
-
+            # pixels without a valid uncertainty are masked, too
+            if (bad_pixels is not None and numpy.any(bad_pixels)):
+                if (segm is None):
+                    segm = numpy.zeros(bad_pixels.shape, dtype=numpy.uint8)
+                segm[bad_pixels] = numpy.iinfo(segm.dtype).max
+            if (segm is not None):
+                job_files.append((segm_out_fn, cutout_container.fits_bytes(
+                    pyfits.PrimaryHDU(data=segm, header=phdu.header))))
+                _, _bpm = os.path.split(segm_out_fn)
+
+            # starting values of all members, measured from the cutout
+            guesses = [None] * len(members)
+            sky_level = 0.
+            if (args.initial_guess == 'moments'):
+                guess = initial_guess.estimate(
+                    img, segm, plan['x'][members] - x1, plan['y'][members] - y1,
+                    plan['halflight_radius'][members])
+                guesses = list(guess)
+                sky_level = float(guess['sky'][0])
 
             #
             # Generate the constraints file
             #
-            dx = numpy.hypot(3., 3 * numpy.sqrt(src['ERRX2WIN_IMAGE']))
-            dy = numpy.hypot(3., 3 * numpy.sqrt(src['ERRY2WIN_IMAGE']))
-            # dx = numpy.max([3., 3 * numpy.sqrt(src_info['ERRX2WIN_IMAGE']) + 1.])
-            # dy = numpy.max([3., 3 * numpy.sqrt(src_info['ERRY2WIN_IMAGE']) + 1.])
-            with open(constraints_fn, "w") as cf:
-                constraints = """
-                    1   x   -%(dx).2f %(dx).2f
-                    1   y   -%(dy).2f %(dy).2f    
+            constraints = ""
+            for component, i_src in enumerate(members, 1):
+                dx, dy = plan['dx'][i_src], plan['dy'][i_src]
+                # dx = numpy.max([3., 3 * numpy.sqrt(src_info['ERRX2WIN_IMAGE']) + 1.])
+                # dy = numpy.max([3., 3 * numpy.sqrt(src_info['ERRY2WIN_IMAGE']) + 1.])
+                constraints += """
+                    %(component)d   x   -%(dx).2f %(dx).2f
+                    %(component)d   y   -%(dy).2f %(dy).2f    
                             
                 """ % {
+                    'component': component,
                     'dx': dx,
                     'dy': dy,
                 }
-                cf.write("\n".join([c.strip() for c in constraints.splitlines(keepends=False)]))
+            constraints = "\n".join([c.strip() for c in constraints.splitlines(keepends=False)])
+            job_files.append((constraints_fn, constraints.encode()))
 
 
             galfit_info = {
@@ -321,6 +733,8 @@ def parallel_config_writer(file_queue, galfit_queue,
                 'psf_supersample': int(psf_supersample),
                 'magzero': magzero,
                 'constraints': constraints_opt,
+                'conv_x': conv_box[0],
+                'conv_y': conv_box[1],
             }
 
             head_block = """
@@ -332,7 +746,7 @@ def parallel_config_writer(file_queue, galfit_queue,
                 F) %(bpm)s                # Bad pixel mask (FITS image or ASCII coord list)
                 G) %(constraints)s                # File with parameter constraints (ASCII file) 
                 H) %(x1)d %(x2)d %(y1)d %(y2)d   # Image region to fit (xmin xmax ymin ymax)
-                I) 100    100          # Size of the convolution box (x y)
+                I) %(conv_x)d    %(conv_y)d          # Size of the convolution box (x y)
                 J) %(magzero).3f              # Magnitude photometric zeropoint 
                 K) %(pixelscale).3f %(pixelscale).3f            # Plate scale (dx dy)    [arcsec per pixel]
                 O) regular             # Display type (regular, curses, both)
@@ -341,17 +755,18 @@ def parallel_config_writer(file_queue, galfit_queue,
             """ % (galfit_info)
                 # print(head_block)
 
-            posangle = 90 - src['THETA_IMAGE']
             src = {
                 'x': x-x1,
                 'y': y-y1,
-                'magnitude': src['MAG_AUTO'],  # +magzero,
-                'halflight_radius': src['FLUX_RADIUS_50'],
+                'magnitude': src['magnitude'],  # +magzero,
+                'halflight_radius': src['halflight_radius'],
                 'sersic_n': 1.5, #src[7],
-                'axis_ratio': 1./src['ELONGATION'],  #sextractur uses a/b, galfit needs b/a
-                'position_angle': posangle,
+                'axis_ratio': src['axis_ratio'],
+                'position_angle': src['position_angle'],
 
             }
+            src.update(initial_guess.starting_values(guesses[0]))
+            src.update(warm_start.starting_values(warm_solutions.get(src_id, None)))
             object_block = """
                 # Object number: 1
                  0) sersic                 #  object type
@@ -384,64 +799,489 @@ def parallel_config_writer(file_queue, galfit_queue,
                 # 10) %(position_angle).3f    1          #  position angle (PA) [deg: Up=0, Left=90]
                 #  Z) 0                      #  output option (0 = resid., 1 = Don't subtract)
                 
-                # Object number: 2
+            """ % src
+
+            # all other members of the group get their own sersic component
+            for component, (i_src, guess) in enumerate(zip(members[1:], guesses[1:]), 2):
+                neighbour = plan[i_src]
+                neighbour_values = {
+                    'component': component,
+                    'x': neighbour['x']-x1,
+                    'y': neighbour['y']-y1,
+                    'magnitude': neighbour['magnitude'],
+                    'halflight_radius': neighbour['halflight_radius'],
+                    'sersic_n': 1.5,
+                    'axis_ratio': neighbour['axis_ratio'],
+                    'position_angle': neighbour['position_angle'],
+                }
+                neighbour_values.update(initial_guess.starting_values(guess))
+                neighbour_values.update(warm_start.starting_values(warm_solutions.get(int(neighbour['number']), None)))
+                object_block += """
+                # Object number: %(component)d
+                 0) sersic                 #  object type
+                 1) %(x)d  %(y)d  1 1  #  position x, y
+                 3) %(magnitude).3f     1          #  Integrated magnitude	
+                 4) %(halflight_radius).3f      1          #  R_e (half-light radius)   [pix]
+                 5) %(sersic_n).3f      1          #  Sersic index n (de Vaucouleurs n=4) 
+                 6) 0.0000      0          #     ----- 
+                 7) 0.0000      0          #     ----- 
+                 8) 0.0000      0          #     ----- 
+                 9) %(axis_ratio).3f      1          #  axis ratio (b/a)  
+                10) %(position_angle).3f    1          #  position angle (PA) [deg: Up=0, Left=90]
+                 Z) 0                      #  output option (0 = resid., 1 = Don't subtract)
+                
+                """ % neighbour_values
+
+            object_block += """
+                # Object number: %(component)d
                  0) sky                    #  object type
-                 1) 0.0000      1          #  sky background at center of fitting region [ADUs]
+                 1) %(sky).4f      1          #  sky background at center of fitting region [ADUs]
                  2) 0.0000      0          #  dsky/dx (sky gradient in x)
                  3) 0.0000      0          #  dsky/dy (sky gradient in y)
                  Z) 0                      #  output option (0 = resid., 1 = Don't subtract) 
                     
-            """ % src
+            """ % {'component': len(members) + 1, 'sky': sky_level}
             # print(object_block)
 
             # feedme_fn = "feedme.%d" % (int(src[4]))
             # feedme_fn = "%s.src%05d.galfeed" % (config_basename, src_id)
-            with open(feedme_fullfn, "w") as feedfile:
-                feedfile.write("\n".join([l.strip() for l in head_block.splitlines()]))
-                feedfile.write("\n".join([l.strip() for l in object_block.splitlines()]))
-
-
-            # Now also prepare the segmentation mask, if available
-
-            # queue up a new execution of galfit
-            if (n_galfit_queuesize is not None):
-                with n_galfit_queuesize.get_lock():
-                    n_galfit_queuesize.value += 1
-            if (n_galfeeds is not None):
-                with n_galfeeds.get_lock():
-                    n_galfeeds.value += 1
-            if (total_feed_count is not None):
-                with total_feed_count.get_lock():
-                    total_feed_count.value += 1
-
-            print(feedme_fullfn, galfit_fullfn, galfit_fulllogfn)
-            galfit_queue.put((feedme_fullfn, galfit_fullfn, galfit_fulllogfn))
+            feedme = "\n".join([l.strip() for l in head_block.splitlines()]) + \
+                     "\n".join([l.strip() for l in object_block.splitlines()])
+            job_files.append((feedme_fullfn, feedme.encode()))
+
+            if (coarse is not None):
+                if (coarse_factor not in coarse_psf_options):
+                    coarse_psf_options[coarse_factor] = store_coarse_psf(
+                        psf_file, coarse_factor, galfit_dir, container, n_shards)
+                job_files.extend(coarse_inputs(coarse, feedme, constraints, img, wht, segm, phdu.header,
+                                               coarse_psf_options[coarse_factor]))
+                galfit_job['coarse'] = coarse
+
+
+            # queue up a new execution of galfit, once all its files are written
+            # (members of a cutout container are always added by the writer itself)
+            write_info = dict(start_time=src_start_time, npix=int(npix), flux_radius=flux_radius,
+                              psf_supersample=float(psf_supersample), conv_box=list(conv_box), fft_cost=fft_cost)
+            if (io_pool is not None and container is None):
+                pending_writes.append((io_pool.submit(write_job_inputs, job_files), (galfit_job, write_info)))
+            else:
+                write_job_inputs(job_files, container, src_id)
+                queue_new_job(galfit_queue, galfit_job, write_info, ledger, counters)
+            for _job, _info in finished_writes(pending_writes, max_pending=WRITES_PER_IO_THREAD * args.io_threads):
+                queue_new_job(galfit_queue, _job, _info, ledger, counters)
             counter += 1
 
+        for _job, _info in finished_writes(pending_writes, wait=True):
+            queue_new_job(galfit_queue, _job, _info, ledger, counters)
+        print("Sizing (%s) of %s: %s" % (args.sizing, fn, job_sizing.format_cost(job_npix, job_fft)))
+
         # close all files
         img_hdu.close()
         if (wht_hdu is not None):
             wht_hdu.close()
         if (segm_hdu is not None):
             segm_hdu.close()
+        if (container is not None):
+            cutout_container.close_container(container)
+        run_metrics.flush_counters(counters, force=True)
 
         file_queue.task_done()
         continue # with next catalog
 
+    if (io_pool is not None):
+        io_pool.shutdown()
+    run_metrics.flush_counters(counters, force=True)
     print("Prepared %d galfeeds, queue-size = %d %d" % (
         n_galfeeds.value, n_galfit_queuesize.value, counter))
 
 
+def shard_input_images(input_images, n_shards, catalog_extension):
+
+    #
+    # Distribute the input images across n_shards writers. The size of each
+    # source catalog is a good proxy for the number of feed-me files to be
+    # written, so assign the largest catalogs first, always to the shard with
+    # the least amount of work so far.
+    #
+    n_shards = int(numpy.max([1, numpy.min([n_shards, len(input_images)])]))
+
+    workload = []
+    for fn in input_images:
+        bn, _ = os.path.splitext(fn)
+        catalog_fn = "%s.%s" % (bn, catalog_extension)
+        try:
+            workload.append(os.path.getsize(catalog_fn))
+        except OSError:
+            workload.append(0)
+
+    shards = [[] for i in range(n_shards)]
+    shard_load = numpy.zeros((n_shards))
+    for i in numpy.argsort(workload)[::-1]:
+        target = numpy.argmin(shard_load)
+        shards[target].append(input_images[i])
+        shard_load[target] += workload[i]
+
+    return shards
+
+
+def plan_campaign(input_images, cost_model, n_procs, ledger=None):
+
+    #
+    # Predict the runtime of all outstanding GALFIT jobs without writing
+    # anything, and report how long the campaign should take on n_procs slots
+    #
+    all_runtimes = []
+    for fn in input_images:
+        bn, _ = os.path.splitext(fn)
+        catalog_fn = "%s.%s" % (bn, args.catalog_extension)
+        try:
+            img_header = pyfits.getheader(fn)
+            catalog = astropy.table.Table.read(catalog_fn)
+        except (IOError, ValueError) as e:
+            print("Unable to plan %s (%s)" % (fn, str(e)))
+            continue
+
+        job_states = {} if ledger is None else galfit_ledger.image_states(ledger, fn)
+        psf_file, psf_supersample = get_psf_model(fn)
+        psf_nx, psf_ny = job_sizing.psf_footprint(psf_file, psf_supersample)
+
+        # the same jobs as the writers would queue: one per group with any member not done yet
+        plan = plan_sources(catalog, img_header['NAXIS1'], img_header['NAXIS2'], args.max_size, args.sizing)
+        boxes = plan_boxes(plan)
+        runtimes, npix, conv_boxes = [], [], []
+        for members in plan_groups(plan, boxes):
+            if (numpy.all([job_states.get(int(n), None) == 'done' for n in plan['number'][members]])):
+                continue
+            (x1, x2, y1, y2), conv_box, predicted_time = plan_group_job(
+                plan, boxes, members, psf_nx, psf_ny, psf_supersample, cost_model)
+            runtimes.append(float(predicted_time))
+            npix.append((x2 - x1) * (y2 - y1))
+            conv_boxes.append(conv_box)
+        conv_boxes = numpy.array(conv_boxes).reshape((-1, 2))
+        print("%s: %d jobs, %.1f CPU-seconds" % (fn, len(runtimes), numpy.sum(runtimes)))
+        print("    %s" % (job_sizing.format_cost(
+            npix, job_sizing.fft_cost(conv_boxes[:, 0], conv_boxes[:, 1], psf_supersample))))
+        all_runtimes.extend(runtimes)
+
+    if (not all_runtimes):
+        print("Nothing left to do")
+        return
+
+    all_runtimes = numpy.array(all_runtimes)
+    print("Cost model: %s (%s)" % (
+        str(cost_model['coefficients']),
+        "calibrated from %d jobs" % (cost_model['n_jobs']) if cost_model['calibrated'] else "default"))
+    print("Total: %d jobs, %.1f CPU-seconds, longest job %.1f seconds" % (
+        all_runtimes.shape[0], numpy.sum(all_runtimes), numpy.max(all_runtimes)))
+    print("Expected wall-clock time with %d processes: %.1f seconds" % (
+        n_procs, galfit_scheduler.expected_walltime(all_runtimes, n_procs)))
+
+
 dryrun = False
 
 
+def unpack_job_inputs(cmd, container_indices, scratch_dir):
+
+    #
+    # In container mode, unpack only this source's files into a private
+    # scratch directory; returns that directory, or None outside container mode
+    #
+    if (cmd['container'] is None):
+        return None
+
+    container_fn = cmd['container']
+    index, index_pos = container_indices.get(container_fn, ({}, 0))
+    if (cmd['src_id'] not in index):
+        # the writer might have added more sources since we last looked
+        index, index_pos = cutout_container.read_index(
+            cutout_container.index_filename(container_fn), index, index_pos)
+        container_indices[container_fn] = (index, index_pos)
+    work_dir = tempfile.mkdtemp(prefix="galfit_", dir=scratch_dir)
+    cutout_container.unpack(container_fn, index, cmd['src_id'], work_dir)
+    return work_dir
+
+
+def collect_job_output(cmd, work_dir):
+
+    # keep the GALFIT output, but discard all unpacked input files
+    if (work_dir is None):
+        return
+    _, _galfit_output = os.path.split(cmd['galfit_output'])
+    if (os.path.isfile(os.path.join(work_dir, _galfit_output))):
+        shutil.move(os.path.join(work_dir, _galfit_output), cmd['galfit_output'])
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def retire_job(cmd, input_slots=None, ledger=None):
+
+    #
+    # The job is finished for good (fitted, given up on, or skipped). In
+    # pipelined mode, remove its cutouts, feed-me files and GALFIT restart
+    # files, keeping only the GALFIT output and log, record that in the
+    # ledger, and let the writers prepare the next job.
+    # (in container mode the inputs are unpacked to scratch and removed there)
+    #
+    if (cmd.get('cleanup', False) and cmd['container'] is None and not dryrun):
+        source_dir, _ = os.path.split(cmd['feedme'])
+        prefix = "%s.%05d." % (cmd['basename'], cmd['src_id'])
+        keep = [cmd['galfit_output'], cmd['logfile']]
+        for fn in glob.glob(os.path.join(source_dir, prefix + "*")):
+            if (fn not in keep and not fn.endswith(".png")):
+                os.remove(fn)
+        for restart_fn, _ in galfit_retry.restart_files(source_dir):
+            output_name = galfit_retry.restart_output_name(restart_fn)
+            if (output_name is not None and output_name.startswith(prefix)):
+                try:
+                    os.remove(restart_fn)
+                except OSError:
+                    pass
+        if (ledger is not None):
+            galfit_ledger.mark_inputs_removed(ledger, cmd['image'], job_sources(cmd))
+    if (input_slots is not None):
+        input_slots.release()
+
+
+def run_galfit_process(galfit_cmd, cwd, job_timeout, logfile, monitor=None, cancel=None):
+
+    #
+    # Run GALFIT and keep its output in the logfile; returns the return
+    # code and a description of what went wrong, if anything. The output is
+    # read while GALFIT is running, so the monitor (if any) can stop fits
+    # that are going nowhere before they run into the timeout, and GALFIT
+    # is also stopped once the threading.Event cancel (if any) is set.
+    #
+    returncode = -99999999
+    problem = None
+    deadline = time.time() + job_timeout
+    try:
+        with open(logfile, "wb") as log, \
+                subprocess.Popen(galfit_cmd.split(),
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT,
+                                 cwd=cwd) as galfit_process, \
+                selectors.DefaultSelector() as selector:
+            selector.register(galfit_process.stdout, selectors.EVENT_READ)
+            while (True):
+                remaining = deadline - time.time()
+                if (remaining <= 0):
+                    problem = "timeout after %.1f seconds" % (job_timeout)
+                    break
+                if (cancel is not None and cancel.is_set()):
+                    problem = "cancelled"
+                    break
+                if (not selector.select(timeout=remaining if cancel is None else min(remaining, 1.))):
+                    continue
+                output = os.read(galfit_process.stdout.fileno(), 65536)
+                if (not output):
+                    break
+                log.write(output)
+                reason = galfit_monitor.feed(monitor, output)
+                if (reason is not None):
+                    problem = "aborted: %s" % (reason)
+                    break
+
+            if (problem is None):
+                try:
+                    returncode = galfit_process.wait(timeout=max(0., deadline - time.time()))
+                except subprocess.TimeoutExpired:
+                    problem = "timeout after %.1f seconds" % (job_timeout)
+            if (problem is not None):
+                galfit_process.kill()
+                print("Terminating galfit: %s" % (problem))
+                returncode = -9999999
+            elif (returncode != 0):
+                print("return code was not 0 (%d), see %s" % (returncode, logfile))
+
+    except OSError as e:
+        print("Some exception has occured:\n%s" % (str(e)))
+        problem = str(e)
+
+    return returncode, problem
+
+
+def request_plot(plot_queue, plot_backlog, galfit_output_fn):
+
+    #
+    # Hand the result to the plotting workers without ever waiting for them;
+    # whatever they can not take right now is plotted once all fits are done
+    #
+    if (plot_queue is None or not os.path.isfile(galfit_output_fn)):
+        return
+    try:
+        plot_queue.put_nowait(galfit_output_fn)
+    except queue.Full:
+        plot_backlog.put(galfit_output_fn)
+
+
+def job_sources(cmd):
+
+    # all sources fitted in this job; more than one when fitting a group of neighbours
+    return cmd.get('members', [cmd['src_id']])
+
+
+def report_results(results_queue, cmd, returncode, runtime):
+
+    # parse the fit results while the output file is still in the page cache
+    if (results_queue is None):
+        return
+    for record in galfit_results.make_records(cmd, returncode, runtime):
+        results_queue.put(record)
+
+
+def prepare_feedme(cmd, cwd):
+
+    # coarse fits have their own feed-me file, refined fits and retries run a modified copy
+    if (cmd.get('coarse') is not None):
+        _, feedfile = os.path.split(cmd['coarse']['feedme'])
+        return feedfile
+    _, feedfile = os.path.split(cmd['feedme'])
+    if (cmd.get('feedme_text') is None):
+        return feedfile
+    if (cmd.get('retry', 0) > 0):
+        feedfile = galfit_retry.retry_feedme_filename(cmd)
+    else:
+        feedfile = coarse_fit.seeded_feedme_filename(feedfile)
+    with open(os.path.join(cwd, feedfile), "w") as ff:
+        ff.write(cmd['feedme_text'])
+    return feedfile
+
+
+def plan_retry(cmd, returncode, problem, cwd, feedfile, retry_policy):
+
+    #
+    # Work out how to retry a failed fit; this needs to happen while the
+    # feed-me file (and a GALFIT restart file, if any) are still around
+    #
+    if (cmd.get('coarse') is not None):
+        return plan_refinement(cmd, returncode, problem, cwd)
+    if (retry_policy is None):
+        return None
+    # (in container mode the output is still in the scratch directory at this point)
+    _, galfit_output = os.path.split(cmd['galfit_output'])
+    failure = galfit_retry.classify_failure(returncode, problem, os.path.join(cwd, galfit_output))
+    if (failure is None):
+        return None
+    try:
+        with open(os.path.join(cwd, feedfile), "r") as ff:
+            feedme = ff.read()
+    except IOError:
+        return None
+
+    retry = galfit_retry.escalate(cmd, failure, feedme, cwd, retry_policy)
+    if (retry is not None):
+        print("Retrying %s after %s (attempt %d: %s)" % (
+            cmd['feedme'], failure, retry['retry'], retry['strategy']))
+        # retries go to the end of the line, and always need to run
+        retry['cost'] = -retry['retry']
+        retry['state'] = 'failed'
+    return retry
+
+
+def plan_refinement(cmd, returncode, problem, cwd):
+
+    #
+    # After the coarse fit of a large source, continue at full resolution,
+    # starting from the coarse solution (or from scratch if the coarse fit
+    # did not work out)
+    #
+    coarse = cmd['coarse']
+    refine = dict(cmd)
+    del refine['coarse']
+    refine['strategy'] = 'full'
+    refine['feedme_text'] = None
+
+    _, feedfile = os.path.split(cmd['feedme'])
+    _, coarse_output = os.path.split(coarse['galfit_output'])
+    coarse_output = os.path.join(cwd, coarse_output)
+    if (galfit_retry.classify_failure(returncode, problem, coarse_output) is None):
+        try:
+            with open(os.path.join(cwd, feedfile), "r") as ff:
+                refine['feedme_text'] = coarse_fit.seed_feedme(ff.read(), coarse_output, coarse['factor'])
+        except IOError:
+            pass
+    if (refine['feedme_text'] is not None):
+        refine['strategy'] = 'refine'
+        if (cmd.get('timeout') is not None):
+            refine['timeout'] = coarse_fit.refine_timeout(cmd['timeout'])
+    print("Fitting %s at full resolution (%s)" % (
+        cmd['feedme'], "seeded from coarse fit" if refine['strategy'] == 'refine' else "coarse fit failed"))
+    refine['queued_time'] = time.time()
+    return refine
+
+
+def finish_job(cmd, returncode, problem, start_time, end_time, runtime, retry=None,
+               ledger=None, counters=None, results_queue=None, retry_queue=None,
+               input_slots=None, **event_info):
+
+    #
+    # All the bookkeeping after a fit: ledger, results table, counters and
+    # metrics; failed jobs with a retry go back into the job queue
+    #
+    if (cmd.get('coarse') is not None):
+        # only the fit at full resolution counts
+        event_info['stage'] = 'coarse'
+    else:
+        record_job_result(ledger, cmd, returncode, end_time, runtime, problem, retry)
+        report_results(results_queue, cmd, returncode, runtime)
+
+    # a job going back for a retry is not done yet
+    done = 0 if retry is not None else 1
+    run_metrics.count(counters, [-done, done, runtime], run_metrics.job_event(
+        'fit', cmd, queue_wait=start_time - cmd.get('queued_time', start_time),
+        runtime=runtime, returncode=returncode,
+        timeout=problem is not None and problem.startswith("timeout"),
+        aborted=problem is not None and problem.startswith("aborted"),
+        output_size=run_metrics.output_size(cmd['galfit_output']),
+        attempt=cmd.get('retry', 0),
+        retry_strategy=None if retry is None else retry['strategy'],
+        **event_info))
+
+    if (retry is not None):
+        retry['queued_time'] = time.time()
+        retry_queue.put(retry)
+    else:
+        retire_job(cmd, input_slots, ledger)
+
+
+def record_job_result(ledger, cmd, returncode, end_time, runtime, problem, retry=None):
+
+    if (ledger is None):
+        return None
+
+    # only a clean exit with a non-empty output file counts as done
+    if (problem is not None and problem.startswith("timeout")):
+        final_state = 'timeout'
+    elif (returncode == 0 and os.path.isfile(cmd['galfit_output']) and
+          os.path.getsize(cmd['galfit_output']) > 0):
+        final_state = 'done'
+    else:
+        final_state = 'failed'
+        if (problem is None):
+            problem = "no output" if returncode == 0 else "return code %d" % (returncode)
+    if (cmd.get('retry', 0) > 0):
+        problem = "%s (attempt %d: %s)" % ("done" if problem is None else problem, cmd['retry'], cmd['strategy'])
+    if (retry is not None):
+        problem = "%s; retry %d: %s" % (problem, retry['retry'], retry['strategy'])
+    galfit_ledger.update_job(ledger, cmd['image'], job_sources(cmd), final_state,
+                             returncode=returncode, end_time=end_time,
+                             runtime=runtime, message=problem)
+    return final_state
+
+
 def parallel_run_galfit(galfit_queue,
                         problems_queue,
                         galfit_exe='galfit',
-                        make_plots=True, redo=False,
+                        plot_queue=None, plot_backlog=None, results_queue=None, redo=False,
+                        retry_queue=None, retry_policy=None,
                         n_galfit_complete=None, n_total_galfit_time=None,
                         n_galfit_queuesize=None, n_galfeeds=None,
+                        n_galfit_queued=None,
                         galfit_timeout=60,
+                        monitor_rules=None,
+                        scratch_dir=None,
+                        ledger_fn=None,
+                        metrics_queue=None,
+                        input_slots=None,
                         ):
 
     logger = logging.getLogger("GalfitWorker")
@@ -450,12 +1290,30 @@ def parallel_run_galfit(galfit_queue,
     logger.debug("%s %s %s %s" % (str(n_galfit_queuesize), str(n_galfit_complete), str(n_total_galfit_time), str(n_galfeeds)))
     # return
 
+    # offset indices of all cutout containers we have seen so far
+    container_indices = {}
+
+    ledger = None
+    if (ledger_fn is not None):
+        ledger = galfit_ledger.open_ledger(ledger_fn)
+
+    # increments for n_galfit_queuesize, n_galfit_complete and n_total_galfit_time
+    counters = run_metrics.counter_batch(
+        [n_galfit_queuesize, n_galfit_complete, n_total_galfit_time], metrics_queue)
+
     counter = 0
     while (True):
 
-        cmd = galfit_queue.get()
+        try:
+            cmd = galfit_queue.get(timeout=counters['max_age'])
+        except queue.Empty:
+            # nothing to do right now, so make sure the progress counters are current
+            run_metrics.flush_counters(counters, force=True)
+            continue
+        galfit_scheduler.job_taken(n_galfit_queued, cmd)
         if (cmd is None):
             print("Received shutdown command")
+            run_metrics.flush_counters(counters, force=True)
             galfit_queue.task_done()
             break
 
@@ -464,7 +1322,10 @@ def parallel_run_galfit(galfit_queue,
         #     galfit_queue.task_done()
         #     continue
 
-        feedme_fn, galfit_output_fn, logfile = cmd
+        feedme_fn = cmd['feedme']
+        galfit_output_fn = cmd['galfit_output']
+        logfile = cmd['logfile']
+        job_timeout = cmd.get('timeout', galfit_timeout)
         _cwd, _feedfile = os.path.split(feedme_fn)
 
         # if (n_galfit_queuesize is not None):
@@ -478,84 +1339,62 @@ def parallel_run_galfit(galfit_queue,
 
         galfit_cmd = "%s %s" % (galfit_exe, _feedfile) #feedme_fn)
 
-        if ((os.path.isfile(galfit_output_fn) and not redo) or dryrun):
+        #
+        # Jobs the ledger knows to be unfinished are always re-run, even if
+        # there is a (possibly truncated) output file from an earlier attempt
+        #
+        known_unfinished = (cmd['state'] in galfit_ledger.INPUT_READY)
+        if ((not known_unfinished and os.path.isfile(galfit_output_fn) and not redo) or dryrun):
             if (dryrun):
                 print("cd %s && %s" % (_cwd, galfit_cmd))
             else:
                 print("Skipping galfit run for completed file (%s)" % (galfit_output_fn))
-            if (n_galfit_queuesize is not None):
-                with n_galfit_queuesize.get_lock():
-                    n_galfit_queuesize.value -= 1
-            if (n_galfit_complete is not None):
-                with n_galfit_complete.get_lock():
-                    n_galfit_complete.value += 1
+                if (ledger is not None):
+                    galfit_ledger.update_job(ledger, cmd['image'], job_sources(cmd), 'done',
+                                             feedme=feedme_fn, galfit_output=galfit_output_fn)
+            run_metrics.count(counters, [-1, 1, 0], run_metrics.job_event('skip', cmd))
+            retire_job(cmd, input_slots, ledger)
             galfit_queue.task_done()
             continue
 
         # galfit_queue.task_done()
         # continue
 
-        start_time = time.time()
-        returncode = -99999999
-        try:
-            # os.system(sexcmd)
-#             time.sleep(.2)
-            with subprocess.Popen(galfit_cmd.split(),
-                                  stdout=subprocess.PIPE,
-                                  stderr=subprocess.PIPE,
-                                  cwd=_cwd) as galfit_process:
-                try:
-                    _stdout, _stderr = galfit_process.communicate(input=None, timeout=galfit_timeout)
-
-
-                    returncode = galfit_process.returncode
-                    if (galfit_process.returncode != 0):
-                        print("return code was not 0 (%d)" % (galfit_process.returncode))
-                        print(str(_stdout))
-                        print(str(_stderr))
-                #print(_stdout)
-
-                    with open(logfile, "wb") as log:
-                        log.write(_stdout)
-                        #log.write("\n*10STDERR\n========\n")
-                        log.write(_stderr)
-
-                except (TimeoutError, subprocess.TimeoutExpired) as e: #TimeoutExpired
-                    galfit_process.kill()
-                    print("Terminating galfit after timeout")
-                    returncode = -9999999
-
-                    problem_str = "%s ::: %s\n" % (feedme_fn, " ".join(galfit_cmd.split()))
-                    problems_queue.put(problem_str)
-
-            # ret = subprocess.Popen(galfit_cmd.split(),
-            #                        stdout=subprocess.PIPE,
-            #                        stderr=subprocess.PIPE)
-            # (_stdout, _stderr) = ret.communicate()
-            #     break
+        #
+        # In container mode, unpack only this source's files into a private
+        # scratch directory and run GALFIT in there
+        #
+        work_dir = unpack_job_inputs(cmd, container_indices, scratch_dir)
+        if (work_dir is not None):
+            _cwd = work_dir
+        _feedfile = prepare_feedme(cmd, _cwd)
+        galfit_cmd = "%s %s" % (galfit_exe, _feedfile)
 
-            # sex = subprocess.run(sexcmd.split(), shell=True, check=True,
-            #                      stdout=subprocess.PIPE,
-            #                      stderr=subprocess.PIPE,)
-        except OSError as e:
-            print("Some exception has occured:\n%s" % (str(e)))
+        start_time = time.time()
+        if (ledger is not None):
+            galfit_ledger.update_job(ledger, cmd['image'], job_sources(cmd), 'running',
+                                     feedme=feedme_fn, galfit_output=galfit_output_fn,
+                                     start_time=start_time)
+
+        returncode, problem = run_galfit_process(galfit_cmd, _cwd, job_timeout, logfile,
+                                                 galfit_monitor.start(monitor_rules, os.path.join(_cwd, _feedfile)))
+        if (problem is not None and problem.startswith("timeout")):
+            problems_queue.put("%s ::: %s\n" % (feedme_fn, " ".join(galfit_cmd.split())))
+        elif (problem is not None and problem.startswith("aborted")):
+            problems_queue.put("%s ::: %s\n" % (feedme_fn, problem))
         end_time = time.time()
         galfit_time = end_time - start_time
+
+        retry = plan_retry(cmd, returncode, problem, _cwd, _feedfile, retry_policy)
+        collect_job_output(cmd, work_dir)
         # print("Galfit returned after %.3f seconds" % (end_time - start_time))
         # print(n_galfit_queuesize, n_galfit_complete, n_total_galfit_time)
 
         logger.debug("%s ==> %d" % (galfit_cmd, returncode))
 
-
-        if (n_galfit_queuesize is not None):
-            with n_galfit_queuesize.get_lock():
-                n_galfit_queuesize.value -= 1
-        if (n_galfit_complete is not None):
-            with n_galfit_complete.get_lock():
-                n_galfit_complete.value += 1
-        if (n_total_galfit_time is not None):
-            with n_total_galfit_time.get_lock():
-                n_total_galfit_time.value += galfit_time
+        finish_job(cmd, returncode, problem, start_time, end_time, galfit_time, retry,
+                   ledger=ledger, counters=counters, results_queue=results_queue,
+                   retry_queue=retry_queue, input_slots=input_slots)
         # if (n_galfit_queuesize is not None and
         #         n_galfit_complete is not None and
         #         n_total_galfit_time is not None and
@@ -568,14 +1407,7 @@ def parallel_run_galfit(galfit_queue,
         #         n_galfit_queuesize.value*avg_galfit_time,
         #     ))
 
-        if (make_plots and os.path.isfile(galfit_output_fn)):
-            try:
-                plot_galfit_results.plot_galfit_result(
-                    fits_fn=galfit_output_fn,
-                    plot_fn=galfit_output_fn[:-5]+".png",
-                )
-            except:
-                print("Error while making plot")
+        request_plot(plot_queue, plot_backlog, galfit_output_fn)
 
         galfit_queue.task_done()
         continue
@@ -583,6 +1415,427 @@ def parallel_run_galfit(galfit_queue,
     print("Shutting down galfit parallel worker-process")
 
 
+async def async_run_galfit_job(cmd, galfit_queue, problems_queue, galfit_exe, redo,
+                               galfit_timeout, scratch_dir, container_indices,
+                               ledger, counters, plot_queue, plot_backlog, results_queue,
+                               retry_queue, retry_policy, input_slots, monitor_rules, bookkeeping):
+
+    #
+    # Same as one iteration of parallel_run_galfit, but the GALFIT process is
+    # handled by the event loop so many of them can run side by side. Unpacking
+    # the inputs, the ledger, moving the output and parsing the results all
+    # block, so they run in the bookkeeping thread (which also owns the ledger
+    # connection and the counters), never on the event loop itself.
+    #
+    feedme_fn = cmd['feedme']
+    galfit_output_fn = cmd['galfit_output']
+    job_timeout = cmd.get('timeout', galfit_timeout)
+    _cwd, _feedfile = os.path.split(feedme_fn)
+    loop = asyncio.get_running_loop()
+
+    def blocking(function, *args, **kwargs):
+        return loop.run_in_executor(bookkeeping, functools.partial(function, *args, **kwargs))
+
+    def skip_job():
+        if (ledger is not None and not dryrun):
+            galfit_ledger.update_job(ledger, cmd['image'], job_sources(cmd), 'done',
+                                     feedme=feedme_fn, galfit_output=galfit_output_fn)
+        run_metrics.count(counters, [-1, 1, 0], run_metrics.job_event('skip', cmd))
+        retire_job(cmd, input_slots, ledger)
+
+    def start_job():
+        work_dir = unpack_job_inputs(cmd, container_indices, scratch_dir)
+        cwd = _cwd if work_dir is None else work_dir
+        feedfile = prepare_feedme(cmd, cwd)
+        start_time = time.time()
+        if (ledger is not None):
+            galfit_ledger.update_job(ledger, cmd['image'], job_sources(cmd), 'running',
+                                     feedme=feedme_fn, galfit_output=galfit_output_fn,
+                                     start_time=start_time)
+        monitor = galfit_monitor.start(monitor_rules, os.path.join(cwd, feedfile))
+        return work_dir, cwd, feedfile, start_time, monitor
+
+    def end_job(work_dir, cwd, feedfile, returncode, problem, start_time, end_time):
+        retry = plan_retry(cmd, returncode, problem, cwd, feedfile, retry_policy)
+        collect_job_output(cmd, work_dir)
+        finish_job(cmd, returncode, problem, start_time, end_time, end_time - start_time, retry,
+                   ledger=ledger, counters=counters, results_queue=results_queue,
+                   retry_queue=retry_queue, input_slots=input_slots)
+        request_plot(plot_queue, plot_backlog, galfit_output_fn)
+
+    try:
+        known_unfinished = (cmd['state'] in galfit_ledger.INPUT_READY)
+        if ((not known_unfinished and os.path.isfile(galfit_output_fn) and not redo) or dryrun):
+            if (dryrun):
+                print("cd %s && %s %s" % (_cwd, galfit_exe, _feedfile))
+            else:
+                print("Skipping galfit run for completed file (%s)" % (galfit_output_fn))
+            await blocking(skip_job)
+            return
+
+        work_dir, _cwd, _feedfile, start_time, monitor = await blocking(start_job)
+
+        returncode = -99999999
+        problem = None
+        deadline = time.time() + job_timeout
+        try:
+            # --galfit may include arguments, run the same command line as run_galfit_process
+            galfit_process = await asyncio.create_subprocess_exec(
+                *galfit_exe.split(), _feedfile,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT,
+                cwd=_cwd)
+            with open(cmd['logfile'], "wb") as log:
+                try:
+                    # read the output as it comes, so the monitor can stop the fit early
+                    while (True):
+                        output = await asyncio.wait_for(
+                            galfit_process.stdout.read(65536), timeout=max(0., deadline - time.time()))
+                        if (not output):
+                            break
+                        log.write(output)
+                        reason = galfit_monitor.feed(monitor, output)
+                        if (reason is not None):
+                            problem = "aborted: %s" % (reason)
+                            break
+                    if (problem is None):
+                        returncode = await asyncio.wait_for(
+                            galfit_process.wait(), timeout=max(0., deadline - time.time()))
+                except asyncio.TimeoutError:
+                    problem = "timeout after %.1f seconds" % (job_timeout)
+            if (problem is not None):
+                try:
+                    galfit_process.kill()
+                except ProcessLookupError:
+                    pass
+                await galfit_process.wait()
+                print("Terminating galfit: %s" % (problem))
+                returncode = -9999999
+                if (problem.startswith("timeout")):
+                    problems_queue.put("%s ::: %s %s\n" % (feedme_fn, galfit_exe, _feedfile))
+                else:
+                    problems_queue.put("%s ::: %s\n" % (feedme_fn, problem))
+            elif (returncode != 0):
+                print("return code was not 0 (%d), see %s" % (returncode, cmd['logfile']))
+        except OSError as e:
+            print("Some exception has occured:\n%s" % (str(e)))
+            problem = str(e)
+        await blocking(end_job, work_dir, _cwd, _feedfile, returncode, problem, start_time, time.time())
+
+    finally:
+        galfit_queue.task_done()
+
+
+async def async_galfit_orchestrator(galfit_queue, n_slots, n_galfit_queued=None, poll_interval=0.05, **kwargs):
+
+    #
+    # Keep up to n_slots GALFIT processes running at any time, starting a new
+    # one as soon as a slot frees up and a job is waiting in the queue
+    #
+    running = set()
+    shutdown = False
+    while (not shutdown or running):
+        while (not shutdown and len(running) < n_slots):
+            try:
+                cmd = galfit_queue.get_nowait()
+            except queue.Empty:
+                break
+            galfit_scheduler.job_taken(n_galfit_queued, cmd)
+            if (cmd is None):
+                print("Received shutdown command")
+                galfit_queue.task_done()
+                shutdown = True
+                break
+            running.add(asyncio.ensure_future(async_run_galfit_job(cmd, galfit_queue, **kwargs)))
+
+        if (running):
+            # with all slots busy there is no point looking at the queue before a job finishes
+            done, running = await asyncio.wait(
+                running, timeout=None if len(running) >= n_slots else poll_interval,
+                return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if (task.exception() is not None):
+                    print("Error while running galfit: %s" % (str(task.exception())))
+        else:
+            await asyncio.sleep(poll_interval)
+
+        # pass on progress once in a while, also while idle (the counters belong to the bookkeeping thread)
+        kwargs['bookkeeping'].submit(run_metrics.flush_counters, kwargs['counters'])
+
+    kwargs['bookkeeping'].submit(run_metrics.flush_counters, kwargs['counters'], force=True).result()
+
+
+def parallel_run_galfit_async(galfit_queue,
+                              problems_queue,
+                              galfit_exe='galfit',
+                              plot_queue=None, plot_backlog=None, results_queue=None, redo=False,
+                              retry_queue=None, retry_policy=None,
+                              n_galfit_complete=None, n_total_galfit_time=None,
+                              n_galfit_queuesize=None, n_galfeeds=None,
+                              n_galfit_queued=None,
+                              n_slots=1,
+                              galfit_timeout=60,
+                              monitor_rules=None,
+                              scratch_dir=None,
+                              ledger_fn=None,
+                              metrics_queue=None,
+                              input_slots=None,
+                              ):
+
+    #
+    # Alternative to starting n_slots copies of parallel_run_galfit: a single
+    # process runs an asyncio event loop that supervises all GALFIT processes,
+    # with all blocking bookkeeping done in one separate thread
+    #
+    bookkeeping = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    ledger = None
+    if (ledger_fn is not None):
+        # sqlite connections can only be used in the thread that opened them
+        ledger = bookkeeping.submit(galfit_ledger.open_ledger, ledger_fn).result()
+
+    counters = run_metrics.counter_batch(
+        [n_galfit_queuesize, n_galfit_complete, n_total_galfit_time], metrics_queue)
+
+    asyncio.run(async_galfit_orchestrator(
+        galfit_queue, n_slots, n_galfit_queued=n_galfit_queued,
+        problems_queue=problems_queue, galfit_exe=galfit_exe, redo=redo,
+        galfit_timeout=galfit_timeout, scratch_dir=scratch_dir,
+        container_indices={}, ledger=ledger, counters=counters,
+        plot_queue=plot_queue, plot_backlog=plot_backlog, results_queue=results_queue,
+        retry_queue=retry_queue, retry_policy=retry_policy, input_slots=input_slots,
+        monitor_rules=monitor_rules, bookkeeping=bookkeeping))
+    bookkeeping.shutdown()
+    print("Shutting down galfit orchestrator")
+
+
+def run_broker_job(cmd, galfit_exe='galfit', galfit_timeout=60, redo=False,
+                   scratch_dir=None, container_indices=None, retry_policy=None, monitor_rules=None,
+                   cancel=None):
+
+    #
+    # Run one job handed out by the job broker on a worker agent. All the
+    # bookkeeping is left to the coordinator; only the fit results are
+    # already extracted here, while the output file is still in the cache.
+    #
+    feedme_fn = cmd['feedme']
+    galfit_output_fn = cmd['galfit_output']
+    _cwd, _feedfile = os.path.split(feedme_fn)
+
+    known_unfinished = (cmd['state'] in galfit_ledger.INPUT_READY)
+    if (not known_unfinished and os.path.isfile(galfit_output_fn) and not redo):
+        print("Skipping galfit run for completed file (%s)" % (galfit_output_fn))
+        return dict(skipped=True)
+
+    work_dir = unpack_job_inputs(cmd, {} if container_indices is None else container_indices, scratch_dir)
+    if (work_dir is not None):
+        _cwd = work_dir
+    _feedfile = prepare_feedme(cmd, _cwd)
+
+    start_time = time.time()
+    returncode, problem = run_galfit_process(
+        "%s %s" % (galfit_exe, _feedfile), _cwd, cmd.get('timeout', galfit_timeout), cmd['logfile'],
+        galfit_monitor.start(monitor_rules, os.path.join(_cwd, _feedfile)), cancel)
+    end_time = time.time()
+    retry = plan_retry(cmd, returncode, problem, _cwd, _feedfile, retry_policy)
+    collect_job_output(cmd, work_dir)
+
+    return dict(skipped=False, returncode=returncode, problem=problem, retry=retry,
+                start_time=start_time, end_time=end_time, runtime=end_time - start_time,
+                output_size=run_metrics.output_size(galfit_output_fn),
+                results=galfit_results.make_records(cmd, returncode, end_time - start_time))
+
+
+def run_broker_agent(address, n_slots, galfit_exe='galfit', galfit_timeout=60,
+                     scratch_dir=None, authkey=None, retry_policy=None, monitor_rules=None):
+
+    #
+    # Worker agent: run n_slots jobs at a time for the coordinator at address
+    #
+    agent_base = "%s:%d" % (socket.gethostname(), os.getpid())
+    container_indices = {}
+
+    def run_job(cmd, cancel):
+        return run_broker_job(cmd, galfit_exe=galfit_exe, galfit_timeout=galfit_timeout,
+                              scratch_dir=scratch_dir, container_indices=container_indices,
+                              retry_policy=retry_policy, monitor_rules=monitor_rules, cancel=cancel)
+
+    agents = []
+    for i in range(n_slots):
+        t = threading.Thread(
+            target=galfit_broker.agent_loop,
+            kwargs=dict(address=address, agent_name="%s/%d" % (agent_base, i),
+                        run_job=run_job, authkey=authkey),
+        )
+        t.start()
+        agents.append(t)
+    for t in agents:
+        t.join()
+    print("Agent %s: coordinator has no more work" % (agent_base))
+
+
+def handle_broker_results(result_queue, problems_queue,
+                          plot_queue=None, plot_backlog=None, results_queue=None,
+                          n_galfit_complete=None, n_total_galfit_time=None,
+                          n_galfit_queuesize=None,
+                          ledger_fn=None, metrics_queue=None, retry_queue=None,
+                          input_slots=None):
+
+    #
+    # Book-keeping on the coordinator for all jobs run by remote agents, the
+    # same way parallel_run_galfit does it for local jobs
+    #
+    ledger = None
+    if (ledger_fn is not None):
+        ledger = galfit_ledger.open_ledger(ledger_fn)
+
+    counters = run_metrics.counter_batch(
+        [n_galfit_queuesize, n_galfit_complete, n_total_galfit_time], metrics_queue)
+
+    while (True):
+        try:
+            item = result_queue.get(timeout=counters['max_age'])
+        except queue.Empty:
+            run_metrics.flush_counters(counters, force=True)
+            continue
+        if (item is None):
+            break
+
+        cmd, result = item
+        if (result['skipped']):
+            if (ledger is not None):
+                galfit_ledger.update_job(ledger, cmd['image'], job_sources(cmd), 'done',
+                                         feedme=cmd['feedme'], galfit_output=cmd['galfit_output'])
+            run_metrics.count(counters, [-1, 1, 0], run_metrics.job_event('skip', cmd, agent=result['agent']))
+            retire_job(cmd, input_slots, ledger)
+            continue
+
+        problem = result['problem']
+        timed_out = (problem is not None and problem.startswith("timeout"))
+        if (timed_out or (problem is not None and problem.startswith("aborted"))):
+            problems_queue.put("%s ::: %s (on %s)\n" % (cmd['feedme'], problem, result['agent']))
+        # the fit results were already extracted by the agent
+        if (results_queue is not None):
+            for record in result['results']:
+                results_queue.put(record)
+        finish_job(cmd, result['returncode'], problem, result['start_time'], result['end_time'],
+                   result['runtime'], result['retry'],
+                   ledger=ledger, counters=counters, retry_queue=retry_queue,
+                   input_slots=input_slots, agent=result['agent'])
+        request_plot(plot_queue, plot_backlog, cmd['galfit_output'])
+
+    run_metrics.flush_counters(counters, force=True)
+
+
+def parallel_run_sersicfit(galfit_queue,
+                           problems_queue,
+                           plot_queue=None, plot_backlog=None, results_queue=None, redo=False,
+                           retry_queue=None, retry_policy=None,
+                           n_galfit_complete=None, n_total_galfit_time=None,
+                           n_galfit_queuesize=None, n_galfeeds=None,
+                           n_galfit_queued=None,
+                           batch_size=16,
+                           galfit_timeout=60,
+                           scratch_dir=None,
+                           ledger_fn=None,
+                           metrics_queue=None,
+                           input_slots=None,
+                           ):
+
+    #
+    # Alternative to parallel_run_galfit: instead of starting one GALFIT
+    # process per source, collect up to batch_size jobs from the queue and
+    # fit all of them in-process with a batched single-Sersic fitter. Output
+    # files use the same format as GALFIT, so all later steps work as before.
+    #
+    logger = logging.getLogger("SersicWorker")
+
+    container_indices = {}
+
+    ledger = None
+    if (ledger_fn is not None):
+        ledger = galfit_ledger.open_ledger(ledger_fn)
+
+    counters = run_metrics.counter_batch(
+        [n_galfit_queuesize, n_galfit_complete, n_total_galfit_time], metrics_queue)
+
+    shutdown = False
+    while (not shutdown):
+
+        # block for the first job, then take whatever else is already waiting
+        try:
+            batch = [galfit_queue.get(timeout=counters['max_age'])]
+        except queue.Empty:
+            run_metrics.flush_counters(counters, force=True)
+            continue
+        while (batch[-1] is not None and len(batch) < batch_size):
+            try:
+                batch.append(galfit_queue.get_nowait())
+            except queue.Empty:
+                break
+        for cmd in batch:
+            galfit_scheduler.job_taken(n_galfit_queued, cmd)
+        if (batch[-1] is None):
+            print("Received shutdown command")
+            run_metrics.flush_counters(counters, force=True)
+            shutdown = True
+            batch = batch[:-1]
+            galfit_queue.task_done()
+
+        jobs = []
+        for cmd in batch:
+            known_unfinished = (cmd['state'] in galfit_ledger.INPUT_READY)
+            if ((not known_unfinished and os.path.isfile(cmd['galfit_output']) and not redo) or dryrun):
+                print("Skipping sersic fit for completed file (%s)" % (cmd['galfit_output']))
+                if (ledger is not None and not dryrun):
+                    galfit_ledger.update_job(ledger, cmd['image'], job_sources(cmd), 'done',
+                                             feedme=cmd['feedme'], galfit_output=cmd['galfit_output'])
+                run_metrics.count(counters, [-1, 1, 0], run_metrics.job_event('skip', cmd))
+                retire_job(cmd, input_slots, ledger)
+                galfit_queue.task_done()
+                continue
+
+            work_dir = unpack_job_inputs(cmd, container_indices, scratch_dir)
+            if (work_dir is None):
+                _cwd, _ = os.path.split(cmd['feedme'])
+            else:
+                _cwd = work_dir
+            if (ledger is not None):
+                galfit_ledger.update_job(ledger, cmd['image'], job_sources(cmd), 'running',
+                                         feedme=cmd['feedme'], galfit_output=cmd['galfit_output'],
+                                         start_time=time.time())
+            jobs.append((cmd, work_dir, _cwd, prepare_feedme(cmd, _cwd)))
+
+        if (not jobs):
+            continue
+
+        start_time = time.time()
+        status = sersic_fit.fit_feedme_files(
+            [(os.path.join(_cwd, _feedfile), _cwd) for (cmd, work_dir, _cwd, _feedfile) in jobs],
+            timeouts=[cmd.get('timeout', galfit_timeout) for (cmd, work_dir, _cwd, _feedfile) in jobs])
+        end_time = time.time()
+
+        for (cmd, work_dir, _cwd, _feedfile), result in zip(jobs, status):
+            problem = result['message'] if result['returncode'] != 0 else None
+            retry = plan_retry(cmd, result['returncode'], problem, _cwd, _feedfile, retry_policy)
+            collect_job_output(cmd, work_dir)
+            if (result['returncode'] != 0):
+                problems_queue.put("%s ::: sersic_fit %s\n" % (cmd['feedme'], problem))
+            with open(cmd['logfile'], "w") as log:
+                log.write("sersic_fit: returncode=%d runtime=%.3f %s\n" % (
+                    result['returncode'], result['runtime'], result['message'] if result['message'] else ""))
+            logger.debug("%s ==> %d" % (cmd['feedme'], result['returncode']))
+
+            finish_job(cmd, result['returncode'], problem, start_time, end_time, result['runtime'], retry,
+                       ledger=ledger, counters=counters, results_queue=results_queue,
+                       retry_queue=retry_queue, input_slots=input_slots, batch_size=len(jobs))
+
+            request_plot(plot_queue, plot_backlog, cmd['galfit_output'])
+
+            galfit_queue.task_done()
+
+    print("Shutting down sersic-fit parallel worker-process")
+
+
 
 if __name__ == "__main__":
 
@@ -616,18 +1869,47 @@ if __name__ == "__main__":
                          help="output subdirectory to hold galfit feed-files and output")
     cmdline.add_argument("--weight", dest="weight_file", type=str, default=None,
                          help="weight file")
+    cmdline.add_argument("--weighttype", dest="weight_type", type=str, default="sigma",
+                         choices=sigma_maps.KINDS,
+                         help="what the weight file holds: sigma/rms (used as is), weight/ivar (inverse variance) or var (variance)")
     cmdline.add_argument("--nprocs", dest="number_processes",
                          default=multiprocessing.cpu_count(), type=int,
                          help="number of Sextractors to run in parallel")
+    cmdline.add_argument("--nwriters", dest="number_writers", default=-1, type=int,
+                         help="number of feed-me writers, each handling a shard of the input images (default: nprocs/4)")
     cmdline.add_argument("--galfit", dest="galfit_exe", type=str, default="galfit",
                          help="location of galfit executable")
 
     cmdline.add_argument("--plot", dest="plot_results", default=False,
                          action='store_true',
                          help="create plots from GALFIT results")
-
+    cmdline.add_argument("--nplotters", dest="number_plotters", default=1, type=int,
+                         help="number of processes making plots alongside the fits")
+    cmdline.add_argument("--plotqueue", dest="plot_queue_size", default=100, type=int,
+                         help="plots waiting for a plotter before the rest is deferred until all fits are done")
+
+    cmdline.add_argument("--sizing", dest="sizing", default="fixed", type=str,
+                         choices=job_sizing.SIZINGS,
+                         help="fixed cutouts and convolution box (3 FWHM, 100x100; default), or sized from the light profile and PSF")
     cmdline.add_argument("--maxsize", dest="max_size", default=-1, type=int,
                          help="maximum cutout size for fitting")
+    cmdline.add_argument("--warmstart", dest="warm_start_fn", default="none", type=str,
+                         help="store converged solutions in this file, and start fits from the solutions found there ('none' to disable)")
+    cmdline.add_argument("--warmradius", dest="warm_start_radius", default=0., type=float,
+                         help="also match earlier solutions by sky position, within this radius [arcsec]")
+    cmdline.add_argument("--guess", dest="initial_guess", default="catalog", type=str,
+                         choices=("catalog", "moments"),
+                         help="start fits from the catalog values (default), or from values measured in the cutout (moments)")
+    cmdline.add_argument("--coarse", dest="coarse_size", default=-1, type=int,
+                         help="fit cutouts larger than this (in pixels) on 2x2 or 4x4 binned data first, then refine at full resolution (-1: disable)")
+    cmdline.add_argument("--group", dest="max_group_size", default=1, type=int,
+                         help="fit up to this many sources with overlapping cutouts together in one GALFIT run (1: fit each source on its own)")
+    cmdline.add_argument("--shards", dest="n_shards", default=0, type=int,
+                         help="spread the per-source files over this many sub-directories of the galfit directory, by source ID (0: all in one directory; a directory keeps the layout it was started with)")
+    cmdline.add_argument("--iothreads", dest="io_threads", default=0, type=int,
+                         help="threads per feed-me writer for writing cutouts and feed-me files, e.g. 4 (default: 0, write from the writer itself)")
+    cmdline.add_argument("--lookahead", dest="lookahead", default=-1, type=int,
+                         help="pipelined mode: prepare cutouts at most this many jobs ahead of the running fits, and remove them once a fit is recorded (-1: prepare all cutouts up front)")
 
     cmdline.add_argument("--psf", dest="psf", default=None, type=str,
                          help="filename of PSF model")
@@ -637,17 +1919,154 @@ if __name__ == "__main__":
     cmdline.add_argument("--timeout", dest="galfit_timeout", default=60, type=float,
                          help="maximum tme allowed for a galfit run")
 
-    cmdline.add_argument("input_images", nargs="+",
+    cmdline.add_argument("--timeoutscale", dest="timeout_scale", default=0, type=float,
+                         help="allow each run this multiple of its predicted runtime, at least --timeout, e.g. 10 (default: 0, the fixed --timeout for all runs)")
+    cmdline.add_argument("--maxtimeout", dest="max_timeout", default=900, type=float,
+                         help="upper limit for the runtime-scaled timeout and for timeouts raised by retries")
+    cmdline.add_argument("--abortstall", dest="abort_stall", default=0, type=int,
+                         help="stop a fit once chi2 has not improved for this many iterations, e.g. 30 (default: 0, disabled)")
+    cmdline.add_argument("--abortre", dest="abort_re_factor", default=0., type=float,
+                         help="stop a fit once R_e stays beyond this multiple of the fitting region, e.g. 2 (default: 0, disabled)")
+    cmdline.add_argument("--retries", dest="max_retries", default=0, type=int,
+                         help="number of retries with escalating strategies for failed fits, e.g. 3 (default: 0, disabled)")
+    cmdline.add_argument("--plan", dest="plan_only", default=False,
+                         action='store_true',
+                         help="only predict the runtime of all outstanding jobs and exit")
+
+    cmdline.add_argument("--container", dest="use_container", default=False,
+                         action='store_true',
+                         help="keep all cutouts of an image in one indexed container file")
+    cmdline.add_argument("--scratch", dest="scratch_dir", default=None, type=str,
+                         help="scratch directory to unpack container files into (default: system temp)")
+
+    cmdline.add_argument("--ledger", dest="ledger_fn", default="none", type=str,
+                         help="SQLite job ledger to track and resume GALFIT runs, e.g. galfit_ledger.db (default: none)")
+
+    cmdline.add_argument("--metrics", dest="metrics_fn", default="none", type=str,
+                         help="JSON-lines file for per-job metrics and progress snapshots, e.g. auto_galfit_metrics.jsonl (default: none)")
+    cmdline.add_argument("--metricsinterval", dest="metrics_interval", default=60, type=float,
+                         help="seconds between progress snapshots in the metrics file")
+
+    cmdline.add_argument("--results", dest="write_results", default=False, action='store_true',
+                         help="write a table of all fit results per image (galfit/<image>.galfit_results.txt) while the fits run (default: off; implied by --combined and --warmstart)")
+    cmdline.add_argument("--combined", dest="combined_extension", default="none", type=str,
+                         help="file extension for the combined source catalog + fit results, e.g. galcomb.vot (default: none)")
+
+    cmdline.add_argument("--backend", dest="backend", default="galfit", type=str,
+                         choices=["galfit", "python"],
+                         help="fit with GALFIT, or with the batched in-process Sersic fitter")
+    cmdline.add_argument("--async", dest="async_orchestrator", default=False,
+                         action='store_true',
+                         help="run all GALFIT processes from a single asyncio event loop instead of one worker process each")
+    cmdline.add_argument("--batchsize", dest="batch_size", default=16, type=int,
+                         help="number of sources fitted together by the python backend")
+
+    cmdline.add_argument("--serve", dest="broker_address", default=None, type=str,
+                         help="also hand out GALFIT jobs to worker agents connecting to this HOST:PORT")
+    cmdline.add_argument("--connect", dest="coordinator_address", default=None, type=str,
+                         help="run as worker agent for the coordinator at HOST:PORT, with --nprocs GALFIT slots")
+    cmdline.add_argument("--brokerkey", dest="broker_key", default=None, type=str,
+                         help="shared key for coordinator and agents, required with --serve and --connect (default: $GALFIT_BROKER_KEY)")
+
+    cmdline.add_argument("input_images", nargs="*",
                          help="list of input images")
     #cmdline.print_help()
     args = cmdline.parse_args()
+    if ((args.broker_address is not None or args.coordinator_address is not None) and
+            args.broker_key is None and not os.environ.get("GALFIT_BROKER_KEY", None)):
+        cmdline.error("--serve and --connect need a shared key (--brokerkey or GALFIT_BROKER_KEY)")
+    if (args.ledger_fn is not None and args.ledger_fn.lower() == "none"):
+        args.ledger_fn = None
+    if (args.metrics_fn is not None and args.metrics_fn.lower() == "none"):
+        args.metrics_fn = None
+    if (args.combined_extension is not None and args.combined_extension.lower() == "none"):
+        args.combined_extension = None
+    if (args.warm_start_fn is not None and args.warm_start_fn.lower() == "none"):
+        args.warm_start_fn = None
 
     print(args)
 
+    # failed fits are retried with these settings
+    retry_policy = None
+    if (args.max_retries > 0):
+        retry_policy = dict(max_retries=args.max_retries,
+                            max_timeout=args.max_timeout * galfit_retry.TIMEOUT_FACTOR,
+                            max_size=args.max_size)
+
+    # fits going nowhere are stopped early by these rules
+    monitor_rules = None
+    if (args.abort_stall > 0 or args.abort_re_factor > 0):
+        monitor_rules = galfit_monitor.default_rules()
+        monitor_rules['max_stall'] = args.abort_stall
+        monitor_rules['re_factor'] = args.abort_re_factor
+
+    if (args.coordinator_address is not None):
+        run_broker_agent(args.coordinator_address, args.number_processes,
+                         galfit_exe=args.galfit_exe, galfit_timeout=args.galfit_timeout,
+                         scratch_dir=args.scratch_dir, authkey=args.broker_key,
+                         retry_policy=retry_policy, monitor_rules=monitor_rules)
+        sys.exit(0)
+    if (not args.input_images):
+        cmdline.error("no input images given")
+
+    #
+    # Calibrate the runtime model from all fits we have done so far
+    #
+    ledger = None
+    if (args.ledger_fn is not None):
+        ledger = galfit_ledger.open_ledger(args.ledger_fn)
+    cost_model = galfit_scheduler.calibrate(ledger)
+    if (cost_model['calibrated']):
+        print("Runtime model calibrated from %d completed fits" % (cost_model['n_jobs']))
+
+    if (args.plan_only):
+        plan_campaign(args.input_images, cost_model, args.number_processes, ledger)
+        sys.exit(0)
+
     # initialize work queues
     src_queue = multiprocessing.JoinableQueue()
     galfit_queue = multiprocessing.JoinableQueue()
 
+    #
+    # The feed-me writers hand their jobs to the dispatcher, which passes them
+    # on to the GALFIT workers, most expensive jobs first
+    #
+    intake_queue = multiprocessing.Queue()
+    queue_depth = args.number_processes
+    if (args.backend == "python" and args.max_group_size > 1):
+        print("The python backend only fits single sources, disabling --group")
+        args.max_group_size = 1
+    if (args.backend == "python"):
+        # keep enough jobs queued for every worker to fill a complete batch
+        queue_depth = args.number_processes * args.batch_size
+    if (args.broker_address is not None):
+        # keep a few jobs ready for the remote agents
+        queue_depth += 8
+
+    #
+    # In pipelined mode, every job holds one of a fixed number of slots from
+    # the moment its cutouts are written until its fit is recorded, so the
+    # writers stay just far enough ahead to keep all workers busy (and the
+    # most-expensive-first ordering only applies to the jobs within reach)
+    #
+    input_slots = None
+    if (args.lookahead >= 0):
+        input_slots = multiprocessing.Semaphore(queue_depth + args.lookahead)
+        print("Pipelined mode: keeping at most %d jobs prepared" % (queue_depth + args.lookahead))
+    # jobs handed to the workers but not yet taken from galfit_queue
+    n_galfit_queued = multiprocessing.Value('i', 0, lock=True)
+    dispatcher_stop = threading.Event()
+    dispatcher = threading.Thread(
+        target=galfit_scheduler.priority_dispatcher,
+        kwargs=dict(intake_queue=intake_queue,
+                    galfit_queue=galfit_queue,
+                    n_queued=n_galfit_queued,
+                    queue_depth=queue_depth,
+                    stop_event=dispatcher_stop),
+    )
+    dispatcher.daemon = True
+    dispatcher.start()
+
     # start some counters for progress info and book-keeping
     n_galfeeds = multiprocessing.Value('i', 0, lock=True)#multiprocessing.Lock())
     n_galfit_queuesize = multiprocessing.Value('i', 0, lock=True)#lock=multiprocessing.Lock())
@@ -658,6 +2077,13 @@ if __name__ == "__main__":
     n_galfit_complete.value = 0
     n_total_galfit_time.value = 0.
 
+    # per-job events from writers and workers, collected by the main process
+    metrics_queue = multiprocessing.Queue()
+    metrics_log = None
+    if (args.metrics_fn is not None):
+        metrics_log = run_metrics.open_metrics_log(args.metrics_fn)
+    run_stats = run_metrics.new_run_stats(numpy.max([1, args.number_processes]))
+
     ##########################################################################
     #
     # Stert up all GALFIT execution workers first so they can go straight to
@@ -665,23 +2091,84 @@ if __name__ == "__main__":
     #
     ##########################################################################
 
+    #
+    # Plots are made by their own low-priority workers; fitting workers never
+    # wait for them, and plots that can not be queued right away are made
+    # after all fits are done
+    #
+    plot_queue = None
+    plot_backlog = None
+    plot_workers = []
+    if (args.plot_results):
+        plot_queue = multiprocessing.JoinableQueue(maxsize=args.plot_queue_size)
+        plot_backlog = multiprocessing.Queue()
+        for i in range(args.number_plotters):
+            p = multiprocessing.Process(
+                target=plot_galfit_results.parallel_plot_worker,
+                kwargs=dict(plot_queue=plot_queue, niceness=10),
+            )
+            p.daemon = True
+            p.start()
+            plot_workers.append(p)
+
+    #
+    # On request, all fit results are collected into one results table per
+    # image while the fits are running; the combined catalogs and the
+    # warm-start store are made from these
+    #
+    results_queue = None
+    results_collector = None
+    if (args.write_results or args.combined_extension is not None or args.warm_start_fn is not None):
+        results_queue = multiprocessing.Queue()
+        results_collector = multiprocessing.Process(
+            target=galfit_results.results_collector,
+            kwargs=dict(results_queue=results_queue,
+                        combined_extension=args.combined_extension,
+                        warm_start_fn=args.warm_start_fn),
+        )
+        results_collector.daemon = True
+        results_collector.start()
+
     print("Starting up the GALFIT workers")
     galfit_workers = []
     galfit_problems_queue = multiprocessing.Queue()
-    for i in range(args.number_processes):
+    worker_kwargs = dict(galfit_queue=galfit_queue,
+                         problems_queue=galfit_problems_queue,
+                         plot_queue=plot_queue,
+                         plot_backlog=plot_backlog,
+                         results_queue=results_queue,
+                         retry_queue=intake_queue,
+                         retry_policy=retry_policy,
+                         redo=False,
+                         n_galfit_complete=n_galfit_complete,
+                         n_total_galfit_time=n_total_galfit_time,
+                         n_galfit_queuesize=n_galfit_queuesize,
+                         n_galfeeds=n_galfeeds,
+                         n_galfit_queued=n_galfit_queued,
+                         scratch_dir=args.scratch_dir,
+                         ledger_fn=args.ledger_fn,
+                         metrics_queue=metrics_queue,
+                         input_slots=input_slots,
+                         )
+    if (args.backend == "python"):
+        worker_target = parallel_run_sersicfit
+        worker_kwargs['batch_size'] = args.batch_size
+        worker_kwargs['galfit_timeout'] = args.galfit_timeout
+    else:
+        worker_target = parallel_run_galfit
+        worker_kwargs['galfit_exe'] = args.galfit_exe
+        worker_kwargs['galfit_timeout'] = args.galfit_timeout
+        worker_kwargs['monitor_rules'] = monitor_rules
+    n_worker_processes = args.number_processes
+    if (args.async_orchestrator and args.backend == "galfit"):
+        # one process supervises all GALFIT runs
+        worker_target = parallel_run_galfit_async
+        worker_kwargs['n_slots'] = args.number_processes
+        n_worker_processes = 1
+    for i in range(n_worker_processes):
         p = multiprocessing.Process(
-            target=parallel_run_galfit,
-            kwargs=dict(galfit_queue=galfit_queue,
-                        problems_queue=galfit_problems_queue,
-                        galfit_exe=args.galfit_exe,
-                        make_plots=args.plot_results,
-                        redo=False,
-                        n_galfit_complete=n_galfit_complete,
-                        n_total_galfit_time=n_total_galfit_time,
-                        n_galfit_queuesize=n_galfit_queuesize,
-                        n_galfeeds=n_galfeeds,
-                        galfit_timeout=args.galfit_timeout,
-                        )
+            target=worker_target,
+            kwargs=worker_kwargs,
         )
         p.daemon = True
         p.start()
@@ -689,43 +2176,75 @@ if __name__ == "__main__":
         # galfit_queue.put((None))
     print("All Galfit workers started")
 
+    #
+    # Remote worker agents get their jobs from the same queue as the local
+    # workers; the results they report are handled in a separate thread
+    #
+    broker = None
+    if (args.broker_address is not None):
+        broker_results = queue.Queue()
+        broker = galfit_broker.start_broker(
+            args.broker_address, galfit_queue, broker_results,
+            authkey=args.broker_key, default_timeout=args.galfit_timeout, n_queued=n_galfit_queued)
+        broker_handler = threading.Thread(
+            target=handle_broker_results,
+            kwargs=dict(result_queue=broker_results,
+                        problems_queue=galfit_problems_queue,
+                        plot_queue=plot_queue,
+                        plot_backlog=plot_backlog,
+                        results_queue=results_queue,
+                        n_galfit_complete=n_galfit_complete,
+                        n_total_galfit_time=n_total_galfit_time,
+                        n_galfit_queuesize=n_galfit_queuesize,
+                        ledger_fn=args.ledger_fn,
+                        metrics_queue=metrics_queue,
+                        retry_queue=intake_queue,
+                        input_slots=input_slots),
+        )
+        broker_handler.daemon = True
+        broker_handler.start()
+
 
 
 
     ##########################################################################
     #
     # First, handle all the jobs to load catalogs and generate the
-    # list of feedme files that need to be written
-    #
-    # TODO: Merge the catalog reader and feedme-writer jobs into one; this
-    #   should also increase speed by not having to open input files repeatedly
-    #   from different processes
+    # list of feedme files that need to be written. Input images are split
+    # into shards, and each feed-me writer owns one shard so no two writers
+    # ever open the same image, weight map or segmentation map.
     #
     ##########################################################################
 
-
-    #
-    # Next, start up the workers to read the input catalogs and generate the
-    # galfit feedme configuration files
-    #
     total_feed_count = multiprocessing.Value('i', 0)
-    input_file_queue = multiprocessing.JoinableQueue()
 
-    for fn in args.input_images:
-        input_file_queue.put(fn)
+    n_writers = args.number_writers
+    if (n_writers <= 0):
+        n_writers = numpy.max([1, args.number_processes // 4])
+    shards = shard_input_images(args.input_images, n_writers, args.catalog_extension)
 
     feedme_workers = []
-    print("Starting up %d parallel Galfit workers" % (args.number_processes))
-    for i in range(1):
+    print("Starting up %d parallel feed-me writers" % (len(shards)))
+    for i, shard in enumerate(shards):
         workername = "FeedmeWriter_%03d" % (i+1)
+
+        # each writer gets its own queue, terminated by its own shutdown token
+        input_file_queue = multiprocessing.JoinableQueue()
+        for fn in shard:
+            input_file_queue.put(fn)
+        input_file_queue.put((None))
+
         p = multiprocessing.Process(
             target=parallel_config_writer,
             kwargs=dict(file_queue=input_file_queue,
-                        galfit_queue=galfit_queue,
+                        galfit_queue=intake_queue,
                         n_galfeeds=n_galfeeds,
                         n_galfit_queuesize=n_galfit_queuesize,
                         total_feed_count=total_feed_count,
                         workername=workername,
+                        cost_model=cost_model,
+                        metrics_queue=metrics_queue,
+                        input_slots=input_slots,
                         ),
         )
         p.daemon = True
@@ -733,70 +2252,45 @@ if __name__ == "__main__":
         feedme_workers.append((p,workername))
     print("Feed-me creation workers started")
 
-
-    print("Adding token to file writer workers")
-    # Also add the worker termination token to the job queue
-
-    # time.sleep(5)
-    for p in feedme_workers:
-        input_file_queue.put((None))
-
-    print("waiting")
-    # time.sleep(10)
-
-    # print("Joining feedme-writer queue")
-    # while (True):
-    #     print("Waiting for all Galfeed files to be written")
-    #     one_still_alive = False
-    #     for (p,wn) in feedme_workers:
-    #         p.join(0.1)
-    #         one_still_alive |= p.is_alive()
-    #         print(wn,"still alive", p.is_alive())
-    #     print("All dead?", all_dead)
-    #     if (not one_still_alive):
-    #         break
-    #     time.sleep(1)
-
-    # wait for all files to be generated and shut down workers
-    input_file_queue.join()
-    for (p,wn) in feedme_workers:
-        p.join()
-
-    print("all done!")
-
-
-
-    print("Done creating all %d GALFIT config files, joining the fun!" % (
-        n_galfit_queuesize.value))
-    # print(n_galfeeds, n_galfit_queuesize)
-    # time.sleep(1)
-
-    # counter = 0
-    # while(True):
-    #     cmd = galfit_queue.get()
-    #     galfit_queue.task_done()
-    #     if (cmd is not None):
-    #         counter += 1
-    #     print(counter, n_galfeeds.value)
-
-
-    # wait for all config files to be written
-    # for i in range(30):
-    #     print n_galfit_queuesize.lock
-    #     time.sleep(10)
-
+    #
+    # Report progress while the feed-me writers and GALFIT workers are busy;
+    # GALFIT is already working on the first sources while the writers are
+    # still handling the remainder of their shards
+    #
     start_time = time.time()
-    while (n_galfit_queuesize.value > 0):
-        try:
-            avg_galfit_time = n_total_galfit_time.value / n_galfit_complete.value
-        except ZeroDivisionError:
-            avg_galfit_time = 10.
+    last_snapshot_time = start_time
+    snapshot_eta = None
+    writers_done = False
+    while (not writers_done or n_galfit_queuesize.value > 0):
+        if (not writers_done):
+            writers_done = not numpy.any([p.is_alive() for (p,wn) in feedme_workers])
+            if (writers_done):
+                print("\nDone creating all %d GALFIT config files" % (n_galfeeds.value))
+                intake_queue.put((None))
+
+        run_metrics.drain_events(metrics_queue, run_stats, metrics_log)
+        if (time.time() - last_snapshot_time > args.metrics_interval):
+            snapshot = run_metrics.snapshot(
+                run_stats, n_galfit_complete.value, n_galfeeds.value, n_galfit_queuesize.value)
+            run_metrics.write_events(metrics_log, [snapshot])
+            snapshot_eta = snapshot['eta']
+            last_snapshot_time = time.time()
+
+        if (snapshot_eta is not None):
+            eta = numpy.max([0., snapshot_eta - (time.time() - last_snapshot_time)])
+        else:
+            # no snapshot yet, extrapolate from the average runtime
+            try:
+                avg_galfit_time = n_total_galfit_time.value / n_galfit_complete.value
+            except ZeroDivisionError:
+                avg_galfit_time = 10.
+            eta = n_galfit_queuesize.value * avg_galfit_time / run_stats['n_procs']
         sys.stdout.write("\rRunning since %d seconds, finished %d (of %d) galfit runs, %d (est. %.1f seconds) left" % (
             int(numpy.round(time.time() - start_time)),
             n_galfit_complete.value,
             n_galfeeds.value,
             n_galfit_queuesize.value,
-            n_galfit_queuesize.value * avg_galfit_time / args.number_processes,
+            eta,
         ))
         sys.stdout.flush()
 
@@ -817,10 +2311,63 @@ if __name__ == "__main__":
             gf_problems.close()
         time.sleep(1)
 
-
+    for (p,wn) in feedme_workers:
+        p.join()
 
     # galfit_queue.join()
     print("\ndone with all work!")
+    dispatcher_stop.set()
+    dispatcher.join()
+
+    # no more jobs for the agents, so none of them can take the shutdown
+    # tokens meant for the local workers
+    if (broker is not None):
+        galfit_broker.stop_broker(broker)
+
+    # let the workers finish; once they are gone, all their results and plot
+    # requests have been handed over to the queues
+    for p in galfit_workers:
+        galfit_queue.put((None))
+    for p in galfit_workers:
+        p.join()
+
+    if (broker is not None):
+        broker_results.put((None))
+        broker_handler.join()
+
+    # write out the combined catalogs
+    if (results_collector is not None):
+        results_queue.put((None))
+        results_collector.join()
+
+    if (plot_queue is not None):
+        n_deferred = 0
+        while (True):
+            try:
+                plot_queue.put(plot_backlog.get(block=True, timeout=1.))
+            except queue.Empty:
+                break
+            n_deferred += 1
+        print("Finishing plots (%d deferred until after the fits)" % (n_deferred))
+        for p in plot_workers:
+            plot_queue.put((None))
+        for p in plot_workers:
+            p.join()
+
+    # collect the last events still on their way and summarize the run
+    run_metrics.drain_events(metrics_queue, run_stats, metrics_log, timeout=1.)
+    snapshot = run_metrics.snapshot(
+        run_stats, n_galfit_complete.value, n_galfeeds.value, n_galfit_queuesize.value)
+    run_metrics.write_events(metrics_log, [snapshot])
+    print(run_metrics.format_snapshot(snapshot))
+    if (metrics_log is not None):
+        metrics_log.close()
+
+    if (ledger is not None):
+        ledger_summary = galfit_ledger.summary(ledger)
+        print("Job ledger (%s): %s" % (args.ledger_fn, ", ".join(
+            ["%d %s" % (ledger_summary[state][0], state) for state in galfit_ledger.STATES
+             if state in ledger_summary])))
 
     # img_fn = sys.argv[1]
     # cat_fn = sys.argv[2]
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+#
+# Benchmark the auto_galfit orchestration (feed-me writers, job queue,
+# dispatcher and workers) separately from GALFIT itself.
+#
+# Generates a set of synthetic images with weight maps, segmentation maps,
+# source catalogs and a PSF, and runs auto_galfit on them with the
+# fake_galfit.py stand-in for a range of --nprocs values. Every run starts
+# from scratch (no ledger, fresh galfit directory), and is evaluated from
+# its metrics file:
+#
+#    writes/s     feed-me files (and cutouts) written per second
+#    queue p50/95 time jobs waited between being written and being started
+#    idle         fraction of the worker slots not running a fit, between
+#                 the start of the first and the end of the last fit
+#    overhead     time per fit spent outside the stand-in's (known) sleep,
+#                 i.e. process startup and I/O
+#    jobs/s       end-to-end throughput, including startup and shutdown
+#
+# For example:
+#
+#    benchmark_auto_galfit.py --nprocs 1,2,4,8 --images 4 --sources 200 --runtime 0.2
+#    benchmark_auto_galfit.py --nprocs 4 --args --async --group 4
+#
+
+import os
+import sys
+import argparse
+import json
+import shutil
+import subprocess
+import tempfile
+import time
+import numpy
+import astropy.io.fits as pyfits
+import astropy.table
+
+import fake_galfit
+import sersic_fit
+
+CATALOG_COLUMNS = ['NUMBER', 'X_IMAGE', 'Y_IMAGE', 'ALPHA_J2000', 'DELTA_J2000', 'FWHM_IMAGE',
+                   'ERRX2WIN_IMAGE', 'ERRY2WIN_IMAGE', 'MAG_AUTO', 'FLUX_RADIUS_50', 'ELONGATION',
+                   'THETA_IMAGE']
+
+
+def make_field(basename, rng, nx=2048, ny=2048, n_sources=100, magzero=30.):
+
+    #
+    # One synthetic image (exponential profiles on top of gaussian noise)
+    # with weight map, segmentation map and source catalog. The profiles come
+    # from sersic_fit's model, i.e. with GALFIT's conventions (1-based pixel
+    # coordinates, position angle from up towards left), and the catalog
+    # holds the values SExtractor would measure for them.
+    #
+    data = rng.normal(0., 1., (ny, nx)).astype(numpy.float32)
+    segm = numpy.zeros((ny, nx), dtype=numpy.int32)
+    rows = []
+    for number in range(1, n_sources + 1):
+        x, y = rng.uniform(30, nx - 30), rng.uniform(30, ny - 30)
+        re = rng.lognormal(numpy.log(3.), 0.5)
+        q = rng.uniform(0.4, 1.)
+        pa = rng.uniform(-90, 90)
+        mag = magzero - 2.5 * rng.uniform(3, 4.5)
+
+        # only evaluate each profile in a box around the source
+        size = int(numpy.min([10 * re, 200]))
+        x1, x2 = int(numpy.max([0, x - size])), int(numpy.min([nx, x + size]))
+        y1, y2 = int(numpy.max([0, y - size])), int(numpy.min([ny, y + size]))
+        yy, xx = numpy.mgrid[y1:y2, x1:x2]
+        params = numpy.array([[x, y, mag, re, 1., q, pa, 0.]])
+        profile = sersic_fit.sersic_model(params, yy + 1., xx + 1., magzero)[0]
+        data[y1:y2, x1:x2] += profile.astype(numpy.float32)
+        # pixels above the noise level, as a detection would find them
+        _segm = segm[y1:y2, x1:x2]
+        _segm[(profile > 1.) & (_segm == 0)] = number
+
+        # what SExtractor measures, from +x towards +y; auto_galfit uses PA = THETA_IMAGE - 90
+        theta = (pa + 90. + 90.) % 180. - 90.
+        rows.append((number, x, y, 150. + x * 5.e-5, 2. + y * 5.e-5, 2.5 * re,
+                     1.e-3, 1.e-3, mag, re, 1. / q, theta))
+
+    header = pyfits.Header()
+    header['FLUXMAG0'] = 10 ** (0.4 * magzero)
+    pyfits.PrimaryHDU(data=data, header=header).writeto("%s.fits" % (basename), overwrite=True)
+    pyfits.PrimaryHDU(data=numpy.ones_like(data)).writeto("%s.weight.fits" % (basename), overwrite=True)
+    pyfits.PrimaryHDU(data=segm).writeto("%s.segments" % (basename), overwrite=True, output_verify='ignore')
+    catalog = astropy.table.Table(rows=rows, names=CATALOG_COLUMNS)
+    catalog.write("%s.udgcat" % (basename), format='fits', overwrite=True)
+
+
+def make_psf(psf_fn, fwhm=3., size=25):
+
+    yy, xx = numpy.mgrid[:size, :size] - (size - 1) / 2.
+    psf = numpy.exp(-0.5 * (xx ** 2 + yy ** 2) / (fwhm / 2.355) ** 2)
+    header = pyfits.Header()
+    header['SUPERSMP'] = 1
+    pyfits.PrimaryHDU(data=(psf / numpy.sum(psf)).astype(numpy.float32), header=header).writeto(
+        psf_fn, overwrite=True)
+
+
+def make_dataset(data_dir, n_images, n_sources, image_size, seed=1):
+
+    os.makedirs(data_dir, exist_ok=True)
+    rng = numpy.random.default_rng(seed)
+    images = []
+    for i in range(n_images):
+        basename = os.path.join(data_dir, "bench%02d" % (i))
+        make_field(basename, rng, image_size, image_size, n_sources)
+        images.append("%s.fits" % (basename))
+    make_psf(os.path.join(data_dir, "psf.fits"))
+    return images
+
+
+def read_metrics(metrics_fn):
+
+    events = []
+    with open(metrics_fn, "r") as mf:
+        for line in mf:
+            events.append(json.loads(line))
+    return events
+
+
+def evaluate(events, n_procs, wall_time, mean_runtime, distribution):
+
+    writes = [e for e in events if e['event'] == 'write']
+    fits = [e for e in events if e['event'] == 'fit']
+    result = dict(n_procs=n_procs, n_writes=len(writes), n_fits=len(fits), wall_time=wall_time,
+                  jobs_per_second=len(fits) / wall_time if wall_time > 0 else 0.)
+
+    if (len(writes) > 1):
+        first = numpy.min([e['time'] - e['write_time'] for e in writes])
+        last = numpy.max([e['time'] for e in writes])
+        result['writes_per_second'] = len(writes) / (last - first) if last > first else None
+        result['write_time_p50'] = float(numpy.percentile([e['write_time'] for e in writes], 50))
+
+    if (len(fits) > 0):
+        runtimes = numpy.array([e['runtime'] for e in fits])
+        end_times = numpy.array([e['time'] for e in fits])
+        start_times = end_times - runtimes
+        span = numpy.max(end_times) - numpy.min(start_times)
+        waits = [e['queue_wait'] for e in fits]
+        result['queue_wait_p50'] = float(numpy.percentile(waits, 50))
+        result['queue_wait_p95'] = float(numpy.percentile(waits, 95))
+        result['idle_fraction'] = float(1. - numpy.sum(runtimes) / (n_procs * span)) if span > 0 else None
+        # we know how long the stand-in slept for each job, everything else is overhead
+        sleeps = [fake_galfit.job_runtime("%s.%05d.galfeed" % (
+            os.path.splitext(os.path.basename(e['image']))[0], e['src_id']), mean_runtime, distribution)[0]
+            for e in fits]
+        result['overhead_per_fit'] = float(numpy.mean(runtimes - numpy.array(sleeps)))
+    return result
+
+
+def run_benchmark(images, n_procs, work_dir, galfit_cmd, mean_runtime, distribution, extra_args=None):
+
+    #
+    # One auto_galfit run from scratch; returns the evaluation of its metrics
+    #
+    data_dir, _ = os.path.split(images[0])
+    shutil.rmtree(os.path.join(data_dir, "galfit"), ignore_errors=True)
+    metrics_fn = os.path.join(work_dir, "metrics.nprocs%d.jsonl" % (n_procs))
+    log_fn = os.path.join(work_dir, "auto_galfit.nprocs%d.log" % (n_procs))
+    if (os.path.isfile(metrics_fn)):
+        os.remove(metrics_fn)
+
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "auto_galfit.py"),
+           "--galfit", galfit_cmd,
+           "--nprocs", "%d" % (n_procs),
+           "--weight", ".fits:.weight.fits",
+           "--psf", os.path.join(data_dir, "psf.fits"),
+           "--ledger", "none",
+           "--combined", "none",
+           "--metrics", metrics_fn,
+           ] + ([] if extra_args is None else extra_args) + images
+
+    start_time = time.time()
+    with open(log_fn, "w") as log:
+        returncode = subprocess.call(cmd, stdout=log, stderr=subprocess.STDOUT)
+    wall_time = time.time() - start_time
+    if (returncode != 0):
+        print("auto_galfit with --nprocs %d exited with return code %d, see %s" % (n_procs, returncode, log_fn))
+
+    result = evaluate(read_metrics(metrics_fn), n_procs, wall_time, mean_runtime, distribution)
+    result['returncode'] = returncode
+    return result
+
+
+def format_result(result):
+
+    def _fmt(key, fmt="%.3f"):
+        value = result.get(key, None)
+        return "%9s" % ("n/a" if value is None else fmt % (value))
+
+    return "%6d %7d %s %s %s %s %s %s %s" % (
+        result['n_procs'], result['n_fits'], _fmt('writes_per_second', "%.1f"),
+        _fmt('queue_wait_p50'), _fmt('queue_wait_p95'), _fmt('idle_fraction'),
+        _fmt('overhead_per_fit'), _fmt('jobs_per_second', "%.2f"), _fmt('wall_time', "%.1f"))
+
+
+if __name__ == "__main__":
+
+    cmdline = argparse.ArgumentParser()
+    cmdline.add_argument("--nprocs", dest="nprocs", default="1,2,4,8", type=str,
+                         help="comma-separated list of --nprocs values to benchmark")
+    cmdline.add_argument("--images", dest="n_images", default=2, type=int,
+                         help="number of synthetic images")
+    cmdline.add_argument("--sources", dest="n_sources", default=100, type=int,
+                         help="number of sources per image")
+    cmdline.add_argument("--size", dest="image_size", default=2048, type=int,
+                         help="size of the synthetic images [pixels]")
+    cmdline.add_argument("--runtime", dest="runtime", default=0.1, type=float,
+                         help="mean runtime of the stand-in fits [seconds]")
+    cmdline.add_argument("--distribution", dest="distribution", default="lognormal", type=str,
+                         choices=("constant", "exponential", "lognormal"),
+                         help="distribution of the stand-in runtimes")
+    cmdline.add_argument("--workdir", dest="work_dir", default=None, type=str,
+                         help="directory for data, logs and metrics (default: temporary, removed afterwards)")
+    cmdline.add_argument("--args", dest="extra_args", default=None, nargs=argparse.REMAINDER,
+                         help="additional options for auto_galfit, everything after --args is passed on "
+                              "(must come last), e.g. --args --async --group 4")
+    cmdline.add_argument("--json", dest="json_fn", default=None, type=str,
+                         help="also write all results to this file")
+    args = cmdline.parse_args()
+
+    work_dir = args.work_dir
+    if (work_dir is None):
+        work_dir = tempfile.mkdtemp(prefix="benchmark_auto_galfit_")
+    os.makedirs(work_dir, exist_ok=True)
+
+    print("Generating %d images with %d sources each in %s" % (args.n_images, args.n_sources, work_dir))
+    images = make_dataset(os.path.join(work_dir, "data"), args.n_images, args.n_sources, args.image_size)
+
+    galfit_cmd = "%s %s --runtime %f --distribution %s" % (
+        sys.executable, os.path.abspath(fake_galfit.__file__), args.runtime, args.distribution)
+
+    print("%6s %7s %9s %9s %9s %9s %9s %9s %9s" % (
+        "nprocs", "fits", "writes/s", "queue50", "queue95", "idle", "overhead", "jobs/s", "wall"))
+    results = []
+    for n_procs in [int(n) for n in args.nprocs.split(",")]:
+        result = run_benchmark(images, n_procs, work_dir, galfit_cmd, args.runtime, args.distribution,
+                               args.extra_args)
+        print(format_result(result))
+        results.append(result)
+
+    if (args.json_fn is not None):
+        with open(args.json_fn, "w") as jf:
+            json.dump(dict(settings=vars(args), results=results), jf, indent=2)
+
+    if (args.work_dir is None):
+        shutil.rmtree(work_dir, ignore_errors=True)
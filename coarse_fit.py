@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+#
+# Coarse-to-fine fitting of large sources.
+#
+# GALFIT's runtime grows with the number of pixels, so the large cutouts of
+# extended, low-surface-brightness sources dominate the total runtime (and
+# the timeouts). For these, a block-summed copy of the cutout is fitted
+# first (binned 2x2 or 4x4, with the PSF binned the same way), and the
+# coarse solution is then used as starting point for a short fit at full
+# resolution.
+#
+# Block sums rather than block averages keep the total flux, so magnitudes
+# and the zeropoint carry over unchanged between both stages; sizes and
+# positions scale with the binning factor, and the sky with its square.
+#
+
+import sys
+import numpy
+import astropy.io.fits as pyfits
+
+import galfit_results
+
+# largest binning factor to use
+MAX_FACTOR = 4
+
+# the seeded fit at full resolution starts close to the solution, so it only
+# gets this fraction of the job's timeout (but at least MIN_REFINE_TIMEOUT
+# seconds); without a coarse solution, the full fit keeps the whole timeout
+REFINE_TIMEOUT_FRACTION = 0.5
+MIN_REFINE_TIMEOUT = 30.
+
+
+def binning_factor(size, coarse_size):
+
+    #
+    # Smallest binning factor that brings a cutout of the given size (in
+    # pixels along its longer side) down to coarse_size, up to MAX_FACTOR;
+    # 1 if the cutout is not large enough to bother
+    #
+    if (coarse_size <= 0 or size <= coarse_size):
+        return 1
+    factor = 2
+    while (factor < MAX_FACTOR and size > factor * coarse_size):
+        factor *= 2
+    return factor
+
+
+def block_sum(data, factor):
+
+    # incomplete blocks at the upper edges are dropped
+    ny, nx = (data.shape[0] // factor) * factor, (data.shape[1] // factor) * factor
+    return data[:ny, :nx].reshape(ny // factor, factor, nx // factor, factor).sum(axis=(1, 3))
+
+
+def block_sigma(sigma, factor):
+
+    # uncertainties add in quadrature
+    return numpy.sqrt(block_sum(numpy.asarray(sigma, dtype=numpy.float64) ** 2, factor))
+
+
+def block_mask(segm, factor):
+
+    # a coarse pixel is masked as soon as any of its pixels is masked
+    ny, nx = (segm.shape[0] // factor) * factor, (segm.shape[1] // factor) * factor
+    return segm[:ny, :nx].reshape(ny // factor, factor, nx // factor, factor).max(axis=(1, 3))
+
+
+def coarse_psf(psf, factor):
+
+    #
+    # Bin the PSF by the same factor as the data, so it keeps its sampling
+    # relative to the (now coarser) pixels. The PSF is padded so its central
+    # pixel ends up in the middle of the central block; for even factors
+    # that leaves an offset of half a (fine) pixel, which the fit at full
+    # resolution takes care of.
+    #
+    pad = []
+    for n in psf.shape:
+        before = (factor // 2 - (n - 1) // 2) % factor
+        after = (-(n + before)) % factor
+        pad.append((before, after))
+    binned = block_sum(numpy.pad(numpy.asarray(psf, dtype=numpy.float64), pad, mode='constant'), factor)
+    return binned / numpy.sum(binned)
+
+
+def to_coarse(position, factor):
+    # GALFIT pixel coordinates start at 1 in the center of the first pixel
+    return (position + 0.5 * (factor - 1)) / factor
+
+
+def to_fine(position, factor):
+    return position * factor - 0.5 * (factor - 1)
+
+
+def _set_values(line, key, values, formats):
+
+    # replace the leading values of a feed-me parameter line, keeping fit flags and comments
+    value, hash_, comment = line.split(")", 1)[1].partition("#")
+    items = value.split()
+    items[:len(values)] = [f % v for f, v in zip(formats, values)]
+    return "%s) %s  %s%s" % (key, "  ".join(items), hash_, comment)
+
+
+def coarse_feedme(feedme, factor, files):
+
+    #
+    # Turn a feed-me file into the one for the coarse fit; files holds the
+    # new values for the header options (A, B, C, D, F, G) to change
+    #
+    lines = feedme.splitlines()
+    component = None
+    for i, line in enumerate(lines):
+        items = line.split("#")[0].split()
+        if (len(items) < 2 or not items[0].endswith(")")):
+            continue
+        key = items[0][:-1]
+        if (key in files):
+            lines[i] = "%s) %s   # %s" % (key, files[key], line.partition("#")[2].strip(" #"))
+        elif (key == "H"):
+            x1, x2, y1, y2 = [int(v) for v in items[1:5]]
+            lines[i] = _set_values(line, key, [x1 // factor, x2 // factor, y1 // factor, y2 // factor],
+                                   ["%d"] * 4)
+        elif (key == "I"):
+            lines[i] = _set_values(line, key, [int(numpy.ceil(int(v) / float(factor))) for v in items[1:3]],
+                                   ["%d"] * 2)
+        elif (key == "K"):
+            lines[i] = _set_values(line, key, [float(items[1]) * factor, float(items[2]) * factor],
+                                   ["%.3f"] * 2)
+        elif (key == "0"):
+            component = items[1]
+        elif (component == "sersic" and key == "1"):
+            lines[i] = _set_values(line, key, [to_coarse(float(items[1]), factor),
+                                               to_coarse(float(items[2]), factor)], ["%.2f"] * 2)
+        elif (component == "sersic" and key == "4"):
+            lines[i] = _set_values(line, key, [float(items[1]) / factor], ["%.3f"])
+        elif (component == "sky" and key == "1"):
+            lines[i] = _set_values(line, key, [float(items[1]) * factor ** 2], ["%.4f"])
+    return "\n".join(lines) + "\n"
+
+
+def coarse_constraints(constraints, factor):
+
+    # position (and size) ranges shrink with the pixel size
+    lines = constraints.splitlines()
+    for i, line in enumerate(lines):
+        items = line.split("#")[0].split()
+        if (len(items) == 4 and items[1] in ("x", "y", "re")):
+            lines[i] = "%s   %s   %.2f %.2f" % (
+                items[0], items[1], float(items[2]) / factor, float(items[3]) / factor)
+    return "\n".join(lines) + "\n"
+
+
+def read_solution(coarse_output_fn):
+
+    #
+    # Returns the best-fit parameters of all components of the coarse fit,
+    # skipping parameters GALFIT flagged as problematic
+    #
+    try:
+        header = pyfits.getheader(coarse_output_fn, 2)
+    except (IOError, OSError, IndexError, KeyError):
+        return None
+
+    solution = []
+    component = 1
+    while ("COMP_%d" % (component) in header):
+        params = {}
+        for p in galfit_results.COMPONENT_PARAMETERS.get(header["COMP_%d" % (component)].strip().lower(), []):
+            value, _, flag = galfit_results.parse_galfit_value(str(header.get("%d_%s" % (component, p), "")))
+            if (flag in (galfit_results.FLAG_OK, galfit_results.FLAG_FIXED)):
+                params[p] = value
+        solution.append(params)
+        component += 1
+    return solution
+
+
+def seed_feedme(feedme, coarse_output_fn, factor):
+
+    #
+    # Use the coarse solution as starting values for the fit at full
+    # resolution; returns None if there is no usable coarse solution
+    #
+    solution = read_solution(coarse_output_fn)
+    if (not solution):
+        return None
+
+    scaled = []
+    for params in solution:
+        fine = dict(params)
+        for p in ('XC', 'YC'):
+            if (p in fine):
+                fine[p] = to_fine(fine[p], factor)
+        if ('RE' in fine):
+            fine['RE'] = fine['RE'] * factor
+        if ('SKY' in fine):
+            fine['SKY'] = fine['SKY'] / factor ** 2
+        scaled.append(fine)
+
+    lines = feedme.splitlines()
+    n_component = 0
+    component = None
+    for i, line in enumerate(lines):
+        items = line.split("#")[0].split()
+        if (len(items) < 2 or not items[0].endswith(")")):
+            continue
+        key = items[0][:-1]
+        if (key == "0"):
+            component = items[1]
+            n_component += 1
+            continue
+        if (n_component == 0 or n_component > len(scaled)):
+            continue
+        params = scaled[n_component - 1]
+        if (component == "sersic"):
+            if (key == "1" and 'XC' in params and 'YC' in params):
+                lines[i] = _set_values(line, key, [params['XC'], params['YC']], ["%.2f"] * 2)
+            elif (key in ("3", "4", "5", "9", "10")):
+                p = {"3": 'MAG', "4": 'RE', "5": 'N', "9": 'AR', "10": 'PA'}[key]
+                if (p in params):
+                    lines[i] = _set_values(line, key, [params[p]], ["%.4f"])
+        elif (component == "sky" and key == "1" and 'SKY' in params):
+            lines[i] = _set_values(line, key, [params['SKY']], ["%.6g"])
+    return "\n".join(lines) + "\n"
+
+
+def refine_timeout(timeout):
+    return min(timeout, max(MIN_REFINE_TIMEOUT, REFINE_TIMEOUT_FRACTION * timeout))
+
+
+def seeded_feedme_filename(feedfile):
+    return "%s.seeded" % (feedfile)
+
+
+if __name__ == "__main__":
+
+    # show the full-resolution feed-me seeded from a coarse fit:
+    # coarse_fit.py file.galfeed file.coarse.galfit.fits factor
+    with open(sys.argv[1], "r") as ff:
+        seeded = seed_feedme(ff.read(), sys.argv[2], int(sys.argv[3]))
+    if (seeded is None):
+        print("No usable coarse solution in %s" % (sys.argv[2]))
+    else:
+        print(seeded)
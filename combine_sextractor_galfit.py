@@ -12,10 +12,13 @@ logsetup.setup_log()
 
 import astropy.table
 
+import galfit_layout
+import source_groups
+
 
 def read_results(hdr, component, parameter, keyname=None, x1=0, y1=0):
 
-    value, uncert, flag = numpy.NaN, numpy.NaN, 99
+    value, uncert, flag = numpy.nan, numpy.nan, 99
 
     if (keyname is None):
         keyname = "%d_%s" % (component, parameter)
@@ -41,7 +44,7 @@ def read_results(hdr, component, parameter, keyname=None, x1=0, y1=0):
                 uncert = float(_split[1])
         elif (result.startswith("[")):
             value = float(result.split("[")[1].split("]")[0])
-            uncert = numpy.NaN
+            uncert = numpy.nan
             flag = 1
         else:
             print("Unable to understand Galfit result: %s" % (result))
@@ -49,7 +52,7 @@ def read_results(hdr, component, parameter, keyname=None, x1=0, y1=0):
         try:
             value = float(result)
         except:
-            value = numpy.NaN
+            value = numpy.nan
 
     if (parameter == "XC"):
         value += x1 #hdr['SRC_X1']
@@ -59,6 +62,27 @@ def read_results(hdr, component, parameter, keyname=None, x1=0, y1=0):
     return [value, uncert, flag]
 
 
+def member_components(header, member):
+
+    #
+    # GALFIT component numbers for one member of a group fit, in the order
+    # of the model components: the member's own sersic component takes the
+    # place of the first one, those of all other members are skipped
+    #
+    components = []
+    component = 1
+    n_sersic = 0
+    while ("COMP_%d" % (component) in header):
+        if (header["COMP_%d" % (component)].strip().lower() == "sersic"):
+            n_sersic += 1
+            if (n_sersic != member + 1):
+                component += 1
+                continue
+        components.append(component)
+        component += 1
+    return components
+
+
 def prepare_for_galfit(catalog, components):
 
     cols2add = []
@@ -96,7 +120,7 @@ def prepare_for_galfit(catalog, components):
     n_entries = catalog.as_array().shape[0]
     print(n_entries)
     print("Catalog has %d entries" % (n_entries))
-    dummy_col = numpy.full((n_entries), fill_value=numpy.NaN, dtype=numpy.float32)
+    dummy_col = numpy.full((n_entries), fill_value=numpy.nan, dtype=numpy.float32)
 
     # print(dummy_col)
     for column_name in cols2add:
@@ -160,14 +184,17 @@ def parallel_combine(catalog_queue, galfit_directory='galfit', components=None):
             galfit_dir = os.path.join(_dir, galfit_directory)
 
         # print(galfit_dir)
+        n_shards = galfit_layout.load_layout(galfit_dir)
+        # sources fit in a group are found in the output of the group's job
+        group_of = source_groups.read_groups(source_groups.groups_filename(galfit_dir, basename))
 
         # galfit_data = [None] * catalog.shape[0]
         for i_src, src in enumerate(catalog):
 
             src_id = int(src['NUMBER'])
+            job_id, member = group_of.get(src_id, (src_id, None))
 
-            galfit_fn = "%s.%05d.galfit.fits" % (basename, src_id)
-            galfit_fullfn = os.path.join(galfit_dir, galfit_fn)
+            galfit_fullfn = galfit_layout.source_filename(galfit_dir, basename, job_id, "galfit.fits", n_shards)
             print(galfit_fullfn)
 
             if (not os.path.isfile(galfit_fullfn)):
@@ -188,8 +215,16 @@ def parallel_combine(catalog_queue, galfit_directory='galfit', components=None):
                     # Now read all Galfit results from file header and insert
                     # into the catalog
                     header = hdulist[2].header
+                    if (member is not None):
+                        group_components = member_components(header, member)
                     for (header_key, catalog_key) in keylist:
 
+                        if (member is not None and header_key[0].isdigit()):
+                            component, parameter = header_key.split("_", 1)
+                            if (int(component) > len(group_components)):
+                                continue
+                            header_key = "%d_%s" % (group_components[int(component) - 1], parameter)
+
                         if (len(catalog_key) == 1):
                             # there is only a fixed value
                             # print(catalog_key, header_key)
@@ -197,7 +232,7 @@ def parallel_combine(catalog_queue, galfit_directory='galfit', components=None):
                         else:
                             # there are two values (value and uncertainty)
                             value_key, error_key = catalog_key
-                            error = numpy.NaN
+                            error = numpy.nan
 
                             fits_value = header[header_key]
 
@@ -286,7 +321,7 @@ def parallel_combine(catalog_queue, galfit_directory='galfit', components=None):
         #     galfit_results = numpy.empty((catalog.shape[0], numpy.max(param_count)))
         #     # print(galfit_results.shape)
         #     for i, fr in enumerate(galfit_data):
-        #         galfit_results[i,:] = numpy.NaN if fr is None else galfit_data[i]
+        #         galfit_results[i,:] = numpy.nan if fr is None else galfit_data[i]
         #
         #     # Now merge the two arrays - starting with the numbers we got from
         #     # source extractor, followed by the ones from galfit
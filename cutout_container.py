@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+#
+# Container files to hold all per-source GALFIT input files (cutouts,
+# constraints and feed-me files) for one input image in a single
+# uncompressed tar archive, next to a plain-text offset index keyed by the
+# source NUMBER. Individual members can then be unpacked with a single seek
+# and read, without having to scan the archive.
+#
+# Index format, one line per member:
+#    NUMBER  member-name  data-offset  size
+# Members shared by all sources in the image (e.g. the PSF) use NUMBER -1.
+#
+
+import os
+import sys
+import io
+import tarfile
+import time
+
+SHARED = -1
+
+
+def container_filenames(galfit_dir, basename):
+    container_fn = os.path.join(galfit_dir, "%s.cutouts.tar" % (basename))
+    index_fn = os.path.join(galfit_dir, "%s.cutouts.idx" % (basename))
+    return container_fn, index_fn
+
+
+def index_filename(container_fn):
+    bn, _ = os.path.splitext(container_fn)
+    return "%s.idx" % (bn)
+
+
+def read_index(index_fn, index=None, start=0):
+
+    #
+    # Read all index entries starting at byte position start; this allows
+    # readers to pick up entries appended by a writer that is still busy
+    # with the same image without re-reading the full index.
+    #
+    if (index is None):
+        index = {}
+    if (not os.path.isfile(index_fn)):
+        return index, start
+
+    with open(index_fn, "r") as idx:
+        idx.seek(start)
+        while (True):
+            line = idx.readline()
+            if (not line.endswith("\n")):
+                # incomplete line, still being written
+                break
+            start = idx.tell()
+            items = line.split()
+            if (len(items) != 4):
+                continue
+            src_id = int(items[0])
+            if (src_id not in index):
+                index[src_id] = {}
+            index[src_id][items[1]] = (int(items[2]), int(items[3]))
+
+    return index, start
+
+
+def open_container(galfit_dir, basename):
+
+    container_fn, index_fn = container_filenames(galfit_dir, basename)
+    index, _ = read_index(index_fn)
+
+    tar = None
+    if (os.path.isfile(container_fn) and index):
+        try:
+            tar = tarfile.open(container_fn, mode="a", format=tarfile.GNU_FORMAT)
+        except tarfile.ReadError:
+            print("Container %s is damaged, starting over" % (container_fn))
+            tar = None
+
+    if (tar is None):
+        index = {}
+        if (os.path.isfile(index_fn)):
+            os.remove(index_fn)
+        tar = tarfile.open(container_fn, mode="w", format=tarfile.GNU_FORMAT)
+
+    return dict(
+        filename=container_fn,
+        index_filename=index_fn,
+        tar=tar,
+        index=index,
+        index_file=open(index_fn, "a"),
+    )
+
+
+def has_member(container, src_id, name):
+    return (src_id in container['index'] and name in container['index'][src_id])
+
+
+def add_member(container, src_id, name, payload):
+
+    info = tarfile.TarInfo(name=name)
+    info.size = len(payload)
+    info.mtime = time.time()
+    tar = container['tar']
+    tar.addfile(info, io.BytesIO(payload))
+
+    # the data of this member ends (padded to full blocks) where the tar ends
+    n_blocks = (info.size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE
+    offset_data = tar.offset - n_blocks * tarfile.BLOCKSIZE
+
+    # make sure the data is on disk before anybody can find it in the index
+    tar.fileobj.flush()
+    container['index_file'].write("%d %s %d %d\n" % (src_id, name, offset_data, info.size))
+    container['index_file'].flush()
+
+    if (src_id not in container['index']):
+        container['index'][src_id] = {}
+    container['index'][src_id][name] = (offset_data, info.size)
+
+
+def close_container(container):
+    container['tar'].close()
+    container['index_file'].close()
+
+
+def fits_bytes(hdu):
+    buf = io.BytesIO()
+    hdu.writeto(buf)
+    return buf.getvalue()
+
+
+def unpack(container_fn, index, src_id, target_dir):
+
+    #
+    # Write all members belonging to src_id, plus all shared members, into
+    # target_dir; returns the list of files written
+    #
+    members = dict(index.get(SHARED, {}))
+    members.update(index.get(src_id, {}))
+
+    unpacked = []
+    with open(container_fn, "rb") as container:
+        for name in members:
+            offset, size = members[name]
+            container.seek(offset)
+            out_fn = os.path.join(target_dir, name)
+            with open(out_fn, "wb") as out:
+                out.write(container.read(size))
+            unpacked.append(out_fn)
+
+    return unpacked
+
+
+if __name__ == "__main__":
+
+    # unpack the files for one source: cutout_container.py container.tar NUMBER [outdir]
+    container_fn = sys.argv[1]
+    src_id = int(sys.argv[2])
+    target_dir = sys.argv[3] if len(sys.argv) > 3 else "."
+
+    index, _ = read_index(index_filename(container_fn))
+    for fn in unpack(container_fn, index, src_id, target_dir):
+        print(fn)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+import sys
+import numpy
+import astropy.io.fits as pyfits
+
+
+def open_frame(fn):
+
+    #
+    # Open a (potentially very large) frame for cutout extraction. The file is
+    # memory-mapped and no pixel data is read at this point; all pixel access
+    # should go through read_cutout() so only the rows covered by a cutout
+    # are ever paged in.
+    #
+    return pyfits.open(fn, memmap=True, lazy_load_hdus=True)
+
+
+def read_cutout(hdulist, x1, x2, y1, y2, ext=0):
+
+    #
+    # Using .section rather than .data[] avoids loading the full frame, even
+    # for images that need BSCALE/BZERO scaling or are tile-compressed
+    #
+    hdu = hdulist[ext]
+    try:
+        cutout = hdu.section[y1:y2, x1:x2]
+    except (AttributeError, TypeError, ValueError):
+        # fall back to the memory-mapped data array
+        cutout = hdu.data[y1:y2, x1:x2]
+    return numpy.array(cutout)
+
+
+def sort_by_row(catalog, y_column='Y_IMAGE'):
+
+    #
+    # FITS images are stored row by row, so working through the catalog in
+    # order of increasing y keeps consecutive cutouts on neighbouring pages
+    #
+    order = numpy.argsort(numpy.asarray(catalog[y_column]), kind='stable')
+    return catalog[order]
+
+
+if __name__ == "__main__":
+
+    # extract a single cutout: cutouts.py image.fits x1 x2 y1 y2 output.fits
+    fn = sys.argv[1]
+    x1, x2, y1, y2 = [int(v) for v in sys.argv[2:6]]
+    out_fn = sys.argv[6]
+
+    hdulist = open_frame(fn)
+    data = read_cutout(hdulist, x1, x2, y1, y2)
+    phdu = pyfits.PrimaryHDU(data=data)
+    phdu.header['SRC_X1'] = x1
+    phdu.header['SRC_Y1'] = y1
+    phdu.writeto(out_fn, overwrite=True)
+    hdulist.close()
+    print("cutout written to %s" % (out_fn))
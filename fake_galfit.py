@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+#
+# Stand-in for the GALFIT executable, for benchmarking the auto_galfit
+# orchestration without running real fits.
+#
+# It reads a feed-me file, waits for a runtime drawn from a configurable
+# distribution (instead of fitting), and writes an output block laid out
+# like GALFIT's: the input image, a model extension with the fit results in
+# its header (the starting values, with made-up uncertainties), and the
+# residuals. Use it as
+#
+#    auto_galfit.py --galfit "fake_galfit.py --runtime 0.5 --distribution lognormal" ...
+#
+# Runtimes are drawn from a random generator seeded with the name of the
+# feed-me file, so repeated benchmarks wait for the same times.
+#
+# The stand-in is started once per fit, so it reads and writes its FITS
+# files by hand instead of importing astropy, which takes longer to import
+# than many of the fake fits take.
+#
+
+import os
+import sys
+import argparse
+import time
+import zlib
+import numpy
+
+BLOCK = 2880
+
+
+def read_feedme(feedme_fn):
+
+    # header options by letter, and the components with the values of their parameters
+    options = {}
+    components = []
+    with open(feedme_fn, "r") as ff:
+        for line in ff:
+            line = line.split("#")[0].strip()
+            if (line.find(")") <= 0):
+                continue
+            key, value = [v.strip() for v in line.split(")", 1)]
+            if (key.isalpha()):
+                if (not components):
+                    options[key] = value
+            elif (key == "0"):
+                components.append(dict(type=value.split()[0]))
+            elif (components):
+                components[-1][key] = value.split()
+    return options, components
+
+
+def draw_runtime(rng, mean, distribution):
+
+    if (mean <= 0):
+        return 0.
+    if (distribution == "exponential"):
+        return rng.exponential(mean)
+    if (distribution == "lognormal"):
+        # long tail, sigma of 1 in log-space; scaled to the requested mean
+        return rng.lognormal(numpy.log(mean) - 0.5, 1.)
+    return mean
+
+
+def job_runtime(feedme_fn, mean, distribution, fail_rate=0.):
+
+    # the runtime of the fake fit of a feed-me file, and whether it crashes
+    rng = numpy.random.default_rng(zlib.crc32(os.path.basename(feedme_fn).encode()))
+    return draw_runtime(rng, mean, distribution), rng.uniform() < fail_rate
+
+
+def result_cards(components, center):
+
+    #
+    # Fit results as GALFIT reports them: 'value +/- error', with fixed
+    # parameters as '[value]'; the sky is reported at the center of the
+    # fitting region
+    #
+    cards = []
+    for i, component in enumerate(components, 1):
+        cards.append(("COMP_%d" % (i), component['type']))
+        if (component['type'] == "sky"):
+            cards.extend([("%d_XC" % (i), "[%.4f]" % (center[0])), ("%d_YC" % (i), "[%.4f]" % (center[1]))])
+        if (component['type'] == "sersic"):
+            params = [('XC', '1', 0), ('YC', '1', 1), ('MAG', '3', 0), ('RE', '4', 0),
+                      ('N', '5', 0), ('AR', '9', 0), ('PA', '10', 0)]
+        elif (component['type'] == "sky"):
+            params = [('SKY', '1', 0), ('DSDX', '2', 0), ('DSDY', '3', 0)]
+        else:
+            continue
+        for name, key, index in params:
+            items = component.get(key, ["0", "0"])
+            value = float(items[index])
+            flag_index = index + (2 if key == "1" and component['type'] != "sky" else 1)
+            free = len(items) > flag_index and items[flag_index] != "0"
+            if (free):
+                cards.append(("%d_%s" % (i, name), "%.4f +/- %.4f" % (value, 0.01 * abs(value) + 0.001)))
+            else:
+                cards.append(("%d_%s" % (i, name), "[%.4f]" % (value)))
+    return cards
+
+
+def read_image(fn):
+
+    # header cards (as key/value strings) and the raw data of the primary HDU
+    cards = []
+    with open(fn, "rb") as f:
+        while (True):
+            block = f.read(BLOCK).decode("ascii")
+            if (len(block) < BLOCK):
+                raise IOError("Truncated FITS header in %s" % (fn))
+            for i in range(0, BLOCK, 80):
+                card = block[i:i+80]
+                if (card.startswith("END ")):
+                    header = dict(cards)
+                    n_bytes = abs(int(header['BITPIX'])) // 8 * int(header['NAXIS1']) * int(header['NAXIS2'])
+                    return cards, f.read(n_bytes)
+                if (card[8:10] == "= "):
+                    cards.append((card[:8].strip(), card[10:].split(" /")[0].strip()))
+
+
+def format_hdu(cards, data=b"", primary=False):
+
+    # cards are (key, value) with values already formatted as in the FITS file
+    header = "".join([(("%-8s= %20s" % (key, value))[:80]).ljust(80) for key, value in cards])
+    header += "END".ljust(80)
+    header += " " * ((BLOCK - len(header) % BLOCK) % BLOCK)
+    return header.encode("ascii") + data + b"\0" * ((BLOCK - len(data) % BLOCK) % BLOCK)
+
+
+def image_cards(bitpix, nx, ny, extra=[]):
+    return [('XTENSION', "'IMAGE   '"), ('BITPIX', bitpix), ('NAXIS', 2), ('NAXIS1', nx), ('NAXIS2', ny),
+            ('PCOUNT', 0), ('GCOUNT', 1)] + extra
+
+
+def write_output(output_fn, image_cards_in, data, components, center):
+
+    header = dict(image_cards_in)
+    bitpix, nx, ny = int(header['BITPIX']), int(header['NAXIS1']), int(header['NAXIS2'])
+    # keep everything but the structural keywords of the input image
+    structural = ('SIMPLE', 'BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2', 'EXTEND', 'PCOUNT', 'GCOUNT', 'XTENSION')
+    input_cards = [(key, value) for key, value in image_cards_in if key not in structural]
+
+    cards = result_cards(components, center)
+    n_free = len([value for key, value in cards if value.find("+/-") > 0])
+    model_cards = [('OBJECT', "'model'"), ('BACKEND', "'fake_galfit'")] + \
+                  [(key, "'%s'" % (value)) for key, value in cards] + \
+                  [('CHISQ', float(nx * ny)), ('NDOF', nx * ny - n_free), ('NFREE', n_free),
+                   ('NFIX', len([value for key, value in cards if value.startswith("[")])), ('CHI2NU', 1.0)]
+
+    with open(output_fn, "wb") as f:
+        f.write(format_hdu([('SIMPLE', 'T'), ('BITPIX', 8), ('NAXIS', 0), ('EXTEND', 'T')]))
+        f.write(format_hdu(image_cards(bitpix, nx, ny, input_cards), data))
+        f.write(format_hdu(image_cards(bitpix, nx, ny, model_cards), b"\0" * len(data)))
+        f.write(format_hdu(image_cards(bitpix, nx, ny), data))
+
+
+if __name__ == "__main__":
+
+    cmdline = argparse.ArgumentParser()
+    cmdline.add_argument("--runtime", dest="runtime", default=0.1, type=float,
+                         help="mean runtime of each fake fit [seconds]")
+    cmdline.add_argument("--distribution", dest="distribution", default="constant", type=str,
+                         choices=("constant", "exponential", "lognormal"),
+                         help="distribution of the runtimes")
+    cmdline.add_argument("--failrate", dest="fail_rate", default=0., type=float,
+                         help="fraction of fits that crash without output")
+    cmdline.add_argument("feedme", help="GALFIT feed-me file")
+    args = cmdline.parse_args()
+
+    runtime, crash = job_runtime(args.feedme, args.runtime, args.distribution, args.fail_rate)
+
+    start_time = time.time()
+    options, components = read_feedme(args.feedme)
+    image_cards_in, data = read_image(options['A'].split()[0])
+
+    time.sleep(numpy.max([0., runtime - (time.time() - start_time)]))
+    print("Iteration : 1     Chi2nu: 1.000e+00     dChi2/Chi2: 0.00e+00    alamda: 1e-03")
+    print("fake_galfit: %.3f seconds" % (runtime))
+    if (crash):
+        print("fake_galfit: crashing as requested")
+        sys.exit(1)
+
+    x1, x2, y1, y2 = [float(v) for v in options['H'].split()[:4]]
+    write_output(options['B'].split()[0], image_cards_in, data, components, (0.5 * (x1 + x2), 0.5 * (y1 + y2)))
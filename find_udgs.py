@@ -6,6 +6,8 @@ import numpy
 import pyfits
 import scipy.ndimage.filters
 
+import segmentation_index
+
 sexcolumns = {
     'ra': 0,
     'dec': 1,
@@ -46,27 +48,24 @@ if __name__ == "__main__":
     fwhm = catalog[:, sexcolumns['fwhm']]
     bad = fwhm < 6
     bad_sources = catalog[:,sexcolumns['id']][bad].astype(numpy.int)
-    bad_catalog = catalog[bad]
 
     print(bad_sources)
 
     reuse = False
-    boxsize=100
     if (not reuse):
-        # find all bad pixels
+        # find all bad pixels, each within the bounding box of its source
+        index = segmentation_index.build_index(segmentation_hdu)
         bad_pixels = numpy.zeros(segmenation.shape, dtype=numpy.bool)
         print(bad_pixels[:2,:3])
         for i, bad_source_id in enumerate(bad_sources):
 
-            x = int(bad_catalog[i, sexcolumns['x']])
-            y = int(bad_catalog[i, sexcolumns['y']])
-            x1 = int(numpy.max([0, x-boxsize]))
-            x2 = int(numpy.min([x+boxsize, img.shape[1]]))
-            y1 = int(numpy.max([0, y-boxsize]))
-            y2 = int(numpy.min([y+boxsize, img.shape[0]]))
+            box, bad_pixels_in_this_source = segmentation_index.object_pixels(
+                index, segmentation_hdu, bad_source_id)
+            if (box is None):
+                continue
+            x1, x2, y1, y2 = box
 
             print("\rWorking on source %d of %d" % (i+1, bad_sources.shape[0]), end='', flush=True)
-            bad_pixels_in_this_source = (segmenation[y1:y2, x1:x2] == bad_source_id)
             # pyfits.PrimaryHDU(data=bad_pixels_in_this_source.astype(numpy.int)).writeto("bad_mask_%d.fits" % (bad_source_id), clobber=True)
 
             bad_pixels[y1:y2, x1:x2] |= bad_pixels_in_this_source
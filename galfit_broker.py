@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+
+#
+# Job broker to share the GALFIT jobs of one auto_galfit run with worker
+# agents on other machines (or on the same machine, for testing).
+#
+# The coordinator serves jobs from its GALFIT queue over TCP. Agents ask for
+# one job at a time, run it, and report the result back on the same
+# connection. Every job handed out is leased to its agent, and the agent
+# renews the lease every HEARTBEAT_INTERVAL seconds while the job runs. If
+# the agent disconnects, or the lease is not renewed in time, the job is
+# handed out again; should the first agent turn up again, its next
+# heartbeat tells it to stop the job, and a result it still reports is
+# dropped, so only one agent keeps writing the job's output. All input and
+# output files are expected on a shared filesystem; only the job
+# descriptions and results travel over the network.
+#
+# Connections are authenticated with a shared key (--brokerkey, or the
+# GALFIT_BROKER_KEY environment variable), which is required: jobs and
+# results are pickled, so anyone who can connect without it could run code
+# on the coordinator or the agents.
+#
+
+import os
+import sys
+import collections
+import multiprocessing.connection
+import queue
+import threading
+import time
+
+import galfit_scheduler
+
+# extra time on top of the job timeout before a lease expires, and after each renewal
+LEASE_GRACE = 60.
+
+# how often agents renew the lease of the job they are running
+HEARTBEAT_INTERVAL = 5.
+
+# replies to requests that could not be handled, so the agent carries on
+ERROR_REPLIES = {'get': ('wait', 0.5), 'running': ('ok',)}
+
+
+def parse_address(address):
+
+    host, _, port = address.rpartition(":")
+    return (host if host else "127.0.0.1", int(port))
+
+
+def get_authkey(key=None):
+
+    if (key is None):
+        key = os.environ.get("GALFIT_BROKER_KEY", None)
+    if (not key):
+        raise ValueError("The job broker needs a shared key (--brokerkey or GALFIT_BROKER_KEY)")
+    return key.encode()
+
+
+def start_broker(address, galfit_queue, result_queue, authkey=None, default_timeout=60., n_queued=None):
+
+    #
+    # Start serving jobs from galfit_queue. Results reported by the agents
+    # are put into result_queue as (job, result) tuples. Returns the broker
+    # state, to be handed to stop_broker() at the end of the run.
+    #
+    broker = dict(
+        listener=multiprocessing.connection.Listener(parse_address(address), authkey=get_authkey(authkey)),
+        galfit_queue=galfit_queue,
+        n_queued=n_queued,
+        result_queue=result_queue,
+        default_timeout=default_timeout,
+        lock=threading.Lock(),
+        leases={},
+        requeue=collections.deque(),
+        next_lease=0,
+        n_agents=0,
+        shutdown=False,
+    )
+    print("Serving GALFIT jobs on %s:%d" % broker['listener'].address)
+
+    for target in (accept_agents, expire_leases):
+        t = threading.Thread(target=target, args=(broker,))
+        t.daemon = True
+        t.start()
+    return broker
+
+
+def stop_broker(broker):
+
+    # agents asking for more work from now on are told to stop; call this
+    # before putting shutdown tokens for the local workers on the queue
+    with broker['lock']:
+        broker['shutdown'] = True
+
+
+def accept_agents(broker):
+
+    # agents connecting after the shutdown are still served, and told to stop
+    while (True):
+        try:
+            conn = broker['listener'].accept()
+        except (OSError, EOFError, multiprocessing.AuthenticationError) as e:
+            print("Rejected agent connection: %s" % (str(e)))
+            continue
+        t = threading.Thread(target=serve_agent, args=(broker, conn))
+        t.daemon = True
+        t.start()
+
+
+def lease_job(broker, agent_name):
+
+    with broker['lock']:
+        if (broker['shutdown']):
+            return None, None
+        if (broker['requeue']):
+            job = broker['requeue'].popleft()
+        else:
+            try:
+                job = broker['galfit_queue'].get_nowait()
+            except queue.Empty:
+                return None, None
+            broker['galfit_queue'].task_done()
+            if (job is None):
+                # a shutdown token for the local workers, leave it to them
+                broker['galfit_queue'].put(job)
+                return None, None
+            galfit_scheduler.job_taken(broker['n_queued'], job)
+
+        lease_id = broker['next_lease']
+        broker['next_lease'] += 1
+        expires = time.time() + job.get('timeout', broker['default_timeout']) + LEASE_GRACE
+        broker['leases'][lease_id] = (job, agent_name, expires)
+    return lease_id, job
+
+
+def renew_lease(broker, lease_id):
+
+    # returns False if the lease has expired, and the job was handed out again
+    with broker['lock']:
+        lease = broker['leases'].get(lease_id, None)
+        if (lease is None):
+            return False
+        broker['leases'][lease_id] = (lease[0], lease[1], max(lease[2], time.time() + LEASE_GRACE))
+    return True
+
+
+def release_job(broker, lease_id):
+
+    # returns the job if the lease is still valid, None otherwise
+    with broker['lock']:
+        lease = broker['leases'].pop(lease_id, None)
+    return None if lease is None else lease[0]
+
+
+def requeue_job(broker, lease_id, reason):
+
+    with broker['lock']:
+        lease = broker['leases'].pop(lease_id, None)
+        if (lease is not None):
+            broker['requeue'].append(lease[0])
+    if (lease is not None):
+        print("Re-dispatching %s (%s on %s)" % (lease[0]['feedme'], reason, lease[1]))
+
+
+def expire_leases(broker, interval=5.):
+
+    while (True):
+        time.sleep(interval)
+        now = time.time()
+        with broker['lock']:
+            expired = [lease_id for lease_id in broker['leases'] if broker['leases'][lease_id][2] < now]
+        for lease_id in expired:
+            requeue_job(broker, lease_id, "lease expired")
+
+
+def handle_request(broker, agent, message):
+
+    # one request from an agent; returns the reply to send, if any
+    if (message[0] == 'get'):
+        agent['name'] = message[1]
+        if (broker['shutdown']):
+            return ('stop',)
+        lease_id, job = lease_job(broker, agent['name'])
+        if (job is None):
+            return ('stop',) if broker['shutdown'] else ('wait', 0.5)
+        agent['held'].add(lease_id)
+        return ('job', lease_id, job)
+
+    elif (message[0] == 'running'):
+        _, lease_id = message
+        if (renew_lease(broker, lease_id)):
+            return ('ok',)
+        agent['held'].discard(lease_id)
+        return ('cancel',)
+
+    elif (message[0] == 'result'):
+        _, lease_id, result = message
+        agent['held'].discard(lease_id)
+        job = release_job(broker, lease_id)
+        if (job is None):
+            # this job was handed out again in the meantime, the new lease reports the result
+            print("Dropping late result for lease %d from %s" % (lease_id, agent['name']))
+            return None
+        result['agent'] = agent['name']
+        broker['result_queue'].put((job, result))
+    return None
+
+
+def serve_agent(broker, conn):
+
+    agent = dict(name="unknown", held=set())
+    with broker['lock']:
+        broker['n_agents'] += 1
+    try:
+        while (True):
+            message = conn.recv()
+            try:
+                reply = handle_request(broker, agent, message)
+            except Exception as e:
+                # one bad request must not take down the connection (and the jobs leased on it)
+                print("Error handling %s request from %s: %s" % (str(message[0]), agent['name'], str(e)))
+                reply = ERROR_REPLIES.get(message[0], None)
+            if (reply is not None):
+                conn.send(reply)
+            if (reply == ('stop',)):
+                break
+
+    except (EOFError, OSError):
+        pass
+    finally:
+        conn.close()
+        for lease_id in list(agent['held']):
+            requeue_job(broker, lease_id, "agent disconnected")
+        with broker['lock']:
+            broker['n_agents'] -= 1
+
+
+def agent_loop(address, agent_name, run_job, authkey=None, retry_interval=5.):
+
+    #
+    # Fetch jobs from the coordinator and run them with run_job(job, cancel),
+    # which returns the result dictionary to report back, and stops early
+    # once the threading.Event cancel is set. Returns once the coordinator
+    # has no more work.
+    #
+    conn = None
+    while (conn is None):
+        try:
+            conn = multiprocessing.connection.Client(parse_address(address), authkey=get_authkey(authkey))
+        except ConnectionRefusedError:
+            print("Agent %s: waiting for coordinator at %s" % (agent_name, address))
+            time.sleep(retry_interval)
+
+    n_jobs = 0
+    try:
+        while (True):
+            conn.send(('get', agent_name))
+            reply = conn.recv()
+            if (reply[0] == 'stop'):
+                break
+            elif (reply[0] == 'wait'):
+                time.sleep(reply[1])
+                continue
+            _, lease_id, job = reply
+
+            # run the job next to the connection, to renew its lease while it runs
+            cancel = threading.Event()
+            outcome = {}
+            runner = threading.Thread(target=lambda: outcome.update(result=run_job(job, cancel)))
+            runner.start()
+            while (True):
+                runner.join(HEARTBEAT_INTERVAL)
+                if (not runner.is_alive()):
+                    break
+                conn.send(('running', lease_id))
+                if (conn.recv()[0] == 'cancel' and not cancel.is_set()):
+                    print("Agent %s: job %s was handed to another agent, stopping it" % (
+                        agent_name, job['feedme']))
+                    cancel.set()
+            if ('result' not in outcome):
+                # disconnecting makes the coordinator hand the job out again
+                raise RuntimeError("Agent %s: unable to run %s" % (agent_name, job['feedme']))
+            conn.send(('result', lease_id, outcome['result']))
+            n_jobs += 1
+    except (EOFError, OSError):
+        print("Agent %s: lost connection to coordinator" % (agent_name))
+    finally:
+        conn.close()
+    return n_jobs
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+#
+# Layout of the per-source files in a galfit directory.
+#
+# By default all files of all sources of an image (cutouts, feed-me file,
+# constraints, GALFIT output, log and plot; basename.NNNNN.*) go into the
+# galfit directory itself. At several files per source, large images make
+# for directories with hundreds of thousands of entries, and every open(),
+# isfile() or listing in them gets slow on network filesystems. With a
+# sharded layout, the files of each source go into one of n_shards
+# sub-directories instead (galfit/NN/, picked by source ID). Files shared by
+# all sources (PSF store, results tables, cutout containers) stay in the
+# galfit directory itself.
+#
+# The number of shards is recorded in the galfit directory, so all later
+# steps (combining catalogs, collecting results, plotting) find the files
+# without being told again.
+#
+
+import os
+import sys
+import tempfile
+
+LAYOUT_FILE = "layout"
+
+
+def shard_name(src_id, n_shards):
+
+    # zero-padded to the same width for all shards, at least two digits
+    width = len("%d" % (n_shards - 1))
+    return "%0*d" % (max(2, width), int(src_id) % n_shards)
+
+
+def source_dir(galfit_dir, src_id, n_shards=0):
+    if (n_shards <= 0):
+        return galfit_dir
+    return os.path.join(galfit_dir, shard_name(src_id, n_shards))
+
+
+def source_filename(galfit_dir, basename, src_id, suffix, n_shards=0):
+
+    # e.g. source_filename("galfit", "img", 12, "galfit.fits", 100) -> galfit/12/img.00012.galfit.fits
+    return os.path.join(source_dir(galfit_dir, src_id, n_shards), "%s.%05d.%s" % (basename, int(src_id), suffix))
+
+
+def shared_name(name, n_shards=0):
+
+    # feed-me files refer to shared files relative to the directory they are in
+    if (n_shards <= 0 or name == 'none'):
+        return name
+    return os.path.join("..", name)
+
+
+def load_layout(galfit_dir):
+
+    # the number of shards used in this galfit directory (0 for all files in one directory)
+    try:
+        with open(os.path.join(galfit_dir, LAYOUT_FILE), "r") as lf:
+            items = lf.read().split()
+        return int(items[1]) if (len(items) >= 2 and items[0] == "shards") else 0
+    except (IOError, ValueError):
+        return 0
+
+
+def save_layout(galfit_dir, n_shards):
+
+    #
+    # Record the layout of a galfit directory and create the shard
+    # directories; returns the number of shards to use. A directory keeps
+    # the layout it was started with, so files from earlier runs are found.
+    #
+    if (os.path.isfile(os.path.join(galfit_dir, LAYOUT_FILE))):
+        recorded = load_layout(galfit_dir)
+        if (recorded != n_shards):
+            print("%s uses %d shards, ignoring request for %d" % (galfit_dir, recorded, n_shards))
+        n_shards = recorded
+    elif (n_shards > 0):
+        # several writers may share the directory, so write the record atomically
+        _fd, tmp_fn = tempfile.mkstemp(prefix=".layout.", dir=galfit_dir)
+        with os.fdopen(_fd, "w") as lf:
+            lf.write("shards %d\n" % (n_shards))
+        os.replace(tmp_fn, os.path.join(galfit_dir, LAYOUT_FILE))
+
+    for i in range(max(0, n_shards)):
+        os.makedirs(source_dir(galfit_dir, i, n_shards), exist_ok=True)
+    return n_shards
+
+
+if __name__ == "__main__":
+
+    # show where the files of a source go: galfit_layout.py galfit_dir basename src_id
+    galfit_dir, basename, src_id = sys.argv[1], sys.argv[2], int(sys.argv[3])
+    print(source_filename(galfit_dir, basename, src_id, "galfit.fits", load_layout(galfit_dir)))
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+#
+# SQLite-backed ledger to keep track of the state of every GALFIT job in a
+# campaign. Each source passes through the following states:
+#
+#    planned -> cut -> running -> done | failed | timeout
+#
+# A restarted campaign loads the states of all sources of an image with a
+# single query, and only re-runs the sources that never finished. Images are
+# keyed by their real path, so a campaign resumes no matter from where, or
+# with which (relative or absolute) path, the image is given.
+#
+# In pipelined mode the inputs of finished jobs are removed; those jobs are
+# flagged (inputs_removed), and image_states() reports the ones that did
+# not end as done as 'retired', so their cutouts are written again.
+#
+# Every process needs to open its own connection, as sqlite connections can
+# not be shared across a fork.
+#
+
+import os
+import sys
+import sqlite3
+import time
+
+STATES = ('planned', 'cut', 'running', 'done', 'failed', 'timeout')
+
+# jobs in these states have their cutouts and feed-me file on disk
+INPUT_READY = ('cut', 'running', 'failed', 'timeout')
+
+COLUMNS = ('feedme', 'galfit_output', 'returncode',
+           'start_time', 'end_time', 'runtime', 'message',
+           'npix', 'flux_radius', 'psf_supersample')
+
+# columns added after the first version of the ledger
+ADDED_COLUMNS = (('npix', 'INTEGER'), ('flux_radius', 'REAL'), ('psf_supersample', 'REAL'),
+                 ('inputs_removed', 'INTEGER DEFAULT 0'))
+
+
+def open_ledger(ledger_fn):
+
+    conn = sqlite3.connect(ledger_fn, timeout=120)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            image TEXT NOT NULL,
+            src_id INTEGER NOT NULL,
+            state TEXT NOT NULL,
+            feedme TEXT,
+            galfit_output TEXT,
+            returncode INTEGER,
+            start_time REAL,
+            end_time REAL,
+            runtime REAL,
+            attempts INTEGER DEFAULT 0,
+            message TEXT,
+            modified REAL,
+            npix INTEGER,
+            flux_radius REAL,
+            psf_supersample REAL,
+            inputs_removed INTEGER DEFAULT 0,
+            PRIMARY KEY (image, src_id)
+        )""")
+    existing = [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]
+    for (column, column_type) in ADDED_COLUMNS:
+        if (column not in existing):
+            conn.execute("ALTER TABLE jobs ADD COLUMN %s %s" % (column, column_type))
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)")
+    conn.commit()
+    return conn
+
+
+def image_key(image):
+    return os.path.realpath(image)
+
+
+def plan_jobs(conn, image, src_ids):
+
+    # register all sources of an image at once, keeping any existing state
+    now = time.time()
+    conn.executemany(
+        "INSERT OR IGNORE INTO jobs (image, src_id, state, modified) VALUES (?, ?, 'planned', ?)",
+        [(image_key(image), int(src_id), now) for src_id in src_ids])
+    conn.commit()
+
+
+def image_states(conn, image):
+    cursor = conn.execute("SELECT src_id, state, inputs_removed FROM jobs WHERE image=?", (image_key(image),))
+    return dict([(src_id, 'retired' if (removed and state in INPUT_READY) else state)
+                 for (src_id, state, removed) in cursor.fetchall()])
+
+
+def mark_inputs_removed(conn, image, src_ids):
+    conn.executemany("UPDATE jobs SET inputs_removed=1 WHERE image=? AND src_id=?",
+                     [(image_key(image), int(s)) for s in src_ids])
+    conn.commit()
+
+
+def update_job(conn, image, src_id, state, **kwargs):
+
+    # src_id can also be a list of sources, fitted together in one job
+    src_ids = src_id if isinstance(src_id, (list, tuple)) else [src_id]
+    if (state not in STATES):
+        raise ValueError("Invalid job state: %s" % (state))
+
+    columns = ['state', 'modified']
+    values = [state, time.time()]
+    for key in kwargs:
+        if (key not in COLUMNS):
+            raise ValueError("Invalid ledger column: %s" % (key))
+        columns.append(key)
+        values.append(kwargs[key])
+
+    assignments = ", ".join(["%s=excluded.%s" % (c, c) for c in columns])
+    if (state == 'running'):
+        assignments += ", attempts=attempts+1"
+    elif (state == 'cut'):
+        # freshly written inputs
+        assignments += ", inputs_removed=0"
+
+    conn.executemany(
+        "INSERT INTO jobs (image, src_id, %s) VALUES (?, ?, %s) "
+        "ON CONFLICT (image, src_id) DO UPDATE SET %s" % (
+            ", ".join(columns), ", ".join(["?"] * len(columns)), assignments),
+        [[image_key(image), int(s)] + values for s in src_ids])
+    conn.commit()
+
+
+def summary(conn):
+    cursor = conn.execute("SELECT state, COUNT(*), SUM(runtime) FROM jobs GROUP BY state")
+    return dict([(state, (count, runtime)) for (state, count, runtime) in cursor.fetchall()])
+
+
+if __name__ == "__main__":
+
+    # print a summary of a ledger: galfit_ledger.py ledger.db [state]
+    ledger_fn = sys.argv[1]
+    if (not os.path.isfile(ledger_fn)):
+        print("Ledger %s does not exist" % (ledger_fn))
+        sys.exit(1)
+    conn = open_ledger(ledger_fn)
+
+    for state in STATES:
+        count, runtime = summary(conn).get(state, (0, None))
+        print("%-8s %8d jobs   %10.1f seconds" % (state, count, runtime if runtime else 0.))
+
+    if (len(sys.argv) > 2):
+        for row in conn.execute(
+                "SELECT image, src_id, returncode, runtime, attempts, message FROM jobs WHERE state=?",
+                (sys.argv[2],)):
+            print(" ".join([str(r) for r in row]))
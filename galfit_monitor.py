@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+#
+# Watch GALFIT's progress while it runs, and stop fits that are clearly not
+# going anywhere instead of letting them run into the timeout.
+#
+# GALFIT reports every iteration on stdout, e.g.
+#
+#    Iteration : 6     Chi2nu: 3.285e+02     dChi2/Chi2: -3.38e-08    alamda: 1e+02
+#     sersic    : (  [62.00],  [62.00])  18.87      5.98    1.02    0.80    58.43
+#     sky       : [ 63.00,  63.00]  1130.55  [0.00e+00]  [0.00e+00]
+#
+# and the monitor is fed these lines as they come in. A fit is given up on
+#
+#    - as soon as chi2 is no longer a finite number,
+#    - when chi2 has not improved on its best value for max_stall iterations,
+#    - when the half-light radius of a sersic component stays beyond
+#      re_factor times the size of the fitting region for re_patience
+#      iterations in a row.
+#
+# Setting max_stall or re_factor to 0 switches off that rule. GALFIT buffers
+# its output when writing to a pipe, so lines arrive in blocks rather than
+# one by one; that only delays the decision by a few iterations.
+#
+
+import sys
+import numpy
+
+# chi2 has to drop by at least this fraction to count as an improvement
+MIN_IMPROVEMENT = 1.e-6
+
+
+def default_rules():
+    return dict(max_stall=30, re_factor=2., re_patience=3)
+
+
+def region_size(feedme_fn):
+
+    # longer side of the fitting region (H) in the feed-me file
+    try:
+        with open(feedme_fn, "r") as ff:
+            for line in ff:
+                items = line.split("#")[0].split()
+                if (len(items) >= 5 and items[0] == "H)"):
+                    x1, x2, y1, y2 = [float(v) for v in items[1:5]]
+                    return max(x2 - x1, y2 - y1) + 1
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+def start(rules, feedme_fn):
+
+    # a new monitor for one GALFIT run, or None if no rule is active
+    if (rules is None or (rules['max_stall'] <= 0 and rules['re_factor'] <= 0)):
+        return None
+    return dict(rules=rules, region_size=region_size(feedme_fn), iteration=0,
+                best_chi2=numpy.inf, stall=0, re_over=0, re_seen=False, reason=None, pending=b"")
+
+
+def parse_iteration(line):
+
+    # iteration number and chi2nu from an iteration line, or None
+    items = line.replace(":", " ").split()
+    if (len(items) < 4 or items[0] != "Iteration" or items[2] != "Chi2nu"):
+        return None
+    try:
+        return int(items[1]), float(items[3])
+    except ValueError:
+        return None
+
+
+def parse_sersic(line):
+
+    # (x, y, mag, r_e, n, q, pa) from a sersic line of an iteration, or None
+    name, _, values = line.partition(":")
+    if (name.strip() != "sersic"):
+        return None
+    for c in "()[],*":
+        values = values.replace(c, " ")
+    try:
+        return [float(v) for v in values.split()]
+    except ValueError:
+        return None
+
+
+def update(monitor, line):
+
+    #
+    # Feed one line of GALFIT output to the monitor; returns the reason to
+    # stop the fit, or None to let it carry on
+    #
+    if (monitor is None):
+        return None
+    if (monitor['reason'] is not None):
+        return monitor['reason']
+    rules = monitor['rules']
+
+    iteration = parse_iteration(line)
+    if (iteration is not None):
+        # the previous iteration is complete, check its components
+        if (monitor['iteration'] > 0 and rules['re_factor'] > 0):
+            monitor['re_over'] = monitor['re_over'] + 1 if monitor['re_seen'] else 0
+            if (monitor['re_over'] >= rules['re_patience']):
+                monitor['reason'] = "R_e beyond %.1f pixels for %d iterations" % (
+                    rules['re_factor'] * monitor['region_size'], monitor['re_over'])
+                return monitor['reason']
+        monitor['re_seen'] = False
+
+        monitor['iteration'], chi2 = iteration
+        if (not numpy.isfinite(chi2)):
+            monitor['reason'] = "chi2 is %s at iteration %d" % (str(chi2), monitor['iteration'])
+        elif (chi2 < monitor['best_chi2'] * (1. - MIN_IMPROVEMENT)):
+            monitor['best_chi2'] = chi2
+            monitor['stall'] = 0
+        else:
+            monitor['stall'] += 1
+            if (rules['max_stall'] > 0 and monitor['stall'] >= rules['max_stall']):
+                monitor['reason'] = "chi2 not improving for %d iterations (best %.4g)" % (
+                    monitor['stall'], monitor['best_chi2'])
+        return monitor['reason']
+
+    if (rules['re_factor'] > 0 and monitor['region_size'] is not None):
+        values = parse_sersic(line)
+        if (values is not None and len(values) >= 4 and
+                values[3] > rules['re_factor'] * monitor['region_size']):
+            monitor['re_seen'] = True
+    return None
+
+
+def feed(monitor, output):
+
+    # feed a block of raw output to the monitor, which may end in the middle of a line
+    if (monitor is None):
+        return None
+    lines = (monitor['pending'] + output).split(b"\n")
+    monitor['pending'] = lines.pop()
+    for line in lines:
+        reason = update(monitor, line.decode("ascii", errors="replace"))
+        if (reason is not None):
+            return reason
+    return None
+
+
+if __name__ == "__main__":
+
+    # replay a GALFIT log: galfit_monitor.py file.galfeed file.galfit.log
+    monitor = start(default_rules(), sys.argv[1])
+    with open(sys.argv[2], "r", errors="replace") as log:
+        for line in log:
+            reason = update(monitor, line)
+            if (reason is not None):
+                print("Would have stopped at iteration %d: %s" % (monitor['iteration'], reason))
+                break
+        else:
+            print("Ran to the end (%d iterations, best chi2nu %.4g)" % (
+                monitor['iteration'], monitor['best_chi2']))
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+
+#
+# Extract the fit results from GALFIT output files, and collect them into
+# one results table per image while the fits are still running.
+#
+# The fitting workers parse the header of each GALFIT output right after the
+# fit, and pass a compact record of numbers to the collector process. The
+# collector appends these records to a plain-text table next to the galfit
+# output files (one per image), and once all fits are done merges each table
+# with the source catalog of its image into a combined catalog, with the
+# same columns as written by combine_sextractor_galfit.py.
+#
+
+import os
+import sys
+import numpy
+import astropy.io.fits as pyfits
+import astropy.table
+
+import warm_start
+import galfit_layout
+
+COMPONENT_PARAMETERS = {
+    'sersic': ['XC', 'YC', 'MAG', 'RE', 'N', 'AR', 'PA'],
+    'sky': ['XC', 'YC', 'SKY', 'DSDX', 'DSDY'],
+}
+
+FIT_STATISTICS = ['CHISQ', 'NDOF', 'NFREE', 'NFIX', 'CHI2NU']
+
+# written for each source ahead of the fit results
+JOB_COLUMNS = ['NUMBER', 'RETURNCODE', 'RUNTIME', 'GROUP']
+
+# flags for each fit parameter
+FLAG_OK = 0
+FLAG_FIXED = 1
+FLAG_PROBLEMATIC = 2
+FLAG_MISSING = 99
+
+
+def parse_galfit_value(fits_value):
+
+    #
+    # GALFIT reports results as '55.3318 +/- 0.4551', fixed parameters as
+    # '[54.0000]', and marks problematic results with '*55.3318* +/- *0.4551*'
+    #
+    try:
+        if (fits_value.startswith("[")):
+            return float(fits_value.split("[")[1].split("]")[0]), numpy.nan, FLAG_FIXED
+        items = [f.strip() for f in fits_value.split("+/-")]
+        if (len(items) == 2):
+            if (items[0].startswith("*") or items[1].startswith("*")):
+                return float(items[0].strip("*")), float(items[1].strip("*")), FLAG_PROBLEMATIC
+            return float(items[0]), float(items[1]), FLAG_OK
+    except ValueError:
+        pass
+    return numpy.nan, numpy.nan, FLAG_MISSING
+
+
+def read_fit_results(galfit_fn, member=0):
+
+    #
+    # Returns the list of column names and values for one GALFIT output
+    # file, or (None, None) if the file can not be read. Only the header of
+    # the model extension is read, not the image data. For fits of a group
+    # of sources, member selects the sersic component to report (together
+    # with the components shared by all members, like the sky).
+    #
+    try:
+        header = pyfits.getheader(galfit_fn, 2)
+    except (IOError, OSError, IndexError, KeyError):
+        return None, None
+
+    columns = []
+    values = []
+    component = 1
+    n_sersic = 0
+    while ("COMP_%d" % (component) in header):
+        model = header["COMP_%d" % (component)].strip().lower()
+        if (model == 'sersic'):
+            n_sersic += 1
+            if (n_sersic != member + 1):
+                component += 1
+                continue
+        for p in COMPONENT_PARAMETERS.get(model, []):
+            value, error, flag = parse_galfit_value(str(header.get("%d_%s" % (component, p), "")))
+            name = "%s_%s" % (model.upper(), p)
+            columns.extend([name, name + "_ERR", name + "_FLAG"])
+            values.extend([value, error, flag])
+        component += 1
+    if (n_sersic <= member):
+        return None, None
+
+    for key in FIT_STATISTICS:
+        columns.append(key)
+        try:
+            values.append(float(header[key]))
+        except (KeyError, ValueError, TypeError):
+            values.append(numpy.nan)
+
+    return columns, values
+
+
+def results_table_filename(galfit_dir, basename):
+    return os.path.join(galfit_dir, "%s.galfit_results.txt" % (basename))
+
+
+def read_table_columns(table_fn):
+
+    with open(table_fn, "r") as tf:
+        header = tf.readline()
+    return header[1:].split()
+
+
+def converged_sersic(record):
+
+    #
+    # Returns the sersic parameters of a results record that converged, or
+    # None if the fit did not. Parameters that were held fixed, or that
+    # GALFIT flagged as problematic, are left out.
+    #
+    values = dict(zip(record['columns'], record['values']))
+    if (values.get('RETURNCODE', -1) != 0):
+        return None
+    solution = {}
+    for p in COMPONENT_PARAMETERS['sersic']:
+        if (values.get("SERSIC_%s_FLAG" % (p), FLAG_MISSING) == FLAG_OK):
+            solution[p] = float(values["SERSIC_%s" % (p)])
+    if ('MAG' not in solution or 'RE' not in solution):
+        return None
+    solution['CHI2NU'] = float(values.get('CHI2NU', numpy.nan))
+    return solution
+
+
+def results_collector(results_queue, combined_extension=None, warm_start_fn=None):
+
+    #
+    # Append all incoming records to the results table of their image, until
+    # receiving a None token. Then merge each table with its source catalog.
+    # Converged solutions also go into the warm-start store, if there is one.
+    #
+    tables = {}
+    store = None
+    if (warm_start_fn is not None):
+        store = warm_start.open_store(warm_start_fn)
+    positions = {}
+    n_unsaved = 0
+    while (True):
+        record = results_queue.get()
+        if (record is None):
+            break
+
+        table_fn = record['table']
+        if (table_fn not in tables):
+            new_table = not os.path.isfile(table_fn) or os.path.getsize(table_fn) == 0
+            columns = record['columns'] if new_table else read_table_columns(table_fn)
+            tables[table_fn] = dict(file=open(table_fn, "a"), columns=columns, record=record)
+            if (new_table):
+                tables[table_fn]['file'].write("# %s\n" % (" ".join(columns)))
+
+        table = tables[table_fn]
+        if (record['columns'] != table['columns']):
+            print("Results for source %d do not match the columns of %s" % (record['src_id'], table_fn))
+            continue
+        table['file'].write(" ".join(["%.10g" % (v) for v in record['values']]) + "\n")
+        table['file'].flush()
+
+        solution = None if store is None else converged_sersic(record)
+        if (solution is not None):
+            if (record['catalog'] not in positions):
+                positions[record['catalog']] = warm_start.catalog_positions(record['catalog'])
+            ra, dec = positions[record['catalog']].get(record['src_id'], (None, None))
+            warm_start.save_solution(store, record['basename'], record['src_id'], solution, ra, dec)
+            n_unsaved += 1
+            if (n_unsaved >= 50):
+                store.commit()
+                n_unsaved = 0
+
+    if (store is not None):
+        store.commit()
+        store.close()
+
+    for table_fn in tables:
+        tables[table_fn]['file'].close()
+        if (combined_extension is not None):
+            record = tables[table_fn]['record']
+            bn, _ = os.path.splitext(record['image'])
+            write_combined_catalog(record['catalog'], table_fn,
+                                   "%s.%s" % (bn, combined_extension), record['basename'])
+
+
+def make_records(cmd, returncode, runtime, galfit_output_fn=None):
+
+    #
+    # Called by the fitting workers right after each fit; returns one record
+    # for each source in the fit (the GROUP column names the primary source)
+    #
+    if (galfit_output_fn is None):
+        galfit_output_fn = cmd['galfit_output']
+    records = []
+    for member, src_id in enumerate(cmd.get('members', [cmd['src_id']])):
+        columns, values = read_fit_results(galfit_output_fn, member)
+        if (columns is None):
+            break
+        records.append(dict(
+            image=cmd['image'],
+            catalog=cmd['catalog'],
+            table=cmd['results_table'],
+            basename=cmd['basename'],
+            src_id=int(src_id),
+            columns=JOB_COLUMNS + columns,
+            values=[int(src_id), returncode, runtime, int(cmd['src_id'])] + values,
+        ))
+    return records
+
+
+def write_combined_catalog(catalog_fn, table_fn, combined_fn, basename):
+
+    try:
+        catalog = astropy.table.Table.read(catalog_fn)
+        results = astropy.table.Table.read(table_fn, format='ascii.commented_header')
+    except (IOError, OSError, ValueError) as e:
+        print("Unable to combine %s and %s: %s" % (catalog_fn, table_fn, str(e)))
+        return
+
+    # the last entry of a source wins, in case it was fitted more than once
+    row_index = dict([(int(n), i) for i, n in enumerate(results['NUMBER'])])
+    columns = [c for c in results.colnames if c != 'NUMBER']
+
+    combined = numpy.full((len(catalog), len(columns)), numpy.nan)
+    n_missing = 0
+    galfit_dir, _ = os.path.split(table_fn)
+    n_shards = galfit_layout.load_layout(galfit_dir)
+    for i_src, src_id in enumerate(catalog['NUMBER']):
+        if (int(src_id) in row_index):
+            row = results[row_index[int(src_id)]]
+            combined[i_src] = [row[c] for c in columns]
+            continue
+        # fitted before results were collected during the fit
+        _columns, _values = read_fit_results(
+            galfit_layout.source_filename(galfit_dir, basename, src_id, "galfit.fits", n_shards))
+        n_job = len(JOB_COLUMNS) - 1
+        if (_columns is not None and _columns == columns[n_job:]):
+            combined[i_src, n_job:] = _values
+        else:
+            n_missing += 1
+
+    for i_col, column in enumerate(columns):
+        if (column.endswith("_FLAG")):
+            # same as combine_sextractor_galfit.py: no values for problematic results
+            problematic = (combined[:, i_col] == FLAG_PROBLEMATIC)
+            combined[problematic, i_col - 2] = numpy.nan
+            combined[problematic, i_col - 1] = numpy.nan
+
+    for i_col, column in enumerate(columns):
+        catalog.add_column(astropy.table.Column(name=column, data=combined[:, i_col]))
+
+    catalog.write(combined_fn, format='votable', overwrite=True)
+    print("Combined catalog (%d sources, %d without results) written to %s" % (
+        len(catalog), n_missing, combined_fn))
+
+
+if __name__ == "__main__":
+
+    # print the results of GALFIT output files: galfit_results.py *.galfit.fits
+    for fn in sys.argv[1:]:
+        columns, values = read_fit_results(fn)
+        if (columns is None):
+            print("%s: unable to read results" % (fn))
+            continue
+        print(fn)
+        for column, value in zip(columns, values):
+            print("   %-16s %s" % (column, value))
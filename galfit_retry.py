@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+#
+# Retries for failed GALFIT fits.
+#
+# Failed fits are classified as timeouts, crashes (non-zero return code) or
+# fits without (or with an empty) output file. Each class gets its own
+# sequence of escalating strategies, one per retry:
+#
+#    timeout    - longer timeout, smaller fitting region, fixed Sersic index
+#    crash      - restart from GALFIT's restart file, fixed Sersic index,
+#                 smaller fitting region
+#    no output  - same as crash
+#    diverging  - fixed Sersic index, smaller fitting region (for fits the
+#                 output monitor stopped, see galfit_monitor.py)
+#
+# Strategies that can not help (e.g. a longer timeout when the timeout is
+# already at its maximum, or a restart without restart file) are skipped.
+# All changes are made to a copy of the feed-me file, carried along with the
+# job, so the original inputs stay untouched.
+#
+
+import os
+import glob
+
+STRATEGIES = {
+    'timeout': ('longer_timeout', 'crop', 'fix_sersic_n'),
+    'crash': ('restart', 'fix_sersic_n', 'crop'),
+    'no_output': ('restart', 'fix_sersic_n', 'crop'),
+    'diverging': ('fix_sersic_n', 'crop'),
+}
+
+TIMEOUT_FACTOR = 4.
+
+# smallest fitting region worth trying
+MIN_REGION_SIZE = 32
+
+# number of most recent restart files to look at
+MAX_RESTART_FILES = 50
+
+
+def default_policy():
+    return dict(max_retries=3, max_timeout=3600., max_size=-1)
+
+
+def classify_failure(returncode, problem, galfit_output_fn):
+
+    if (problem is not None and problem.startswith("timeout")):
+        return 'timeout'
+    if (problem is not None and problem.startswith("aborted")):
+        return 'diverging'
+    if (returncode != 0):
+        return 'crash'
+    if (not os.path.isfile(galfit_output_fn) or os.path.getsize(galfit_output_fn) == 0):
+        return 'no_output'
+    return None
+
+
+def restart_output_name(restart_fn):
+
+    # the output file (B) a GALFIT restart file belongs to, or None
+    try:
+        with open(restart_fn, "r") as rf:
+            for line in rf:
+                if (line.strip().startswith("B)")):
+                    return line.split(")", 1)[1].split()[0]
+    except (IOError, IndexError, UnicodeDecodeError):
+        pass
+    return None
+
+
+def find_restart_file(cwd, galfit_output_fn):
+
+    #
+    # GALFIT leaves a restart file galfit.NN (with the best-fit parameters as
+    # starting values) in its working directory; find the most recent one
+    # that belongs to this output file
+    #
+    _, output_name = os.path.split(galfit_output_fn)
+    candidates = sorted(restart_files(cwd), key=lambda fn: fn[1], reverse=True)
+    for restart_fn, _ in candidates[:MAX_RESTART_FILES]:
+        if (restart_output_name(restart_fn) == output_name):
+            return restart_fn
+    return None
+
+
+def restart_files(cwd):
+
+    # all restart files in a directory, with their modification times
+    # (others may be removed by finished jobs at any time)
+    files = []
+    for restart_fn in glob.glob(os.path.join(cwd, "galfit.[0-9]*")):
+        try:
+            files.append((restart_fn, os.path.getmtime(restart_fn)))
+        except OSError:
+            continue
+    return files
+
+
+def crop_region(feedme, max_size):
+
+    #
+    # Shrink the fitting region (H) around its center, to max_size if that
+    # makes it smaller, or to half its current size otherwise
+    #
+    lines = feedme.splitlines()
+    for i, line in enumerate(lines):
+        if (not line.strip().startswith("H)")):
+            continue
+        value, _, comment = line.split(")", 1)[1].partition("#")
+        x1, x2, y1, y2 = [int(v) for v in value.split()[:4]]
+        size = max(x2 - x1, y2 - y1)
+        new_size = max_size if (0 < max_size < size) else size // 2
+        if (new_size < MIN_REGION_SIZE or new_size >= size):
+            return None
+        xc, yc = (x1 + x2) // 2, (y1 + y2) // 2
+        half = new_size // 2
+        lines[i] = "H) %d %d %d %d   # Image region to fit (xmin xmax ymin ymax), cropped for retry" % (
+            max(x1, xc - half), min(x2, xc + half), max(y1, yc - half), min(y2, yc + half))
+        return "\n".join(lines) + "\n"
+    return None
+
+
+def fix_sersic_index(feedme):
+
+    # keep the Sersic index of all sersic components at its starting value
+    lines = feedme.splitlines()
+    changed = False
+    component = None
+    for i, line in enumerate(lines):
+        items = line.split("#")[0].split()
+        if (len(items) < 2 or not items[0].endswith(")")):
+            continue
+        if (items[0] == "0)"):
+            component = items[1]
+        elif (items[0] == "5)" and component == "sersic" and len(items) >= 3 and items[2] != "0"):
+            lines[i] = "5) %s      0          #  Sersic index n, fixed for retry" % (items[1])
+            changed = True
+    return "\n".join(lines) + "\n" if changed else None
+
+
+def escalate(cmd, failure, feedme, cwd, policy):
+
+    #
+    # Returns the job for the next retry, or None if there is nothing left
+    # to try. feedme is the text of the feed-me file used in the failed run.
+    #
+    attempt = cmd.get('retry', 0) + 1
+    if (attempt > policy['max_retries']):
+        return None
+
+    strategies = STRATEGIES[failure]
+    for strategy in strategies[cmd.get('next_strategy', 0):]:
+        retry = dict(cmd)
+        retry['retry'] = attempt
+        retry['next_strategy'] = strategies.index(strategy) + 1
+        retry['strategy'] = strategy
+        retry['feedme_text'] = feedme
+
+        if (strategy == 'longer_timeout'):
+            timeout = cmd.get('timeout', 60.)
+            if (timeout >= policy['max_timeout']):
+                continue
+            retry['timeout'] = min(timeout * TIMEOUT_FACTOR, policy['max_timeout'])
+
+        elif (strategy == 'restart'):
+            restart_fn = find_restart_file(cwd, cmd['galfit_output'])
+            if (restart_fn is None):
+                continue
+            with open(restart_fn, "r") as rf:
+                retry['feedme_text'] = rf.read()
+
+        elif (strategy == 'crop'):
+            retry['feedme_text'] = crop_region(feedme, policy['max_size'])
+
+        elif (strategy == 'fix_sersic_n'):
+            retry['feedme_text'] = fix_sersic_index(feedme)
+
+        if (retry['feedme_text'] is None):
+            continue
+        return retry
+
+    return None
+
+
+def retry_feedme_filename(cmd):
+
+    _, feedfile = os.path.split(cmd['feedme'])
+    return "%s.retry%d" % (feedfile, cmd['retry'])
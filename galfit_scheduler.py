@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+#
+# Cost model and scheduling for GALFIT jobs.
+#
+# The runtime of a GALFIT fit is modelled as a linear combination of
+#    - a constant start-up overhead,
+#    - the number of pixels in the cutout,
+#    - the number of pixels times the PSF supersampling factor squared, which
+#      describes the size of the convolutions, and
+#    - the cutout size times the half-light radius, as extended sources need
+#      more iterations to converge.
+# The coefficients are calibrated from the runtimes recorded in the job
+# ledger for all completed fits.
+#
+
+import os
+import sys
+import heapq
+import queue
+import time
+import numpy
+import scipy.optimize
+
+import galfit_ledger
+
+# used as long as there are not enough completed jobs to calibrate the model
+DEFAULT_COEFFICIENTS = [0.5, 2.e-5, 5.e-6, 2.e-6]
+
+MIN_CALIBRATION_JOBS = 25
+
+
+def cost_features(npix, flux_radius, psf_supersample):
+
+    npix = numpy.asarray(npix, dtype=numpy.float64)
+    flux_radius = numpy.nan_to_num(numpy.asarray(flux_radius, dtype=numpy.float64))
+    psf_supersample = numpy.asarray(psf_supersample, dtype=numpy.float64)
+    return numpy.array([
+        numpy.ones_like(npix),
+        npix,
+        npix * psf_supersample**2,
+        npix * numpy.fabs(flux_radius),
+    ]).T
+
+
+def default_model():
+    return dict(coefficients=numpy.array(DEFAULT_COEFFICIENTS), n_jobs=0, calibrated=False)
+
+
+def calibrate(ledger):
+
+    #
+    # Fit the model to all successful fits in the ledger; non-negative least
+    # squares makes sure larger cutouts never get predicted to be faster
+    #
+    model = default_model()
+    if (ledger is None):
+        return model
+
+    rows = ledger.execute(
+        "SELECT npix, flux_radius, psf_supersample, runtime FROM jobs "
+        "WHERE state='done' AND runtime IS NOT NULL AND npix IS NOT NULL").fetchall()
+    if (len(rows) < MIN_CALIBRATION_JOBS):
+        return model
+
+    rows = numpy.array(rows, dtype=numpy.float64)
+    A = cost_features(rows[:, 0], rows[:, 1], rows[:, 2])
+    coefficients, _ = scipy.optimize.nnls(A, rows[:, 3])
+
+    model['coefficients'] = coefficients
+    model['n_jobs'] = rows.shape[0]
+    model['calibrated'] = True
+    return model
+
+
+def predict_runtime(model, npix, flux_radius, psf_supersample):
+    return cost_features(npix, flux_radius, psf_supersample).dot(model['coefficients'])
+
+
+def job_timeout(predicted, min_timeout, timeout_scale, max_timeout):
+
+    # allow each job a multiple of its predicted runtime, within limits
+    if (timeout_scale <= 0):
+        return min_timeout
+    return float(numpy.clip(timeout_scale * predicted, min_timeout, numpy.max([min_timeout, max_timeout])))
+
+
+def expected_walltime(runtimes, n_procs):
+
+    #
+    # Simulate longest-first dispatch of all jobs onto n_procs slots
+    #
+    slots = [0.] * n_procs
+    for runtime in numpy.sort(runtimes)[::-1]:
+        heapq.heappush(slots, heapq.heappop(slots) + runtime)
+    return numpy.max(slots)
+
+
+def job_taken(n_queued, job):
+
+    # a worker took a job from the GALFIT queue; shutdown (None) tokens are not counted
+    if (n_queued is not None and job is not None):
+        with n_queued.get_lock():
+            n_queued.value -= 1
+
+
+def priority_dispatcher(intake_queue, galfit_queue, n_queued, queue_depth, stop_event, max_intake=1000):
+
+    #
+    # Collect all jobs coming from the feed-me writers and always hand the
+    # most expensive job available to the GALFIT workers. Only a few jobs are
+    # kept in the worker queue, so newly arriving expensive jobs can still
+    # overtake cheaper ones. The writers' end is signalled by a None token,
+    # but retries of failed jobs can still come in after that, so the
+    # dispatcher keeps going until stop_event is set at the end of the run.
+    #
+    # The number of jobs in the worker queue is kept in the shared counter
+    # n_queued (multiprocessing.Value), which the workers decrement through
+    # job_taken(); Queue.qsize() is not available on all platforms (macOS).
+    #
+    pending = []
+    counter = 0
+    while (not stop_event.is_set()):
+
+        for i in range(max_intake):
+            try:
+                job = intake_queue.get(block=True, timeout=0.1)
+            except queue.Empty:
+                break
+            if (job is None):
+                continue
+            heapq.heappush(pending, (-job['cost'], counter, job))
+            counter += 1
+
+        while (pending and n_queued.value < queue_depth):
+            _, _, job = heapq.heappop(pending)
+            with n_queued.get_lock():
+                n_queued.value += 1
+            galfit_queue.put(job)
+
+
+if __name__ == "__main__":
+
+    # show the calibrated model: galfit_scheduler.py galfit_ledger.db
+    model = calibrate(galfit_ledger.open_ledger(sys.argv[1]))
+    print("Calibrated from %d jobs: %s" % (model['n_jobs'], str(model['coefficients'])))
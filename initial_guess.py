@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+#
+# Starting values for the sersic fits, measured from the cutouts.
+#
+# The SExtractor values (FLUX_RADIUS_50, 1/ELONGATION) are measured above
+# the detection threshold, which for low surface brightness sources only
+# covers their cores, and the sersic index is not measured at all. Here, all
+# sources of a cutout are measured at once from the unmasked pixels:
+#
+#    - the local sky is the clipped median of the pixels outside all
+#      apertures,
+#    - every pixel within an aperture is assigned to the closest source
+#      (relative to the aperture size), and the light-weighted second
+#      moments of those pixels give axis ratio and position angle,
+#    - the light within elliptical radii gives r_50 and r_90, and their
+#      ratio (the concentration) the sersic index that has the same ratio.
+#
+# The catalog radii of faint, extended sources are often too small, so the
+# apertures are grown to APERTURE_SCALE times the measured r_90 and the
+# measurement repeated, for up to N_ITERATIONS passes.
+#
+# Sources with too few pixels or no flux above the sky are flagged as not
+# valid, and keep their catalog values.
+#
+
+import sys
+import numpy
+import scipy.special
+
+# apertures start at this multiple of the catalog half-light radius (at
+# least MIN_RADIUS pixels), and are grown to this multiple of r_90
+APERTURE_SCALE = 2.
+MIN_RADIUS = 5.
+N_ITERATIONS = 3
+MIN_PIXELS = 20
+MIN_SKY_PIXELS = 50
+
+# allowed range of the starting values
+SERSIC_N_RANGE = (0.3, 6.)
+MIN_AXIS_RATIO = 0.05
+
+GUESS_DTYPE = [('valid', 'bool'), ('sky', 'f8'), ('x', 'f8'), ('y', 'f8'),
+               ('halflight_radius', 'f8'), ('r90', 'f8'), ('sersic_n', 'f8'),
+               ('axis_ratio', 'f8'), ('position_angle', 'f8')]
+
+
+def concentration_table(n_min=0.2, n_max=8., n_steps=200):
+
+    # r_90/r_50 of sersic profiles, which grows monotonically with n
+    n = numpy.linspace(n_min, n_max, n_steps)
+    b_n = scipy.special.gammaincinv(2 * n, 0.5)
+    concentration = (scipy.special.gammaincinv(2 * n, 0.9) / b_n) ** n
+    return concentration, n
+
+
+CONCENTRATION, SERSIC_N = concentration_table()
+
+
+def sersic_index(concentration):
+    return numpy.clip(numpy.interp(concentration, CONCENTRATION, SERSIC_N), *SERSIC_N_RANGE)
+
+
+def clipped_median(values, n_iterations=3, n_sigma=3.):
+    for i in range(n_iterations):
+        median = numpy.median(values)
+        sigma = 1.4826 * numpy.median(numpy.abs(values - median))
+        if (sigma <= 0):
+            break
+        values = values[numpy.abs(values - median) < n_sigma * sigma]
+    return numpy.median(values)
+
+
+def radius_fractions(radius, flux, fractions):
+
+    # radii enclosing the given fractions of the flux
+    order = numpy.argsort(radius)
+    cumulative = numpy.cumsum(flux[order])
+    return numpy.interp(numpy.asarray(fractions) * cumulative[-1], cumulative, radius[order])
+
+
+def measure(px, py, values, x, y, radius):
+
+    # one pass over all sources with the given aperture radii
+    guess = numpy.zeros(x.shape[0], dtype=GUESS_DTYPE)
+
+    # distance of every pixel to every source, in units of its aperture
+    distance = numpy.hypot(px[None, :] - x[:, None], py[None, :] - y[:, None]) / radius[:, None]
+    closest = numpy.argmin(distance, axis=0)
+    min_distance = distance[closest, numpy.arange(px.shape[0])]
+
+    # the local sky; in small cutouts, fall back to the pixels farthest from all sources
+    outside = min_distance > 1
+    if (numpy.sum(outside) < MIN_SKY_PIXELS):
+        outside = min_distance >= numpy.percentile(min_distance, 75)
+    sky = clipped_median(values[outside])
+    guess['sky'] = sky
+
+    for i in range(x.shape[0]):
+        member = (closest == i) & (min_distance <= 1)
+        flux = numpy.maximum(values[member] - sky, 0)
+        total = numpy.sum(flux)
+        if (numpy.sum(member) < MIN_PIXELS or total <= 0):
+            continue
+
+        # light-weighted centroid and second moments
+        mx, my = px[member], py[member]
+        xc, yc = numpy.sum(flux * mx) / total, numpy.sum(flux * my) / total
+        dx, dy = mx - xc, my - yc
+        mxx, myy, mxy = numpy.sum(flux * dx * dx) / total, numpy.sum(flux * dy * dy) / total, \
+            numpy.sum(flux * dx * dy) / total
+        spread = numpy.hypot(0.5 * (mxx - myy), mxy)
+        a2, b2 = 0.5 * (mxx + myy) + spread, 0.5 * (mxx + myy) - spread
+        if (a2 <= 0):
+            continue
+        q = numpy.clip(numpy.sqrt(numpy.maximum(b2, 0) / a2), MIN_AXIS_RATIO, 1.)
+        theta = 0.5 * numpy.arctan2(2 * mxy, mxx - myy)
+
+        # light within elliptical radii (along the major axis, like R_e in GALFIT)
+        major = dx * numpy.cos(theta) + dy * numpy.sin(theta)
+        minor = -dx * numpy.sin(theta) + dy * numpy.cos(theta)
+        r50, r90 = radius_fractions(numpy.hypot(major, minor / q), flux, [0.5, 0.9])
+        if (r50 <= 0):
+            continue
+
+        guess['valid'][i] = True
+        guess['x'][i], guess['y'][i] = xc, yc
+        guess['halflight_radius'][i] = r50
+        guess['r90'][i] = r90
+        guess['sersic_n'][i] = sersic_index(r90 / r50)
+        guess['axis_ratio'][i] = q
+        # theta runs from +x towards +y (like THETA_IMAGE), GALFIT's PA from up (+y) towards left (-x)
+        guess['position_angle'][i] = numpy.degrees(theta) - 90
+    return guess
+
+
+def estimate(img, mask, x, y, halflight_radius):
+
+    #
+    # Starting values for the sources at (x, y) (0-based, in the cutout);
+    # pixels where mask is not 0 (other objects) are ignored. Returns one
+    # row of GUESS_DTYPE per source.
+    #
+    x, y = numpy.atleast_1d(x).astype(numpy.float64), numpy.atleast_1d(y).astype(numpy.float64)
+    radius = numpy.maximum(APERTURE_SCALE * numpy.atleast_1d(halflight_radius).astype(numpy.float64), MIN_RADIUS)
+
+    good = numpy.isfinite(img)
+    if (mask is not None):
+        good &= (mask == 0)
+    py, px = numpy.nonzero(good)
+    values = img[good].astype(numpy.float64)
+    if (values.shape[0] < MIN_PIXELS):
+        return numpy.zeros(x.shape[0], dtype=GUESS_DTYPE)
+
+    for iteration in range(N_ITERATIONS):
+        guess = measure(px, py, values, x, y, radius)
+        grown = numpy.where(guess['valid'], numpy.maximum(radius, APERTURE_SCALE * guess['r90']), radius)
+        if (numpy.all(grown <= radius * 1.05)):
+            break
+        radius = grown
+    return guess
+
+
+def starting_values(guess):
+
+    # feed-me template values to replace, for one row returned by estimate()
+    if (guess is None or not guess['valid']):
+        return {}
+    return dict([(name, float(guess[name])) for name in
+                 ('halflight_radius', 'sersic_n', 'axis_ratio', 'position_angle')])
+
+
+if __name__ == "__main__":
+
+    # measure a source in a cutout: initial_guess.py cutout.fits x y r_50 [mask.fits]
+    import astropy.io.fits as pyfits
+    img = pyfits.getdata(sys.argv[1])
+    mask = pyfits.getdata(sys.argv[5]) if len(sys.argv) > 5 else None
+    guess = estimate(img, mask, float(sys.argv[2]), float(sys.argv[3]), float(sys.argv[4]))
+    for name, _ in GUESS_DTYPE:
+        print("%-18s %s" % (name, guess[name][0]))
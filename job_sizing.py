@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+#
+# Size of the cutout and of the convolution box of each GALFIT job.
+#
+# GALFIT's cost per iteration is set by the number of pixels in the fitting
+# region and by the FFTs over the convolution box (at the PSF's
+# supersampling). Both used to be fixed independently of the source: cutouts
+# of 3 FWHM_IMAGE around each source, which truncates extended low surface
+# brightness sources whose FWHM only measures their core, and a 100x100
+# convolution box, which is mostly empty for compact sources.
+#
+# With 'profile' sizing, both follow from the extent of the light profile,
+# the larger of KRON_SCALE Kron radii (KRON_RADIUS * A_IMAGE, if the catalog
+# has them) and RE_SCALE half-light radii:
+#
+#    - cutouts extend CUTOUT_SCALE times that extent around each source,
+#      for some sky around it, but at least MIN_HALF_SIZE pixels,
+#    - the convolution box covers the light profile plus the footprint of
+#      the PSF (in data pixels), but never more than the fitting region;
+#      for groups it covers the light profiles of all members.
+#
+# 'fixed' sizing keeps the old cutouts and convolution box.
+#
+
+import sys
+import numpy
+import astropy.io.fits as pyfits
+import astropy.table
+
+SIZINGS = ('profile', 'fixed')
+
+KRON_SCALE = 2.5
+RE_SCALE = 4.
+CUTOUT_SCALE = 1.5
+MIN_HALF_SIZE = 10
+
+# cutouts and convolution box with 'fixed' sizing
+FWHM_SCALE = 3
+FIXED_CONVOLUTION_BOX = 100
+
+
+def _column(catalog, name):
+    return numpy.nan_to_num(numpy.asarray(catalog[name], dtype=numpy.float64))
+
+
+def profile_extent(catalog):
+
+    # radius [pixels] that holds (nearly) all light of each source
+    extent = RE_SCALE * numpy.fabs(_column(catalog, 'FLUX_RADIUS_50'))
+    if ('KRON_RADIUS' in catalog.colnames and 'A_IMAGE' in catalog.colnames):
+        extent = numpy.maximum(extent, KRON_SCALE * _column(catalog, 'KRON_RADIUS') * _column(catalog, 'A_IMAGE'))
+    return extent
+
+
+def cutout_half_size(catalog, sizing='profile'):
+
+    # half the side length of the cutout around each source
+    if (sizing == 'fixed'):
+        return FWHM_SCALE * numpy.asarray(catalog['FWHM_IMAGE'], dtype=numpy.float64)
+    return numpy.maximum(CUTOUT_SCALE * profile_extent(catalog), MIN_HALF_SIZE)
+
+
+def psf_footprint(psf_file, psf_supersample=1.):
+
+    # (nx, ny) of the PSF in data pixels, (0, 0) without a PSF
+    if (psf_file is None):
+        return 0, 0
+    try:
+        header = pyfits.getheader(psf_file)
+        return [int(numpy.ceil(header[key] / float(psf_supersample))) for key in ('NAXIS1', 'NAXIS2')]
+    except (IOError, KeyError):
+        return 0, 0
+
+
+def convolution_box(region_nx, region_ny, extent, psf_nx, psf_ny, sizing='profile'):
+
+    # (nx, ny) of the convolution box for a fitting region, see above; extent None to cover the whole region
+    if (sizing == 'fixed'):
+        return FIXED_CONVOLUTION_BOX, FIXED_CONVOLUTION_BOX
+    if (extent is None):
+        return int(region_nx), int(region_ny)
+    light = 2 * int(numpy.ceil(extent))
+    return int(numpy.min([region_nx, numpy.max([psf_nx, light + psf_nx])])), \
+        int(numpy.min([region_ny, numpy.max([psf_ny, light + psf_ny])]))
+
+
+def fft_cost(box_nx, box_ny, psf_supersample=1.):
+
+    # operations of one FFT over the (supersampled) convolution box, N log2 N
+    n = numpy.asarray(box_nx, dtype=numpy.float64) * numpy.asarray(box_ny, dtype=numpy.float64) * \
+        numpy.asarray(psf_supersample, dtype=numpy.float64) ** 2
+    return n * numpy.log2(numpy.maximum(n, 2))
+
+
+def format_cost(npix, fft):
+
+    # one line summary of the pixel and FFT cost of a set of jobs
+    npix, fft = numpy.atleast_1d(npix), numpy.atleast_1d(fft)
+    if (npix.shape[0] == 0):
+        return "no jobs"
+    return "%d jobs, %.3g pixels (median %d), %.3g FFT operations (median %.3g)" % (
+        npix.shape[0], numpy.sum(npix), numpy.median(npix), numpy.sum(fft), numpy.median(fft))
+
+
+if __name__ == "__main__":
+
+    # compare both sizings for a catalog: job_sizing.py catalog [psf.fits [supersampling]]
+    catalog = astropy.table.Table.read(sys.argv[1])
+    psf_supersample = float(sys.argv[3]) if len(sys.argv) > 3 else 1.
+    psf_nx, psf_ny = psf_footprint(sys.argv[2] if len(sys.argv) > 2 else None, psf_supersample)
+    extent = profile_extent(catalog)
+    for sizing in SIZINGS:
+        region = numpy.floor(2 * cutout_half_size(catalog, sizing))
+        boxes = numpy.array([convolution_box(r, r, e, psf_nx, psf_ny, sizing) for r, e in zip(region, extent)])
+        print("%-8s %s" % (sizing, format_cost(region ** 2, fft_cost(boxes[:, 0], boxes[:, 1], psf_supersample))))
@@ -61,14 +61,51 @@ def plot_galfit_result(fits_fn, plot_fn, scaling_mode='asinh', badpixelmask=None
     img.transpose(Image.FLIP_TOP_BOTTOM).save(plot_fn)
     print("plot saved as %s" % (plot_fn))
 
+
+def plot_filename(fits_fn):
+    return fits_fn[:-5]+".png"
+
+
+def plot_is_current(fits_fn, plot_fn):
+
+    # a plot only needs to be redone if the fit was updated since
+    return (os.path.isfile(plot_fn) and
+            os.path.getmtime(plot_fn) >= os.path.getmtime(fits_fn))
+
+
+def parallel_plot_worker(plot_queue, niceness=0):
+
+    #
+    # Make plots for all GALFIT output files coming through the queue, until
+    # receiving a None token. Running at a lower priority keeps the plotting
+    # from slowing down the fits running at the same time.
+    #
+    if (niceness > 0):
+        os.nice(niceness)
+
+    while (True):
+        fits_fn = plot_queue.get()
+        if (fits_fn is None):
+            plot_queue.task_done()
+            break
+
+        plot_fn = plot_filename(fits_fn)
+        if (os.path.isfile(fits_fn) and not plot_is_current(fits_fn, plot_fn)):
+            try:
+                plot_galfit_result(fits_fn=fits_fn, plot_fn=plot_fn)
+            except:
+                print("Error while making plot for %s" % (fits_fn))
+        plot_queue.task_done()
+
+
 if __name__ == "__main__":
 
     for fn in sys.argv[1:]:
         print(fn)
-        out_fn = fn[:-5]+".png"
+        out_fn = plot_filename(fn)
         badpixelmask = fn[:-12]+".segm.fits"
 
-        if (not os.path.isfile(out_fn)):
+        if (not plot_is_current(fn, out_fn)):
             try:
                 plot_galfit_result(fn, out_fn, badpixelmask=badpixelmask)
             except:
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+#
+# Content-addressed store for PSF models. Every distinct PSF is kept exactly
+# once per store directory, under a name derived from a hash of its content,
+# so all feed-me files of an image (or of several images sharing the same
+# PSF) can refer to the same file instead of a private copy each.
+#
+
+import os
+import sys
+import hashlib
+import shutil
+import tempfile
+
+
+def psf_hash(psf_file, blocksize=1048576):
+
+    sha = hashlib.sha1()
+    with open(psf_file, "rb") as pf:
+        while (True):
+            block = pf.read(blocksize)
+            if (not block):
+                break
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def psf_store_name(psf_file):
+    return "psf.%s.fits" % (psf_hash(psf_file)[:16])
+
+
+def store_psf(psf_file, store_dir):
+
+    #
+    # Add the PSF to the store (unless it is already in there) and return the
+    # filename inside the store directory. Several writers may try to store
+    # the same PSF at the same time, so write to a temporary file and rename
+    # it into place, which is atomic on POSIX filesystems.
+    #
+    name = psf_store_name(psf_file)
+    stored_fn = os.path.join(store_dir, name)
+    if (not os.path.isfile(stored_fn)):
+        _fd, tmp_fn = tempfile.mkstemp(prefix=".psf.", dir=store_dir)
+        os.close(_fd)
+        shutil.copyfile(psf_file, tmp_fn)
+        os.replace(tmp_fn, stored_fn)
+        print("Added PSF %s to store as %s" % (psf_file, stored_fn))
+
+    return name
+
+
+def psf_payload_name(payload):
+    return "psf.%s.fits" % (hashlib.sha1(payload).hexdigest()[:16])
+
+
+def store_psf_payload(payload, store_dir):
+
+    # same as store_psf(), for a PSF model that only exists in memory (as FITS file content)
+    name = psf_payload_name(payload)
+    stored_fn = os.path.join(store_dir, name)
+    if (not os.path.isfile(stored_fn)):
+        _fd, tmp_fn = tempfile.mkstemp(prefix=".psf.", dir=store_dir)
+        with os.fdopen(_fd, "wb") as tf:
+            tf.write(payload)
+        os.replace(tmp_fn, stored_fn)
+        print("Added PSF to store as %s" % (stored_fn))
+
+    return name
+
+
+if __name__ == "__main__":
+
+    store_dir = sys.argv[1]
+    for psf_file in sys.argv[2:]:
+        print("%s --> %s" % (psf_file, store_psf(psf_file, store_dir)))
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+#
+# Progress and throughput metrics for auto_galfit runs.
+#
+# Feed-me writers and fitting workers collect one event per job (feed-me
+# write time, queue wait, fit wall time, return code, output size) and hand
+# them to the main process in batches, together with their updates of the
+# shared progress counters. The main process appends all events to a
+# JSON-lines file and regularly adds a snapshot with the throughput, the
+# runtime percentiles and an ETA derived from the observed runtimes.
+#
+
+import os
+import sys
+import json
+import queue
+import time
+import numpy
+
+import galfit_scheduler
+
+PERCENTILES = (50, 95, 99)
+
+
+def counter_batch(counters, event_queue=None, max_pending=25, max_age=2.):
+
+    #
+    # Collects increments for a list of multiprocessing.Value counters (and
+    # the matching job events), so the shared locks are only taken once per
+    # batch instead of once per job
+    #
+    return dict(counters=counters, event_queue=event_queue,
+                increments=[0] * len(counters), events=[],
+                n_pending=0, last_flush=time.time(),
+                max_pending=max_pending, max_age=max_age)
+
+
+def count(batch, increments, event=None):
+
+    for i, increment in enumerate(increments):
+        batch['increments'][i] += increment
+    if (event is not None and batch['event_queue'] is not None):
+        batch['events'].append(event)
+    batch['n_pending'] += 1
+    flush_counters(batch)
+
+
+def flush_counters(batch, force=False):
+
+    if (batch['n_pending'] == 0 or
+            (not force and batch['n_pending'] < batch['max_pending'] and
+             time.time() - batch['last_flush'] < batch['max_age'])):
+        return
+
+    # hand over the events first, so they are available once the counters show the jobs as done
+    if (batch['events']):
+        batch['event_queue'].put(batch['events'])
+    for counter, increment in zip(batch['counters'], batch['increments']):
+        if (counter is not None and increment != 0):
+            with counter.get_lock():
+                counter.value += increment
+
+    batch['increments'] = [0] * len(batch['counters'])
+    batch['events'] = []
+    batch['n_pending'] = 0
+    batch['last_flush'] = time.time()
+
+
+def job_event(event, job, **kwargs):
+
+    record = dict(event=event, time=time.time(), image=job['image'], src_id=int(job['src_id']))
+    record.update(kwargs)
+    return record
+
+
+def output_size(fn):
+    return os.path.getsize(fn) if os.path.isfile(fn) else 0
+
+
+def new_run_stats(n_procs):
+    return dict(n_procs=n_procs, start_time=time.time(), runtimes=[], queue_waits=[],
+                write_times=[], n_failed=0, n_skipped=0, n_retries=0, n_coarse=0)
+
+
+def add_event(stats, event):
+
+    if (event['event'] == 'write'):
+        stats['write_times'].append(event['write_time'])
+    elif (event['event'] == 'fit'):
+        stats['runtimes'].append(event['runtime'])
+        stats['queue_waits'].append(event['queue_wait'])
+        if (event.get('stage') == 'coarse'):
+            # first stage of a coarse-to-fine fit
+            stats['n_coarse'] += 1
+        elif (event.get('retry_strategy') is not None):
+            # failed, but not given up on yet
+            stats['n_retries'] += 1
+        elif (event['returncode'] != 0):
+            stats['n_failed'] += 1
+    elif (event['event'] == 'skip'):
+        stats['n_skipped'] += 1
+
+
+def estimate_remaining_time(runtimes, n_remaining, n_procs):
+
+    #
+    # Draw the outstanding jobs from the observed runtime distribution (at
+    # evenly spaced quantiles, to keep it deterministic) and simulate their
+    # dispatch onto the workers, so long tails show up in the ETA
+    #
+    if (n_remaining <= 0):
+        return 0.
+    if (len(runtimes) == 0):
+        return None
+    quantiles = (numpy.arange(n_remaining) + 0.5) / n_remaining
+    return float(galfit_scheduler.expected_walltime(
+        numpy.quantile(runtimes, quantiles), n_procs))
+
+
+def snapshot(stats, n_complete, n_total, n_queued):
+
+    elapsed = time.time() - stats['start_time']
+    runtimes = numpy.array(stats['runtimes'])
+    record = dict(
+        event='snapshot',
+        time=time.time(),
+        elapsed=elapsed,
+        n_complete=n_complete,
+        n_total=n_total,
+        n_queued=n_queued,
+        n_fitted=len(runtimes),
+        n_failed=stats['n_failed'],
+        n_skipped=stats['n_skipped'],
+        n_retries=stats['n_retries'],
+        n_coarse=stats['n_coarse'],
+        throughput=n_complete / elapsed if elapsed > 0 else 0.,
+        eta=estimate_remaining_time(runtimes, n_queued, stats['n_procs']),
+    )
+    for name, values in (('runtime', runtimes),
+                         ('queue_wait', numpy.array(stats['queue_waits'])),
+                         ('write_time', numpy.array(stats['write_times']))):
+        for p in PERCENTILES:
+            record['%s_p%d' % (name, p)] = float(numpy.percentile(values, p)) if len(values) > 0 else None
+    return record
+
+
+def open_metrics_log(metrics_fn):
+    return open(metrics_fn, "a")
+
+
+def write_events(metrics_log, events):
+
+    if (metrics_log is None):
+        return
+    for event in events:
+        metrics_log.write(json.dumps(event) + "\n")
+    metrics_log.flush()
+
+
+def drain_events(event_queue, stats, metrics_log, timeout=None):
+
+    #
+    # Collect all event batches available right now (or, with a timeout,
+    # until no new events arrive for that long)
+    #
+    n_events = 0
+    while (True):
+        try:
+            if (timeout is None):
+                events = event_queue.get(block=False)
+            else:
+                events = event_queue.get(block=True, timeout=timeout)
+        except queue.Empty:
+            break
+        for event in events:
+            add_event(stats, event)
+        write_events(metrics_log, events)
+        n_events += len(events)
+    return n_events
+
+
+def format_snapshot(record):
+
+    def _fmt(value, unit="s"):
+        return "n/a" if value is None else "%.1f%s" % (value, unit)
+
+    return "%d/%d done (%d failed, %d retries), %.2f jobs/s, runtime p50/p95/p99 = %s/%s/%s, queue wait p95 = %s, ETA %s" % (
+        record['n_complete'], record['n_total'], record['n_failed'], record.get('n_retries', 0), record['throughput'],
+        _fmt(record['runtime_p50']), _fmt(record['runtime_p95']), _fmt(record['runtime_p99']),
+        _fmt(record['queue_wait_p95']), _fmt(record['eta']))
+
+
+if __name__ == "__main__":
+
+    # show the last snapshot of a metrics file: run_metrics.py metrics.jsonl
+    last = None
+    with open(sys.argv[1], "r") as mf:
+        for line in mf:
+            record = json.loads(line)
+            if (record['event'] == 'snapshot'):
+                last = record
+    if (last is None):
+        print("No snapshot in %s" % (sys.argv[1]))
+    else:
+        print(format_snapshot(last))
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+#
+# Index of all objects in a segmentation map.
+#
+# The index is built once per image, in a single pass over the map (strip by
+# strip, so the full map never needs to be in memory), and holds the
+# bounding box and pixel count of every object. With that, masks for a
+# cutout only need to read the part of the map actually covered by other
+# objects (and nothing at all if there are none), and the pixels of a single
+# object can be found within its own extent instead of a fixed-size box.
+#
+# Boxes are (x1, x2, y1, y2), 0-based with x2 and y2 exclusive, like cutout
+# boxes everywhere else.
+#
+
+import sys
+import numpy
+import scipy.ndimage
+
+import cutouts
+
+INDEX_DTYPE = [('label', 'i8'), ('x1', 'i8'), ('x2', 'i8'), ('y1', 'i8'), ('y2', 'i8'), ('npix', 'i8')]
+
+
+def compact_dtype(max_label):
+
+    # smallest integer type that holds all labels (and that FITS supports)
+    if (max_label <= numpy.iinfo(numpy.uint8).max):
+        return numpy.uint8
+    if (max_label <= numpy.iinfo(numpy.int16).max):
+        return numpy.int16
+    return numpy.int32
+
+
+def build_index(hdulist, ext=0, strip_rows=1024):
+
+    hdu = hdulist[ext]
+    nx, ny = hdu.header['NAXIS1'], hdu.header['NAXIS2']
+
+    # per label; grown as higher labels turn up
+    x1 = numpy.zeros(0, dtype=numpy.int64)
+    x2, y1, y2, npix = x1.copy(), x1.copy(), x1.copy(), x1.copy()
+    for row in range(0, ny, strip_rows):
+        # labels are kept in the map's own integer type, not copied into a wider one
+        segm = cutouts.read_cutout(hdulist, 0, nx, row, min(row + strip_rows, ny), ext)
+        if (not numpy.issubdtype(segm.dtype, numpy.integer)):
+            segm = segm.astype(compact_dtype(numpy.nanmax(segm, initial=0)))
+        if (numpy.issubdtype(segm.dtype, numpy.signedinteger)):
+            segm[segm < 0] = 0
+
+        slices = scipy.ndimage.find_objects(segm)
+        if (len(slices) + 1 > npix.shape[0]):
+            n_new = len(slices) + 1 - npix.shape[0]
+            x1 = numpy.append(x1, numpy.full(n_new, nx))
+            x2 = numpy.append(x2, numpy.zeros(n_new, dtype=numpy.int64))
+            y1 = numpy.append(y1, numpy.full(n_new, ny))
+            y2 = numpy.append(y2, numpy.zeros(n_new, dtype=numpy.int64))
+            npix = numpy.append(npix, numpy.zeros(n_new, dtype=numpy.int64))
+
+        for label, box in enumerate(slices, 1):
+            if (box is None):
+                continue
+            sy, sx = box
+            npix[label] += numpy.count_nonzero(segm[box] == label)
+            x1[label] = min(x1[label], sx.start)
+            x2[label] = max(x2[label], sx.stop)
+            y1[label] = min(y1[label], sy.start + row)
+            y2[label] = max(y2[label], sy.stop + row)
+
+    labels = numpy.flatnonzero(npix[1:]) + 1 if npix.shape[0] > 1 else numpy.zeros(0, dtype=numpy.int64)
+    objects = numpy.zeros(labels.shape[0], dtype=INDEX_DTYPE)
+    objects['label'] = labels
+    for name, values in (('x1', x1), ('x2', x2), ('y1', y1), ('y2', y2), ('npix', npix)):
+        objects[name] = values[labels]
+
+    # row in objects for each label, -1 if there is no such object
+    rows = numpy.full(npix.shape[0], -1, dtype=numpy.int64)
+    rows[labels] = numpy.arange(labels.shape[0])
+    max_label = int(labels[-1]) if labels.shape[0] > 0 else 0
+    return dict(objects=objects, rows=rows, shape=(ny, nx), dtype=compact_dtype(max_label))
+
+
+def object_box(index, label):
+
+    label = int(label)
+    if (label <= 0 or label >= index['rows'].shape[0] or index['rows'][label] < 0):
+        return None
+    obj = index['objects'][index['rows'][label]]
+    return int(obj['x1']), int(obj['x2']), int(obj['y1']), int(obj['y2'])
+
+
+def overlapping(index, x1, x2, y1, y2):
+
+    # labels of all objects whose bounding box overlaps the given box
+    objects = index['objects']
+    overlap = (objects['x1'] < x2) & (x1 < objects['x2']) & (objects['y1'] < y2) & (y1 < objects['y2'])
+    return objects['label'][overlap]
+
+
+def cutout_mask(index, hdulist, x1, x2, y1, y2, keep=(), ext=0):
+
+    #
+    # The segmentation map in a cutout, with the objects in keep (the ones
+    # being fitted) removed. Only the part of the cutout covered by other
+    # objects is read from the map.
+    #
+    mask = numpy.zeros((y2 - y1, x2 - x1), dtype=index['dtype'])
+    labels = overlapping(index, x1, x2, y1, y2)
+    labels = labels[~numpy.isin(labels, numpy.asarray(keep, dtype=numpy.int64))]
+    if (labels.shape[0] == 0):
+        return mask
+
+    objects = index['objects'][index['rows'][labels]]
+    rx1, rx2 = max(x1, int(numpy.min(objects['x1']))), min(x2, int(numpy.max(objects['x2'])))
+    ry1, ry2 = max(y1, int(numpy.min(objects['y1']))), min(y2, int(numpy.max(objects['y2'])))
+    segm = cutouts.read_cutout(hdulist, rx1, rx2, ry1, ry2, ext)
+    segm[numpy.isin(segm, keep)] = 0
+    segm[segm < 0] = 0
+    mask[ry1 - y1:ry2 - y1, rx1 - x1:rx2 - x1] = segm
+    return mask
+
+
+def object_pixels(index, hdulist, label, ext=0):
+
+    # bounding box and pixel mask of a single object, read from within its own extent
+    box = object_box(index, label)
+    if (box is None):
+        return None, None
+    x1, x2, y1, y2 = box
+    return box, (cutouts.read_cutout(hdulist, x1, x2, y1, y2, ext) == int(label))
+
+
+if __name__ == "__main__":
+
+    # list all objects in a segmentation map: segmentation_index.py image.segments
+    hdulist = cutouts.open_frame(sys.argv[1])
+    index = build_index(hdulist)
+    for obj in index['objects']:
+        print("%6d  %5d %5d %5d %5d  %8d" % tuple(obj))
+    print("%d objects, labels stored as %s" % (index['objects'].shape[0], numpy.dtype(index['dtype']).name))
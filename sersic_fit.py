@@ -0,0 +1,540 @@
+#!/usr/bin/env python3
+
+#
+# In-process fitting of a single Sersic profile plus a flat sky, as an
+# alternative to running GALFIT as a subprocess for the simple
+# sersic+sky model written by auto_galfit.py.
+#
+# The fitter reads the same feed-me files, cutouts, sigma images, masks,
+# PSF models and constraint files as GALFIT, and writes a GALFIT-style
+# output block (input, model and residual image, with the fit results in
+# the header of the model extension), so everything downstream, e.g.
+# combine_sextractor_galfit.py, works unchanged.
+#
+# Many cutouts are fit at once: all cutouts in a batch are padded to the
+# same shape, and the model, the PSF convolution (via FFT) and a
+# Levenberg-Marquardt minimization are evaluated for the full batch with
+# vectorized numpy operations.
+#
+
+import os
+import sys
+import time
+import hashlib
+import numpy
+import scipy.fft
+import scipy.special
+import astropy.io.fits as pyfits
+
+# parameters of the fit, in order
+PARAMETERS = ['XC', 'YC', 'MAG', 'RE', 'N', 'AR', 'PA', 'SKY']
+N_PARAMS = len(PARAMETERS)
+
+# names GALFIT uses for these parameters in constraint files
+CONSTRAINT_NAMES = {'x': 0, 'y': 1, 'mag': 2, 're': 3, 'n': 4, 'q': 5, 'pa': 6}
+
+# hard limits to keep the model well defined
+LOWER_LIMITS = numpy.array([-numpy.inf, -numpy.inf, -numpy.inf, 0.1, 0.2, 0.02, -numpy.inf, -numpy.inf])
+UPPER_LIMITS = numpy.array([numpy.inf, numpy.inf, numpy.inf, numpy.inf, 10., 1., numpy.inf, numpy.inf])
+
+# largest jacobian (cutouts x pixels x parameters) to hold in memory at once
+MAX_JACOBIAN_SIZE = 2**23
+
+
+def read_feedme(feedme_fn):
+
+    #
+    # Returns the header options (keyed by their letter) and a list of all
+    # components, each with its parameters as (values, fit-flags)
+    #
+    options = {}
+    components = []
+    with open(feedme_fn, "r") as ff:
+        for line in ff:
+            line = line.split("#")[0].strip()
+            if (line.find(")") <= 0):
+                continue
+            key, value = line.split(")", 1)
+            key = key.strip()
+            items = value.split()
+            if (key.isalpha()):
+                if (not components):
+                    options[key] = value.strip()
+                continue
+            if (key == "0"):
+                components.append(dict(type=items[0], params={}))
+                continue
+            if (not components):
+                continue
+            n_values = 2 if key == "1" and components[-1]['type'] != "sky" else 1
+            values = [float(v) for v in items[:n_values]]
+            flags = [int(float(v)) for v in items[n_values:2*n_values]]
+            components[-1]['params'][int(key)] = (values, flags)
+
+    return options, components
+
+
+def read_constraints(constraints_fn):
+
+    # only the relative-range form (e.g. "1  x  -3.0 3.0") is supported
+    constraints = []
+    if (constraints_fn is None or not os.path.isfile(constraints_fn)):
+        return constraints
+    with open(constraints_fn, "r") as cf:
+        for line in cf:
+            items = line.split("#")[0].split()
+            if (len(items) != 4 or items[1] not in CONSTRAINT_NAMES):
+                continue
+            try:
+                constraints.append((int(items[0]), CONSTRAINT_NAMES[items[1]],
+                                    float(items[2]), float(items[3])))
+            except ValueError:
+                continue
+    return constraints
+
+
+def _filename(option, directory):
+    if (option is None or option.split()[0].lower() == "none" or option.strip() == ""):
+        return None
+    return os.path.join(directory, option.split()[0])
+
+
+def fit_region(option, shape):
+
+    #
+    # The fitting region (H, 1-based and inclusive as in GALFIT) as a slice
+    # of the cutout, and the offset of its first pixel
+    #
+    ny, nx = shape
+    x1, x2, y1, y2 = 1, nx, 1, ny
+    if (option is not None):
+        x1, x2, y1, y2 = [int(float(v)) for v in option.split()[:4]]
+    x1, x2, y1, y2 = max(1, x1), min(nx, x2), max(1, y1), min(ny, y2)
+    if (x2 < x1 or y2 < y1):
+        raise ValueError("Empty fitting region (%s)" % (option))
+    return (slice(y1 - 1, y2), slice(x1 - 1, x2)), (x1 - 1, y1 - 1)
+
+
+def load_problem(feedme_fn, directory=None):
+
+    #
+    # Collect everything needed to fit one feed-me file. Only the fitting
+    # region (H) is fit; positions in the problem are relative to it.
+    #
+    if (directory is None):
+        directory, _ = os.path.split(feedme_fn)
+    options, components = read_feedme(feedme_fn)
+
+    types = [c['type'] for c in components]
+    if (types != ['sersic', 'sky']):
+        raise ValueError("Unsupported model (%s) in %s" % (",".join(types), feedme_fn))
+
+    img_hdu = pyfits.open(_filename(options['A'], directory))
+    data = img_hdu[0].data.astype(numpy.float64)
+    img_header = img_hdu[0].header
+    img_hdu.close()
+
+    sigma_fn = _filename(options.get('C'), directory)
+    if (sigma_fn is not None and os.path.isfile(sigma_fn)):
+        sigma = pyfits.getdata(sigma_fn).astype(numpy.float64)
+    else:
+        # no sigma image, use the pixel-to-pixel scatter of the data
+        _med = numpy.nanmedian(data)
+        sigma = numpy.full_like(data, 1.4826 * numpy.nanmedian(numpy.fabs(data - _med)))
+
+    good = numpy.isfinite(data) & numpy.isfinite(sigma) & (sigma > 0)
+    bpm_fn = _filename(options.get('F'), directory)
+    if (bpm_fn is not None and os.path.isfile(bpm_fn)):
+        good &= (pyfits.getdata(bpm_fn) == 0)
+
+    region, offset = fit_region(options.get('H'), data.shape)
+    data, sigma, good = data[region], sigma[region], good[region]
+
+    psf = None
+    psf_key = None
+    psf_fn = _filename(options.get('D'), directory)
+    if (psf_fn is not None and os.path.isfile(psf_fn)):
+        psf_supersample = int(float(options.get('E', "1").split()[0]))
+        psf = rebin_psf(pyfits.getdata(psf_fn).astype(numpy.float64), psf_supersample)
+        # cutouts are only fit together if their PSFs are identical
+        psf_key = (psf.shape, hashlib.sha1(psf.tobytes()).hexdigest())
+
+    sersic = components[0]['params']
+    sky = components[1]['params']
+    values = [sersic[1][0][0], sersic[1][0][1], sersic[3][0][0], sersic[4][0][0],
+              sersic[5][0][0], sersic[9][0][0], sersic[10][0][0], sky[1][0][0]]
+    flags = [sersic[1][1][0], sersic[1][1][1], sersic[3][1][0], sersic[4][1][0],
+             sersic[5][1][0], sersic[9][1][0], sersic[10][1][0], sky[1][1][0]]
+
+    lower = LOWER_LIMITS.copy()
+    upper = UPPER_LIMITS.copy()
+    for (component, param, low, high) in read_constraints(_filename(options.get('G'), directory)):
+        if (component == 1):
+            lower[param] = numpy.max([lower[param], values[param] + low])
+            upper[param] = numpy.min([upper[param], values[param] + high])
+    values = numpy.array(values, dtype=numpy.float64)
+    for i in (0, 1):
+        values[i] -= offset[i]
+        lower[i] -= offset[i]
+        upper[i] -= offset[i]
+
+    return dict(
+        feedme=feedme_fn,
+        directory=directory,
+        output=os.path.join(directory, options['B'].split()[0]),
+        data=data, sigma=sigma, good=good,
+        header=img_header,
+        offset=offset,
+        psf=psf, psf_key=psf_key,
+        magzero=float(options.get('J', "0").split()[0]),
+        values=numpy.clip(values, lower, upper),
+        free=(numpy.array(flags) != 0),
+        lower=lower, upper=upper,
+    )
+
+
+def rebin_psf(psf, supersample):
+
+    # bring a supersampled PSF to the pixel scale of the data
+    if (supersample > 1):
+        ny = (psf.shape[0] // supersample) * supersample
+        nx = (psf.shape[1] // supersample) * supersample
+        psf = psf[:ny, :nx].reshape(
+            ny // supersample, supersample, nx // supersample, supersample).sum(axis=(1, 3))
+    return psf / numpy.sum(psf)
+
+
+def sersic_bn(n):
+    return scipy.special.gammaincinv(2. * n, 0.5)
+
+
+def sersic_model(params, yy, xx, magzero):
+
+    #
+    # params has shape (batch, N_PARAMS); returns the un-convolved galaxy
+    # model (without sky) for all cutouts at once. Coordinates are 1-based
+    # and the position angle runs from up (+y) towards left (-x), as in GALFIT.
+    #
+    p = params[:, :, None, None]
+    xc, yc, mag, re, n, q, pa = p[:, 0], p[:, 1], p[:, 2], p[:, 3], p[:, 4], p[:, 5], p[:, 6]
+
+    theta = numpy.radians(pa)
+    dx = xx - xc
+    dy = yy - yc
+    r_major = -dx * numpy.sin(theta) + dy * numpy.cos(theta)
+    r_minor = dx * numpy.cos(theta) + dy * numpy.sin(theta)
+    r = numpy.sqrt(r_major**2 + (r_minor / q)**2)
+
+    bn = sersic_bn(n)
+    total_flux = numpy.power(10., -0.4 * (mag - magzero))
+    norm = 2. * numpy.pi * re**2 * numpy.exp(bn) * n * numpy.power(bn, -2. * n) * \
+           scipy.special.gamma(2. * n) * q
+    i_e = total_flux / norm
+
+    return i_e * numpy.exp(-bn * (numpy.power(r / re, 1. / n) - 1.))
+
+
+def make_convolver(psf, shape):
+
+    #
+    # Returns a function to convolve a full batch of images of the given
+    # shape with the same PSF, using FFTs
+    #
+    if (psf is None):
+        return lambda images: images
+
+    fft_shape = [scipy.fft.next_fast_len(shape[i] + psf.shape[i] - 1, real=True) for i in range(2)]
+    psf_fft = scipy.fft.rfft2(psf, s=fft_shape)
+    y0, x0 = psf.shape[0] // 2, psf.shape[1] // 2
+
+    def convolve(images):
+        conv = scipy.fft.irfft2(scipy.fft.rfft2(images, s=fft_shape) * psf_fft, s=fft_shape)
+        return conv[:, y0:y0 + shape[0], x0:x0 + shape[1]]
+
+    return convolve
+
+
+def fit_batch(problems, max_iterations=100, tolerance=1.e-5, deadlines=None):
+
+    #
+    # Fit all problems (all sharing the same PSF) simultaneously. Cutouts are
+    # padded to a common shape, with the padding excluded from the fit.
+    # Problems still iterating at their deadline (time.time() value, or
+    # numpy.inf) stop there, and are reported as timed out.
+    #
+    if (len(set([p['psf_key'] for p in problems])) > 1):
+        raise ValueError("Cutouts with different PSFs in one batch")
+    n_batch = len(problems)
+    ny = numpy.max([p['data'].shape[0] for p in problems])
+    nx = numpy.max([p['data'].shape[1] for p in problems])
+
+    data = numpy.zeros((n_batch, ny, nx))
+    weight = numpy.zeros((n_batch, ny, nx))
+    for i, p in enumerate(problems):
+        sy, sx = p['data'].shape
+        data[i, :sy, :sx] = numpy.where(p['good'], p['data'], 0.)
+        weight[i, :sy, :sx] = numpy.where(p['good'], 1. / numpy.where(p['good'], p['sigma'], 1.), 0.)
+
+    params = numpy.array([p['values'] for p in problems])
+    free = numpy.array([p['free'] for p in problems])
+    lower = numpy.array([p['lower'] for p in problems])
+    upper = numpy.array([p['upper'] for p in problems])
+    magzero = numpy.array([p['magzero'] for p in problems])[:, None, None]
+
+    yy, xx = numpy.mgrid[1:ny+1, 1:nx+1].astype(numpy.float64)
+    convolve = make_convolver(problems[0]['psf'], (ny, nx))
+
+    def model(p, chunk=slice(None)):
+        return convolve(sersic_model(p, yy, xx, magzero[chunk])) + p[:, 7, None, None]
+
+    def chi2(m):
+        return numpy.sum(((data - m) * weight)**2, axis=(1, 2))
+
+    # finite-difference step sizes for each parameter, the sky's scaled by the typical noise
+    sky_step = 1.e-3 * numpy.nanmedian(numpy.where(weight > 0, 1. / numpy.where(weight > 0, weight, 1.), numpy.nan),
+                                       axis=(1, 2))
+
+    def steps(p, chunk):
+        h = numpy.empty_like(p)
+        h[:, 0:2] = 0.01
+        h[:, 2] = 0.001
+        h[:, 3] = 1.e-3 * numpy.fabs(p[:, 3]) + 1.e-4
+        h[:, 4] = 1.e-3 * numpy.fabs(p[:, 4]) + 1.e-4
+        h[:, 5] = 1.e-3
+        h[:, 6] = 0.05
+        h[:, 7] = sky_step[chunk]
+        return numpy.nan_to_num(h, nan=1.e-3)
+
+    def jacobian(p, m0, chunk):
+        J = numpy.zeros((p.shape[0], ny * nx, N_PARAMS))
+        h = steps(p, chunk)
+        for k in range(N_PARAMS):
+            if (not numpy.any(free[chunk, k])):
+                continue
+            pk = p.copy()
+            pk[:, k] += h[:, k]
+            J[:, :, k] = (((model(pk, chunk) - m0) / h[:, k, None, None]) * weight[chunk]).reshape(p.shape[0], -1)
+        return J * free[chunk, None, :]
+
+    # the normal equations J^T J and J^T r, building the jacobian a few cutouts at a time
+    chunk_size = int(numpy.max([1, MAX_JACOBIAN_SIZE // (ny * nx * N_PARAMS)]))
+
+    def normal_equations(p, m):
+        A = numpy.zeros((n_batch, N_PARAMS, N_PARAMS))
+        g = numpy.zeros((n_batch, N_PARAMS))
+        for start in range(0, n_batch, chunk_size):
+            chunk = slice(start, start + chunk_size)
+            J = jacobian(p[chunk], m[chunk], chunk)
+            r = ((data[chunk] - m[chunk]) * weight[chunk]).reshape(J.shape[0], -1)
+            A[chunk] = numpy.einsum('bnp,bnq->bpq', J, J)
+            g[chunk] = numpy.einsum('bnp,bn->bp', J, r)
+        return A, g
+
+    #
+    # Catalog magnitudes can be far off, so start from the linear best-fit
+    # flux and sky level for the initial shape of each galaxy
+    #
+    unit = params.copy()
+    unit[:, 2] = magzero[:, 0, 0]
+    t = convolve(sersic_model(unit, yy, xx, magzero))
+    w2 = weight**2
+    s_tt, s_t, s_1 = numpy.sum(w2 * t * t, axis=(1, 2)), numpy.sum(w2 * t, axis=(1, 2)), numpy.sum(w2, axis=(1, 2))
+    s_td, s_d = numpy.sum(w2 * t * data, axis=(1, 2)), numpy.sum(w2 * data, axis=(1, 2))
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        det = s_tt * s_1 - s_t**2
+        amplitude = numpy.where(free[:, 7], (s_td * s_1 - s_t * s_d) / det, (s_td - params[:, 7] * s_t) / s_tt)
+        sky = (s_d - amplitude * s_t) / s_1
+        linear_mag = magzero[:, 0, 0] - 2.5 * numpy.log10(amplitude)
+    use_linear = free[:, 2] & numpy.isfinite(linear_mag) & (amplitude > 0)
+    params[:, 2] = numpy.where(use_linear, numpy.clip(linear_mag, lower[:, 2], upper[:, 2]), params[:, 2])
+    params[:, 7] = numpy.where(use_linear & free[:, 7], sky, params[:, 7])
+
+    m = model(params)
+    current_chi2 = chi2(m)
+    lam = numpy.full(n_batch, 1.e-3)
+    converged = numpy.zeros(n_batch, dtype=bool)
+    n_iterations = numpy.zeros(n_batch, dtype=int)
+    timed_out = numpy.zeros(n_batch, dtype=bool)
+    if (deadlines is None):
+        deadlines = numpy.full(n_batch, numpy.inf)
+
+    for iteration in range(max_iterations):
+        timed_out |= ~converged & (time.time() > deadlines)
+        if (numpy.all(converged | timed_out)):
+            break
+        A, g = normal_equations(params, m)
+
+        # fixed parameters get a dummy diagonal so the system stays solvable
+        diag = numpy.diagonal(A, axis1=1, axis2=2).copy()
+        diag[diag <= 0] = 1.
+        damped = A + (lam[:, None] * diag)[:, :, None] * numpy.eye(N_PARAMS)[None, :, :]
+        damped[~free] = 0.
+        damped[:, numpy.arange(N_PARAMS), numpy.arange(N_PARAMS)] += ~free
+        delta = numpy.linalg.solve(damped, g[:, :, None])[:, :, 0]
+
+        trial = numpy.where(free, numpy.clip(params + delta, lower, upper), params)
+        # position angles are only defined modulo 180 degrees
+        trial[:, 6] = numpy.where(free[:, 6] & numpy.isinf(upper[:, 6]),
+                                  numpy.mod(trial[:, 6] + 90., 180.) - 90., trial[:, 6])
+        trial_m = model(trial)
+        trial_chi2 = chi2(trial_m)
+
+        improved = (trial_chi2 < current_chi2) & ~converged & ~timed_out
+        small_change = (current_chi2 - trial_chi2) < tolerance * current_chi2
+        converged |= (improved & small_change) | (lam > 1.e8)
+
+        params[improved] = trial[improved]
+        m[improved] = trial_m[improved]
+        current_chi2[improved] = trial_chi2[improved]
+        lam = numpy.where(improved, lam / 10., lam * 10.)
+        n_iterations[~(converged | timed_out)] += 1
+
+    #
+    # Uncertainties from the covariance matrix at the best-fit solution
+    #
+    A, _ = normal_equations(params, m)
+    A[:, numpy.arange(N_PARAMS), numpy.arange(N_PARAMS)] += ~free
+    try:
+        covariance = numpy.linalg.inv(A)
+        errors = numpy.sqrt(numpy.fabs(numpy.diagonal(covariance, axis1=1, axis2=2)))
+    except numpy.linalg.LinAlgError:
+        errors = numpy.full_like(params, numpy.nan)
+    errors[~free] = 0.
+
+    results = []
+    for i, p in enumerate(problems):
+        sy, sx = p['data'].shape
+        n_good = numpy.sum(p['good'])
+        n_free = numpy.sum(p['free'])
+        ndof = int(numpy.max([1, n_good - n_free]))
+        at_limit = free[i] & ((params[i] <= lower[i]) | (params[i] >= upper[i]))
+        results.append(dict(
+            values=params[i], errors=errors[i], free=free[i], at_limit=at_limit,
+            model=m[i, :sy, :sx],
+            chisq=float(current_chi2[i]), ndof=ndof, nfree=int(n_free),
+            nfix=int(N_PARAMS - n_free),
+            chi2nu=float(current_chi2[i] / ndof),
+            iterations=int(n_iterations[i]),
+            converged=bool(converged[i]),
+            timed_out=bool(timed_out[i]),
+        ))
+    return results
+
+
+def format_result(value, error, free, at_limit):
+
+    # same notation as GALFIT: fixed values in [], problematic ones in **
+    if (not free):
+        return "[%.4f]" % (value)
+    if (at_limit or not numpy.isfinite(error)):
+        return "*%.4f* +/- *%.4f*" % (value, error)
+    return "%.4f +/- %.4f" % (value, error)
+
+
+def write_output(problem, result):
+
+    # as GALFIT, only the fitting region is written, with positions relative to the full cutout
+    ny, nx = problem['data'].shape
+    x0, y0 = problem['offset']
+    values = result['values'].copy()
+    values[0] += x0
+    values[1] += y0
+
+    model_hdr = pyfits.Header()
+    model_hdr['OBJECT'] = 'model'
+    model_hdr['INITFILE'] = os.path.split(problem['feedme'])[1]
+    model_hdr['FITSECT'] = "[%d:%d,%d:%d]" % (x0 + 1, x0 + nx, y0 + 1, y0 + ny)
+    model_hdr['MAGZPT'] = problem['magzero']
+    model_hdr['BACKEND'] = 'sersic_fit'
+    model_hdr['COMP_1'] = 'sersic'
+    for k, name in enumerate(PARAMETERS[:7]):
+        model_hdr['1_%s' % (name)] = format_result(
+            values[k], result['errors'][k], result['free'][k], result['at_limit'][k])
+    model_hdr['COMP_2'] = 'sky'
+    model_hdr['2_XC'] = "[%.4f]" % (x0 + (nx + 1) / 2.)
+    model_hdr['2_YC'] = "[%.4f]" % (y0 + (ny + 1) / 2.)
+    model_hdr['2_SKY'] = format_result(values[7], result['errors'][7], result['free'][7], False)
+    model_hdr['2_DSDX'] = "[%.4f]" % (0.)
+    model_hdr['2_DSDY'] = "[%.4f]" % (0.)
+    model_hdr['CHISQ'] = result['chisq']
+    model_hdr['NDOF'] = result['ndof']
+    model_hdr['NFREE'] = result['nfree']
+    model_hdr['NFIX'] = result['nfix']
+    model_hdr['CHI2NU'] = result['chi2nu']
+    model_hdr['NITER'] = result['iterations']
+
+    hdulist = pyfits.HDUList([
+        pyfits.PrimaryHDU(),
+        pyfits.ImageHDU(data=problem['data'].astype(numpy.float32), header=problem['header']),
+        pyfits.ImageHDU(data=result['model'].astype(numpy.float32), header=model_hdr),
+        pyfits.ImageHDU(data=(problem['data'] - result['model']).astype(numpy.float32)),
+    ])
+    hdulist.writeto(problem['output'], overwrite=True)
+
+
+def batch_key(problem, bin_size=32):
+
+    #
+    # Cutouts are only batched with others of similar size (so padding does
+    # not waste too much time) and with exactly the same PSF
+    #
+    ny, nx = problem['data'].shape
+    return ((ny + bin_size - 1) // bin_size, (nx + bin_size - 1) // bin_size, problem['psf_key'])
+
+
+def fit_feedme_files(feedme_list, max_iterations=100, timeouts=None):
+
+    #
+    # Fit all given feed-me files (each a tuple of feed-me filename and the
+    # directory holding its input files), batching similar cutouts.
+    # timeouts gives the time limit in seconds for each file (None: no limit),
+    # counted from the start of its batch; fits still running then fail
+    # like a GALFIT run that timed out.
+    # Returns one status dictionary per feed-me file, in the same order.
+    #
+    if (timeouts is None):
+        timeouts = [None] * len(feedme_list)
+    status = [None] * len(feedme_list)
+    batches = {}
+    for i, (feedme_fn, directory) in enumerate(feedme_list):
+        try:
+            problem = load_problem(feedme_fn, directory)
+        except (IOError, ValueError, KeyError, IndexError) as e:
+            status[i] = dict(returncode=1, message=str(e), runtime=0.)
+            continue
+        key = batch_key(problem)
+        if (key not in batches):
+            batches[key] = []
+        batches[key].append((i, problem))
+
+    for key in batches:
+        start_time = time.time()
+        indices = [i for (i, p) in batches[key]]
+        problems = [p for (i, p) in batches[key]]
+        deadlines = numpy.array([numpy.inf if timeouts[i] is None else start_time + timeouts[i] for i in indices])
+        try:
+            results = fit_batch(problems, max_iterations=max_iterations, deadlines=deadlines)
+        except (ValueError, numpy.linalg.LinAlgError, FloatingPointError) as e:
+            for i in indices:
+                status[i] = dict(returncode=1, message=str(e), runtime=0.)
+            continue
+        runtime = (time.time() - start_time) / len(problems)
+        for i, problem, result in zip(indices, problems, results):
+            if (result['timed_out']):
+                status[i] = dict(returncode=1, runtime=runtime,
+                                 message="timeout after %.1f seconds" % (timeouts[i]))
+                continue
+            write_output(problem, result)
+            status[i] = dict(returncode=0, runtime=runtime,
+                             message=None if result['converged'] else "not converged")
+
+    return status
+
+
+if __name__ == "__main__":
+
+    # fit one or more feed-me files: sersic_fit.py file1.galfeed [file2.galfeed ...]
+    feedme_list = [(fn, None) for fn in sys.argv[1:]]
+    for fn, st in zip(sys.argv[1:], fit_feedme_files(feedme_list)):
+        print("%s: return code %d (%.2f s) %s" % (
+            fn, st['returncode'], st['runtime'], st['message'] if st['message'] else ""))
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+#
+# Sigma cutouts from weight, inverse-variance, variance or rms maps.
+#
+# GALFIT wants the 1-sigma uncertainty of every pixel (C in the feed-me
+# file). Rather than converting the full frame up-front (var2sigma.py) and
+# writing another full-size image, the map is converted as cutouts are
+# read from it:
+#
+#    sigma, rms     the map already is the uncertainty, used as it is
+#    weight, ivar   inverse variance (SExtractor MAP_WEIGHT), 1/sqrt(map)
+#    var            variance, sqrt(map)
+#
+# Pixels without a valid uncertainty (sigma, weight or variance <= 0, NaN)
+# are reported as bad, so they can be added to the mask, and set to BAD_SIGMA.
+#
+# Converted pixels are kept per image in tiles of TILE_SIZE x TILE_SIZE, so
+# the overlapping cutouts of neighbouring sources (catalogs are worked
+# through by row) are converted only once; the least recently used tiles
+# are dropped beyond max_tiles.
+#
+
+import sys
+import numpy
+import astropy.io.fits as pyfits
+
+import cutouts
+
+KINDS = ('sigma', 'rms', 'weight', 'ivar', 'var')
+
+TILE_SIZE = 512
+BAD_SIGMA = 1.e10
+
+
+def to_sigma(data, kind):
+
+    # sigma and bad pixels for a block of the map
+    data = numpy.asarray(data, dtype=numpy.float32)
+    bad = ~(numpy.isfinite(data) & (data > 0))
+    if (kind in ('sigma', 'rms')):
+        sigma = data.copy()
+    else:
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            sigma = 1. / numpy.sqrt(data) if kind in ('weight', 'ivar') else numpy.sqrt(data)
+    sigma[bad] = BAD_SIGMA
+    return sigma, bad
+
+
+def open_sigma_map(hdulist, kind, ext=0, max_tiles=64):
+    if (kind not in KINDS):
+        raise ValueError("Unknown type of uncertainty map: %s (use one of %s)" % (kind, ", ".join(KINDS)))
+    header = hdulist[ext].header
+    return dict(hdulist=hdulist, kind=kind, ext=ext, shape=(header['NAXIS2'], header['NAXIS1']),
+                tiles={}, max_tiles=max_tiles)
+
+
+def get_tile(sigma_map, tx, ty):
+
+    key = (tx, ty)
+    tiles = sigma_map['tiles']
+    if (key in tiles):
+        # move to the end, as the most recently used
+        tiles[key] = tiles.pop(key)
+        return tiles[key]
+    ny, nx = sigma_map['shape']
+    x1, y1 = tx * TILE_SIZE, ty * TILE_SIZE
+    tiles[key] = to_sigma(cutouts.read_cutout(
+        sigma_map['hdulist'], x1, min(x1 + TILE_SIZE, nx), y1, min(y1 + TILE_SIZE, ny), sigma_map['ext']),
+        sigma_map['kind'])
+    while (len(tiles) > sigma_map['max_tiles']):
+        del tiles[next(iter(tiles))]
+    return tiles[key]
+
+
+def read_sigma(sigma_map, x1, x2, y1, y2):
+
+    #
+    # Sigma cutout and bad pixels for the box (x1, x2, y1, y2), 0-based with
+    # x2 and y2 exclusive
+    #
+    if (sigma_map['kind'] in ('sigma', 'rms')):
+        return to_sigma(cutouts.read_cutout(sigma_map['hdulist'], x1, x2, y1, y2, sigma_map['ext']), 'sigma')
+
+    sigma = numpy.empty((y2 - y1, x2 - x1), dtype=numpy.float32)
+    bad = numpy.empty((y2 - y1, x2 - x1), dtype=bool)
+    for ty in range(y1 // TILE_SIZE, (y2 - 1) // TILE_SIZE + 1):
+        for tx in range(x1 // TILE_SIZE, (x2 - 1) // TILE_SIZE + 1):
+            tile_sigma, tile_bad = get_tile(sigma_map, tx, ty)
+            # overlap of the cutout and this tile, in image coordinates
+            ox1, ox2 = max(x1, tx * TILE_SIZE), min(x2, (tx + 1) * TILE_SIZE)
+            oy1, oy2 = max(y1, ty * TILE_SIZE), min(y2, (ty + 1) * TILE_SIZE)
+            src = (slice(oy1 - ty * TILE_SIZE, oy2 - ty * TILE_SIZE), slice(ox1 - tx * TILE_SIZE, ox2 - tx * TILE_SIZE))
+            dst = (slice(oy1 - y1, oy2 - y1), slice(ox1 - x1, ox2 - x1))
+            sigma[dst] = tile_sigma[src]
+            bad[dst] = tile_bad[src]
+    return sigma, bad
+
+
+if __name__ == "__main__":
+
+    # sigma cutout from any uncertainty map: sigma_maps.py map.fits kind x1 x2 y1 y2 output.fits
+    hdulist = cutouts.open_frame(sys.argv[1])
+    x1, x2, y1, y2 = [int(v) for v in sys.argv[3:7]]
+    sigma, bad = read_sigma(open_sigma_map(hdulist, sys.argv[2]), x1, x2, y1, y2)
+    pyfits.PrimaryHDU(data=sigma).writeto(sys.argv[7], overwrite=True)
+    print("sigma cutout written to %s (%d bad pixels)" % (sys.argv[7], numpy.sum(bad)))
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+#
+# Group neighbouring sources for simultaneous fitting.
+#
+# In crowded regions (e.g. cluster cores) the cutouts of neighbouring sources
+# overlap, so the same pixels are cut out and fitted again and again, with
+# each fit masking all other sources. Instead, sources with overlapping
+# cutout boxes are merged into one group, fitted with one GALFIT run on the
+# union of their cutouts, with one sersic component per source.
+#
+# Candidate pairs come from a k-d tree over the box centers; two boxes
+# overlap only if their centers are closer (in x and y) than the widest box,
+# so only these pairs need to be checked. Groups are then built with a
+# union-find, merging the closest pairs first and never letting a group grow
+# beyond max_members sources, or its cutout beyond max_width pixels in x or
+# y; sources that are left out of a group remain masked through the
+# segmentation map, as before.
+#
+# Each group is fit as one job, named after its primary source. The members
+# of all groups of an image are listed in a groups file in the galfit
+# directory, so the results of all members can be found again later.
+#
+
+import os
+import sys
+import numpy
+import scipy.spatial
+
+
+def boxes_overlap(boxes, i, j):
+
+    # boxes are (x1, x2, y1, y2), with x2 and y2 exclusive
+    return (boxes[i, 0] < boxes[j, 1] and boxes[j, 0] < boxes[i, 1] and
+            boxes[i, 2] < boxes[j, 3] and boxes[j, 2] < boxes[i, 3])
+
+
+def find_groups(boxes, magnitudes=None, max_members=8, max_width=None):
+
+    #
+    # Returns a list of groups, each a list of indices into boxes. Groups
+    # are sorted by magnitude (brightest first, this is the primary source
+    # that names the group), and the list of groups follows the order of
+    # the first member of each group in the input. With max_width, groups
+    # are not merged if their union box would be wider or taller than that.
+    #
+    boxes = numpy.asarray(boxes, dtype=numpy.float64).reshape((-1, 4))
+    n_boxes = boxes.shape[0]
+    if (magnitudes is None):
+        magnitudes = numpy.zeros(n_boxes)
+
+    parent = numpy.arange(n_boxes)
+    size = numpy.ones(n_boxes, dtype=int)
+    # union box of each group, kept at its root
+    union = boxes.copy()
+
+    def root(i):
+        while (parent[i] != i):
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    if (max_members > 1 and n_boxes > 1):
+        centers = numpy.array([0.5 * (boxes[:, 0] + boxes[:, 1]),
+                               0.5 * (boxes[:, 2] + boxes[:, 3])]).T
+        widest = numpy.max([boxes[:, 1] - boxes[:, 0], boxes[:, 3] - boxes[:, 2]])
+        tree = scipy.spatial.cKDTree(centers)
+        pairs = tree.query_pairs(widest, p=numpy.inf, output_type='ndarray')
+        if (len(pairs) > 0):
+            distance = numpy.hypot(centers[pairs[:, 0], 0] - centers[pairs[:, 1], 0],
+                                   centers[pairs[:, 0], 1] - centers[pairs[:, 1], 1])
+            for i, j in pairs[numpy.argsort(distance, kind='stable')]:
+                if (not boxes_overlap(boxes, i, j)):
+                    continue
+                ri, rj = root(i), root(j)
+                if (ri == rj or size[ri] + size[rj] > max_members):
+                    continue
+                merged = numpy.array([numpy.min([union[ri, 0], union[rj, 0]]), numpy.max([union[ri, 1], union[rj, 1]]),
+                                      numpy.min([union[ri, 2], union[rj, 2]]), numpy.max([union[ri, 3], union[rj, 3]])])
+                if (max_width is not None and
+                        numpy.max([merged[1] - merged[0], merged[3] - merged[2]]) > max_width):
+                    continue
+                parent[rj] = ri
+                size[ri] += size[rj]
+                union[ri] = merged
+
+    groups = {}
+    for i in range(n_boxes):
+        groups.setdefault(root(i), []).append(i)
+    return [sorted(members, key=lambda i: (magnitudes[i], i))
+            for members in sorted(groups.values(), key=lambda m: m[0])]
+
+
+def group_box(boxes, members):
+
+    # the union of the cutout boxes of all members
+    boxes = numpy.asarray(boxes)[members]
+    return (int(numpy.min(boxes[:, 0])), int(numpy.max(boxes[:, 1])),
+            int(numpy.min(boxes[:, 2])), int(numpy.max(boxes[:, 3])))
+
+
+def group_extent(x, y, extents, box):
+
+    # half-size of the box around the center of the group box that holds the light of all members
+    xc, yc = 0.5 * (box[0] + box[1]), 0.5 * (box[2] + box[3])
+    return float(numpy.max(numpy.maximum(numpy.fabs(numpy.asarray(x) - xc), numpy.fabs(numpy.asarray(y) - yc)) +
+                           numpy.asarray(extents)))
+
+
+def groups_filename(galfit_dir, basename):
+    return os.path.join(galfit_dir, "%s.groups.txt" % (basename))
+
+
+def write_groups(groups_fn, member_ids):
+
+    # one line per group of more than one source: the primary source (naming the job), then all other members
+    tmp_fn = "%s.tmp%d" % (groups_fn, os.getpid())
+    with open(tmp_fn, "w") as gf:
+        for ids in member_ids:
+            if (len(ids) > 1):
+                gf.write("%s\n" % (" ".join(["%d" % (i) for i in ids])))
+    os.replace(tmp_fn, groups_fn)
+
+
+def read_groups(groups_fn):
+
+    #
+    # Returns the job (the source ID of the primary) and the member index
+    # (the sersic component, counting from 0) of all grouped sources, by
+    # source ID. Sources fit on their own are not listed.
+    #
+    group_of = {}
+    if (not os.path.isfile(groups_fn)):
+        return group_of
+    with open(groups_fn, "r") as gf:
+        for line in gf:
+            ids = [int(i) for i in line.split()]
+            for member, src_id in enumerate(ids):
+                group_of[src_id] = (ids[0], member)
+    return group_of
+
+
+def group_summary(groups, boxes):
+
+    n_pixels = numpy.sum([(b[1] - b[0]) * (b[3] - b[2]) for b in boxes])
+    n_group_pixels = 0
+    for members in groups:
+        x1, x2, y1, y2 = group_box(boxes, members)
+        n_group_pixels += (x2 - x1) * (y2 - y1)
+    return dict(n_sources=len(boxes), n_groups=len(groups),
+                n_grouped=int(numpy.sum([len(m) for m in groups if len(m) > 1])),
+                largest=int(numpy.max([len(m) for m in groups])) if groups else 0,
+                n_pixels=int(n_pixels), n_group_pixels=int(n_group_pixels))
+
+
+if __name__ == "__main__":
+
+    # show the groups for a source catalog: source_groups.py catalog.vot [max_members]
+    import astropy.table
+    catalog = astropy.table.Table.read(sys.argv[1])
+    max_members = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+
+    x, y = catalog['X_IMAGE'] - 1, catalog['Y_IMAGE'] - 1
+    size = 3 * catalog['FWHM_IMAGE']
+    boxes = numpy.array([numpy.floor(x - size), numpy.ceil(x + size),
+                         numpy.floor(y - size), numpy.ceil(y + size)]).T
+    groups = find_groups(boxes, catalog['MAG_AUTO'], max_members)
+    for members in groups:
+        if (len(members) > 1):
+            print("%5d: %s" % (catalog['NUMBER'][members[0]],
+                               " ".join(["%d" % (catalog['NUMBER'][i]) for i in members[1:]])))
+    summary = group_summary(groups, boxes)
+    print("%(n_sources)d sources in %(n_groups)d groups (%(n_grouped)d sources in groups, "
+          "largest group: %(largest)d); %(n_pixels)d pixels in single cutouts, "
+          "%(n_group_pixels)d in group cutouts" % summary)
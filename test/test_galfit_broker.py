@@ -0,0 +1,107 @@
+#
+# A broker with two agents on localhost, sharing one queue with a local
+# worker, including the shutdown at the end of a run
+#
+
+import multiprocessing
+import queue
+import threading
+import time
+
+import galfit_broker
+
+AUTHKEY = "test"
+
+
+def start(galfit_queue, result_queue):
+    broker = galfit_broker.start_broker("127.0.0.1:0", galfit_queue, result_queue, authkey=AUTHKEY,
+                                        n_queued=multiprocessing.Value('i', 0))
+    return broker, "127.0.0.1:%d" % (broker['listener'].address[1])
+
+
+def start_agents(address, n_agents=2, runtime=0.05):
+
+    def run_job(job, cancel):
+        time.sleep(runtime)
+        return dict(returncode=0)
+
+    agents = []
+    for i in range(n_agents):
+        t = threading.Thread(target=galfit_broker.agent_loop,
+                             args=(address, "agent%d" % (i), run_job), kwargs=dict(authkey=AUTHKEY))
+        t.daemon = True
+        t.start()
+        agents.append(t)
+    return agents
+
+
+def local_worker(galfit_queue, done):
+
+    # like parallel_run_galfit: run jobs until the shutdown token
+    while (True):
+        job = galfit_queue.get()
+        galfit_queue.task_done()
+        if (job is None):
+            break
+        time.sleep(0.05)
+        done.append(job['feedme'])
+
+
+def test_agents_and_local_worker_drain_queue_and_shut_down():
+
+    galfit_queue, result_queue = queue.Queue(), queue.Queue()
+    broker, address = start(galfit_queue, result_queue)
+    n_jobs = 30
+    for i in range(n_jobs):
+        galfit_queue.put(dict(feedme="job%02d" % (i), timeout=10))
+
+    local_done = []
+    worker = threading.Thread(target=local_worker, args=(galfit_queue, local_done))
+    worker.daemon = True
+    worker.start()
+    agents = start_agents(address)
+
+    remote_done = []
+    deadline = time.time() + 30
+    while (len(local_done) + len(remote_done) < n_jobs and time.time() < deadline):
+        try:
+            job, result = result_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        assert result['agent'] in ("agent0", "agent1")
+        remote_done.append(job['feedme'])
+    assert sorted(local_done + remote_done) == ["job%02d" % (i) for i in range(n_jobs)]
+    assert len(remote_done) > 0
+
+    # the agents keep polling until the broker stops, then the local worker gets its token
+    galfit_broker.stop_broker(broker)
+    galfit_queue.put(None)
+    worker.join(10)
+    assert not worker.is_alive()
+    for agent in agents:
+        agent.join(10)
+        assert not agent.is_alive()
+
+
+def test_polling_agents_leave_shutdown_tokens_and_survive_bad_jobs():
+
+    galfit_queue, result_queue = queue.Queue(), queue.Queue()
+    broker, address = start(galfit_queue, result_queue)
+
+    # a broken job description, followed by a valid job and a worker's shutdown token
+    galfit_queue.put("not a job")
+    galfit_queue.put(dict(feedme="job", timeout=10))
+    galfit_queue.put(None)
+    agents = start_agents(address)
+
+    job, result = result_queue.get(timeout=10)
+    assert job['feedme'] == "job"
+    # give the agents a few polls with only the token left in the queue
+    time.sleep(1.5)
+    assert all([agent.is_alive() for agent in agents])
+    assert galfit_queue.get_nowait() is None
+
+    galfit_broker.stop_broker(broker)
+    for agent in agents:
+        agent.join(10)
+        assert not agent.is_alive()
@@ -0,0 +1,55 @@
+#
+# Starting values for a known elongated source, drawn with sersic_fit's model
+# (GALFIT's conventions: 1-based pixels, PA from up towards left)
+#
+
+import numpy
+import astropy.table
+
+import auto_galfit
+import initial_guess
+import sersic_fit
+
+MAGZERO = 30.
+XC, YC, RE, N, Q, PA = 61., 56., 7., 1., 0.4, 30.
+
+
+def elongated_source(noise=0.05, seed=1):
+    yy, xx = numpy.mgrid[1:112, 1:122].astype(numpy.float64)
+    params = numpy.array([[XC, YC, MAGZERO - 2.5 * numpy.log10(2.e4), RE, N, Q, PA, 0.]])
+    img = sersic_fit.sersic_model(params, yy, xx, MAGZERO)[0]
+    return img + numpy.random.default_rng(seed).normal(0., noise, img.shape)
+
+
+def angle_difference(a, b):
+    # position angles are only defined modulo 180 degrees
+    return (a - b + 90.) % 180. - 90.
+
+
+def test_moments_recover_position_angle_and_axis_ratio():
+    guess = initial_guess.estimate(elongated_source(), None, XC - 1, YC - 1, 3.)[0]
+    assert guess['valid']
+    assert abs(angle_difference(guess['position_angle'], PA)) < 2.
+    assert abs(guess['axis_ratio'] - Q) < 0.08
+    assert abs(guess['x'] - (XC - 1)) < 0.5 and abs(guess['y'] - (YC - 1)) < 0.5
+
+
+def test_catalog_angle_matches_model_angle():
+    # THETA_IMAGE as SExtractor measures it: the major axis from +x towards +y
+    img = elongated_source(noise=0.)
+    yy, xx = numpy.mgrid[:img.shape[0], :img.shape[1]]
+    flux = img / numpy.sum(img)
+    dx, dy = xx - numpy.sum(flux * xx), yy - numpy.sum(flux * yy)
+    theta = 0.5 * numpy.degrees(numpy.arctan2(2 * numpy.sum(flux * dx * dy),
+                                              numpy.sum(flux * dx * dx) - numpy.sum(flux * dy * dy)))
+
+    catalog = astropy.table.Table(rows=[(1, XC, YC, 1.e-3, 1.e-3, 20., RE, 1. / Q, 4., theta)],
+                                  names=['NUMBER', 'X_IMAGE', 'Y_IMAGE', 'ERRX2WIN_IMAGE', 'ERRY2WIN_IMAGE',
+                                         'MAG_AUTO', 'FLUX_RADIUS_50', 'ELONGATION', 'FWHM_IMAGE',
+                                         'THETA_IMAGE'])
+    plan = auto_galfit.plan_sources(catalog, img.shape[1], img.shape[0], -1)
+    assert abs(angle_difference(plan['position_angle'][0], PA)) < 1.
+
+    # and both ways to start a fit agree
+    guess = initial_guess.estimate(img, None, XC - 1, YC - 1, 3.)[0]
+    assert abs(angle_difference(guess['position_angle'], plan['position_angle'][0])) < 2.
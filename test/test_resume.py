@@ -0,0 +1,64 @@
+#
+# Resuming a campaign from its job ledger: from another directory, with the
+# image given by another path, and with the inputs of a failed job removed
+#
+
+import os
+import sys
+import subprocess
+
+import benchmark_auto_galfit
+import galfit_ledger
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def run_auto_galfit(image, ledger_fn, data_dir, cwd):
+    galfit_cmd = "%s %s --runtime 0" % (sys.executable, os.path.join(REPO, "fake_galfit.py"))
+    cmd = [sys.executable, os.path.join(REPO, "auto_galfit.py"), "--galfit", galfit_cmd, "--nprocs", "2",
+           "--weight", ".fits:.weight.fits", "--psf", os.path.join(data_dir, "psf.fits"),
+           "--ledger", ledger_fn, image]
+    os.makedirs(cwd, exist_ok=True)
+    result = subprocess.run(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            universal_newlines=True, timeout=300)
+    assert result.returncode == 0, result.stdout
+    return result.stdout
+
+
+def test_resume_from_other_directory_and_recut_missing_inputs(tmp_path):
+
+    data_dir = str(tmp_path / "data")
+    image, = benchmark_auto_galfit.make_dataset(data_dir, 1, 8, 256)
+    galfit_dir = os.path.join(data_dir, "galfit")
+    ledger_fn = str(tmp_path / "ledger.db")
+
+    def source_file(src_id, suffix):
+        return os.path.join(galfit_dir, "bench00.%05d.%s" % (src_id, suffix))
+
+    # first run from one directory, with a relative path to the image
+    run_auto_galfit(os.path.relpath(image, str(tmp_path / "a")), ledger_fn, data_dir, str(tmp_path / "a"))
+    ledger = galfit_ledger.open_ledger(ledger_fn)
+    assert set(galfit_ledger.image_states(ledger, image).values()) == {'done'}
+
+    # two fits failed; the cutout of one of them was removed since
+    galfit_ledger.update_job(ledger, image, [2, 3], 'failed')
+    ledger.close()
+    for src_id in (2, 3):
+        os.remove(source_file(src_id, "galfit.fits"))
+    os.remove(source_file(2, "image.fits"))
+    kept_cutout = os.path.getmtime(source_file(3, "image.fits"))
+    kept_output = os.path.getmtime(source_file(1, "galfit.fits"))
+
+    # the second run, from another directory with the absolute path, picks up where the first left off
+    log = run_auto_galfit(image, ledger_fn, data_dir, str(tmp_path / "b"))
+    ledger = galfit_ledger.open_ledger(ledger_fn)
+    assert ledger.execute("SELECT COUNT(DISTINCT image) FROM jobs").fetchone()[0] == 1
+    assert set(galfit_ledger.image_states(ledger, image).values()) == {'done'}
+
+    assert "Inputs of %s are missing" % (source_file(2, "galfeed")) in log
+    assert os.path.isfile(source_file(2, "image.fits"))
+    assert os.path.getmtime(source_file(3, "image.fits")) == kept_cutout
+    for src_id in (2, 3):
+        assert os.path.isfile(source_file(src_id, "galfit.fits"))
+    # finished fits are not run again
+    assert os.path.getmtime(source_file(1, "galfit.fits")) == kept_output
@@ -0,0 +1,164 @@
+#
+# The in-process Sersic fitter against synthetic profiles with known
+# parameters, written as cutouts with GALFIT feed-me files
+#
+
+import os
+import numpy
+import astropy.io.fits as pyfits
+
+import sersic_fit
+
+MAGZERO = 30.
+SKY = 10.
+NOISE = 1.
+# x, y, mag, re, n, q, pa, sky
+TRUTH = numpy.array([52.3, 47.8, 17., 6., 1.5, 0.6, 35., SKY])
+START = numpy.array([51., 49., 18., 4., 2.5, 0.8, 20., 0.])
+
+
+def gaussian_psf(fwhm, size=25):
+    yy, xx = numpy.mgrid[:size, :size] - size // 2
+    psf = numpy.exp(-0.5 * (xx**2 + yy**2) / (fwhm / 2.355)**2)
+    return psf / numpy.sum(psf)
+
+
+def write_problem(directory, name, truth=TRUTH, psf=None, shape=(96, 104), region=None, seed=1):
+
+    #
+    # a noisy cutout of the given profile, its sigma image and PSF, and a
+    # feed-me file to fit it starting from START
+    #
+    yy, xx = numpy.mgrid[1:shape[0] + 1, 1:shape[1] + 1].astype(numpy.float64)
+    img = sersic_fit.sersic_model(truth[None, :], yy, xx, MAGZERO)[0]
+    if (psf is not None):
+        img = sersic_fit.make_convolver(psf, shape)(img[None, :, :])[0]
+    img = img + truth[7] + numpy.random.default_rng(seed).normal(0., NOISE, shape)
+    pyfits.writeto(os.path.join(directory, name + ".image.fits"), img, overwrite=True)
+    pyfits.writeto(os.path.join(directory, name + ".sigma.fits"), numpy.full(shape, NOISE), overwrite=True)
+    psf_option = "none"
+    if (psf is not None):
+        psf_option = name + ".psf.fits"
+        pyfits.writeto(os.path.join(directory, psf_option), psf, overwrite=True)
+    if (region is None):
+        region = (0, shape[1], 0, shape[0])
+
+    feedme_fn = os.path.join(directory, name + ".galfeed")
+    with open(feedme_fn, "w") as ff:
+        ff.write("""
+A) %(name)s.image.fits
+B) %(name)s.galfit.fits
+C) %(name)s.sigma.fits
+D) %(psf)s
+E) 1
+F) none
+G) none
+H) %(x1)d %(x2)d %(y1)d %(y2)d
+I) 50 50
+J) %(magzero).3f
+K) 0.180 0.180
+O) regular
+P) 0
+
+0) sersic
+1) %(x).4f %(y).4f 1 1
+3) %(mag).4f 1
+4) %(re).4f 1
+5) %(n).4f 1
+9) %(q).4f 1
+10) %(pa).4f 1
+Z) 0
+
+0) sky
+1) %(sky).4f 1
+2) 0.0 0
+3) 0.0 0
+Z) 0
+""" % dict(name=name, psf=psf_option, magzero=MAGZERO, x1=region[0], x2=region[1], y1=region[2], y2=region[3],
+           x=START[0], y=START[1], mag=START[2], re=START[3], n=START[4], q=START[5], pa=START[6], sky=START[7]))
+    return feedme_fn
+
+
+def fit_results(output_fn):
+
+    # the best-fit values from the model extension, as combine_sextractor_galfit.py reads them
+    hdr = pyfits.getheader(output_fn, 2)
+    values = [float(hdr['1_%s' % (name)].split()[0].strip("[]*")) for name in sersic_fit.PARAMETERS[:7]]
+    return numpy.array(values + [float(hdr['2_SKY'].split()[0].strip("[]*"))]), hdr
+
+
+def assert_recovered(values, truth=TRUTH):
+    assert numpy.all(numpy.fabs(values[:2] - truth[:2]) < 0.2)
+    assert abs(values[2] - truth[2]) < 0.05
+    assert abs(values[3] / truth[3] - 1.) < 0.05
+    assert abs(values[4] - truth[4]) < 0.15
+    assert abs(values[5] - truth[5]) < 0.03
+    assert abs(values[6] - truth[6]) < 2.
+    assert abs(values[7] - truth[7]) < 0.1
+
+
+def test_recovers_known_profiles_with_and_without_psf(tmp_path):
+
+    feedmes = [write_problem(str(tmp_path), "nopsf"),
+               write_problem(str(tmp_path), "psf", psf=gaussian_psf(4.), seed=2)]
+    status = sersic_fit.fit_feedme_files([(fn, None) for fn in feedmes])
+    assert [st['returncode'] for st in status] == [0, 0]
+    for fn in feedmes:
+        values, _ = fit_results(fn.replace(".galfeed", ".galfit.fits"))
+        assert_recovered(values)
+
+
+def test_fits_only_the_fitting_region(tmp_path):
+
+    region = (21, 84, 16, 79)
+    fn = write_problem(str(tmp_path), "region", region=region)
+    status = sersic_fit.fit_feedme_files([(fn, None)])
+    assert status[0]['returncode'] == 0
+
+    output_fn = fn.replace(".galfeed", ".galfit.fits")
+    values, hdr = fit_results(output_fn)
+    assert hdr['FITSECT'] == "[21:84,16:79]"
+    assert pyfits.getdata(output_fn, 1).shape == (region[3] - region[2] + 1, region[1] - region[0] + 1)
+    # positions are still given in pixels of the full cutout
+    assert_recovered(values)
+
+
+def test_batches_only_share_identical_psfs(tmp_path):
+
+    psf = gaussian_psf(4.)
+    other = psf.copy()
+    # same shape and same sum over every third pixel, but a different PSF
+    other[1, 1], other[1, 2] = other[1, 1] + 1.e-3, other[1, 2] - 1.e-3
+    problems = [sersic_fit.load_problem(write_problem(str(tmp_path), name, psf=p))
+                for name, p in (("a", psf), ("b", other), ("c", psf))]
+    keys = [sersic_fit.batch_key(p) for p in problems]
+    assert keys[0] == keys[2] and keys[0] != keys[1]
+
+    try:
+        sersic_fit.fit_batch(problems)
+    except ValueError:
+        pass
+    else:
+        assert False, "fit a batch with different PSFs"
+
+
+def test_chunked_jacobian_gives_same_fit(tmp_path, monkeypatch):
+
+    problems = [sersic_fit.load_problem(write_problem(str(tmp_path), "p%d" % (i), seed=i)) for i in range(3)]
+    whole = sersic_fit.fit_batch(problems)
+    # one cutout at a time
+    monkeypatch.setattr(sersic_fit, "MAX_JACOBIAN_SIZE", 1)
+    chunked = sersic_fit.fit_batch(problems)
+    for a, b in zip(whole, chunked):
+        assert numpy.allclose(a['values'], b['values'])
+        assert numpy.allclose(a['errors'], b['errors'])
+
+
+def test_fits_past_their_timeout_fail(tmp_path):
+
+    feedmes = [write_problem(str(tmp_path), "slow"), write_problem(str(tmp_path), "fast", seed=2)]
+    status = sersic_fit.fit_feedme_files([(fn, None) for fn in feedmes], timeouts=[0., None])
+    assert status[0]['returncode'] != 0 and status[0]['message'].startswith("timeout")
+    assert not os.path.isfile(feedmes[0].replace(".galfeed", ".galfit.fits"))
+    assert status[1]['returncode'] == 0
+    assert os.path.isfile(feedmes[1].replace(".galfeed", ".galfit.fits"))
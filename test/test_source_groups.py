@@ -0,0 +1,77 @@
+#
+# Grouping of sources with overlapping cutouts, and finding the results of
+# all group members again when combining the catalogs
+#
+
+import os
+import queue
+import numpy
+import astropy.table
+import astropy.io.fits as pyfits
+
+import source_groups
+import combine_sextractor_galfit
+
+
+def test_groups_stay_within_max_width():
+
+    # a row of overlapping 40x40 boxes, 20 pixels apart
+    boxes = numpy.array([[20 * i, 20 * i + 40, 0, 40] for i in range(6)])
+    assert source_groups.find_groups(boxes, max_members=8) == [[0, 1, 2, 3, 4, 5]]
+
+    groups = source_groups.find_groups(boxes, max_members=8, max_width=80)
+    assert sorted([i for members in groups for i in members]) == list(range(6))
+    assert len(groups) > 1
+    for members in groups:
+        x1, x2, y1, y2 = source_groups.group_box(boxes, members)
+        assert x2 - x1 <= 80 and y2 - y1 <= 80
+
+
+def test_groups_file_lists_job_and_member(tmp_path):
+
+    groups_fn = source_groups.groups_filename(str(tmp_path), "img")
+    source_groups.write_groups(groups_fn, [[5, 7, 3], [9]])
+    assert source_groups.read_groups(groups_fn) == {5: (5, 0), 7: (5, 1), 3: (5, 2)}
+    assert source_groups.read_groups(source_groups.groups_filename(str(tmp_path), "other")) == {}
+
+
+def write_output(fn, sersics, sky):
+
+    # the model header as GALFIT writes it, for one sersic component per member and the sky
+    hdr = pyfits.Header()
+    for component, (xc, mag) in enumerate(sersics, 1):
+        hdr['COMP_%d' % (component)] = 'sersic'
+        for p, value in zip(['XC', 'YC', 'MAG', 'RE', 'N', 'AR', 'PA'], [xc, 20., mag, 5., 1., 0.5, 10.]):
+            hdr['%d_%s' % (component, p)] = "%.4f +/- 0.0100" % (value)
+    sky_component = len(sersics) + 1
+    hdr['COMP_%d' % (sky_component)] = 'sky'
+    for p, value in zip(['XC', 'YC', 'DSDX', 'DSDY'], [20., 20., 0., 0.]):
+        hdr['%d_%s' % (sky_component, p)] = "[%.4f]" % (value)
+    hdr['%d_SKY' % (sky_component)] = "%.4f +/- 0.0010" % (sky)
+    for key in ['CHISQ', 'NDOF', 'NFREE', 'NFIX', 'CHI2NU']:
+        hdr[key] = 1.
+    pyfits.HDUList([pyfits.PrimaryHDU(), pyfits.ImageHDU(), pyfits.ImageHDU(header=hdr)]).writeto(fn)
+
+
+def test_combined_catalog_has_results_of_group_members(tmp_path):
+
+    galfit_dir = tmp_path / "galfit"
+    galfit_dir.mkdir()
+    # sources 5 and 7 were fit together (in the job of 5), 9 on its own
+    write_output(str(galfit_dir / "img.00005.galfit.fits"), [(10., 20.), (30., 21.)], 1.)
+    write_output(str(galfit_dir / "img.00009.galfit.fits"), [(50., 22.)], 2.)
+    source_groups.write_groups(source_groups.groups_filename(str(galfit_dir), "img"), [[5, 7], [9]])
+
+    catalog_fn = str(tmp_path / "img.udgcat")
+    combined_fn = str(tmp_path / "img.galcomb.vot")
+    astropy.table.Table([[5, 7, 9]], names=['NUMBER']).write(catalog_fn, format='votable')
+
+    catalog_queue = queue.Queue()
+    catalog_queue.put((str(tmp_path / "img.fits"), catalog_fn, combined_fn))
+    catalog_queue.put(None)
+    combine_sextractor_galfit.parallel_combine(catalog_queue, components=['sersic', 'sky'])
+
+    combined = astropy.table.Table.read(combined_fn)
+    assert list(combined['SERSIC_XC']) == [10., 30., 50.]
+    assert list(combined['SERSIC_MAG']) == [20., 21., 22.]
+    assert list(combined['SKY_SKY']) == [1., 1., 2.]
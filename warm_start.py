@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+#
+# Warm-start store of converged fit solutions.
+#
+# Every converged sersic fit is kept in a small SQLite database, keyed by the
+# image basename and the source NUMBER, together with the sky position of
+# the source. When the same field is processed again (e.g. after changing
+# the PSF model or the weight maps), the stored solutions are used as
+# starting values instead of the SExtractor values, so the fits start close
+# to where they ended last time. Sources can also be matched by position,
+# which also works for new catalogs of the same field (with different
+# NUMBERs) or for overlapping images.
+#
+# Only the results collector writes to the store (see
+# galfit_results.converged_sersic), the feed-me writers only read from it.
+#
+
+import sys
+import sqlite3
+import time
+import numpy
+import scipy.spatial
+import astropy.table
+
+# sersic parameters kept in the store, and the feed-me template values they replace
+PARAMETERS = (('MAG', 'magnitude'), ('RE', 'halflight_radius'), ('N', 'sersic_n'),
+              ('AR', 'axis_ratio'), ('PA', 'position_angle'))
+
+# catalog columns with the sky position of each source
+POSITION_COLUMNS = ('ALPHA_J2000', 'DELTA_J2000')
+
+
+def open_store(store_fn):
+
+    conn = sqlite3.connect(store_fn, timeout=120)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS solutions (
+            basename TEXT NOT NULL,
+            number INTEGER NOT NULL,
+            ra REAL,
+            dec REAL,
+            %s,
+            chi2nu REAL,
+            modified REAL,
+            PRIMARY KEY (basename, number)
+        )""" % (", ".join(["%s REAL" % (p.lower()) for p, _ in PARAMETERS])))
+    conn.execute("CREATE INDEX IF NOT EXISTS solutions_dec ON solutions (dec)")
+    conn.commit()
+    return conn
+
+
+def save_solution(conn, basename, number, solution, ra=None, dec=None):
+
+    columns = ['basename', 'number', 'ra', 'dec', 'chi2nu', 'modified'] + [p.lower() for p, _ in PARAMETERS]
+    values = [basename, int(number), ra, dec, solution.get('CHI2NU'), time.time()] + \
+             [solution.get(p) for p, _ in PARAMETERS]
+    conn.execute("INSERT OR REPLACE INTO solutions (%s) VALUES (%s)" % (
+        ", ".join(columns), ", ".join(["?"] * len(columns))), values)
+
+
+def _row_solution(row):
+    return dict([(p, v) for (p, _), v in zip(PARAMETERS, row) if v is not None])
+
+
+def _offsets(ra, dec, ra0, cos_dec):
+
+    # flat-sky positions [deg] relative to ra0, with RA differences wrapped into [-180, 180)
+    dra = (numpy.asarray(ra, dtype=numpy.float64) - ra0 + 180.) % 360. - 180.
+    return numpy.array([dra * cos_dec, dec]).T
+
+
+def load_solutions(conn, basename, numbers, ra=None, dec=None, radius=0.):
+
+    #
+    # Returns the stored solutions for the given sources, as a dictionary
+    # keyed by NUMBER. Sources are looked up by basename and NUMBER first;
+    # with a matching radius (in arcsec) and sky positions, the remaining
+    # sources are matched to the closest stored solution within the radius.
+    #
+    parameter_columns = ", ".join([p.lower() for p, _ in PARAMETERS])
+    stored = dict([(row[0], _row_solution(row[1:])) for row in conn.execute(
+        "SELECT number, %s FROM solutions WHERE basename=?" % (parameter_columns), (basename,))])
+    solutions = dict([(int(n), stored[int(n)]) for n in numbers if int(n) in stored])
+
+    if (radius <= 0 or ra is None or dec is None or len(solutions) == len(numbers)):
+        return solutions
+
+    numbers = numpy.asarray(numbers)
+    ra, dec = numpy.asarray(ra, dtype=numpy.float64), numpy.asarray(dec, dtype=numpy.float64)
+    todo = numpy.array([int(n) not in solutions for n in numbers]) & numpy.isfinite(ra) & numpy.isfinite(dec)
+    if (not numpy.any(todo)):
+        return solutions
+
+    # everything stored in the declination range of the catalog
+    r_deg = radius / 3600.
+    rows = conn.execute(
+        "SELECT ra, dec, %s FROM solutions WHERE dec BETWEEN ? AND ? AND ra IS NOT NULL" % (parameter_columns),
+        (float(numpy.min(dec[todo])) - r_deg, float(numpy.max(dec[todo])) + r_deg)).fetchall()
+    if (len(rows) == 0):
+        return solutions
+
+    # flat-sky approximation around the center of the catalog, fine for matching radii of a few arcsec
+    ra0 = ra[todo][0]
+    cos_dec = numpy.cos(numpy.radians(numpy.median(dec[todo])))
+    stored = numpy.array([[r[0], r[1]] for r in rows])
+    tree = scipy.spatial.cKDTree(_offsets(stored[:, 0], stored[:, 1], ra0, cos_dec))
+    distance, index = tree.query(_offsets(ra[todo], dec[todo], ra0, cos_dec), distance_upper_bound=r_deg)
+    for n, d, i in zip(numbers[todo], distance, index):
+        if (numpy.isfinite(d)):
+            solutions[int(n)] = _row_solution(rows[i][2:])
+    return solutions
+
+
+def starting_values(solution):
+
+    # the feed-me template values to replace with the stored solution
+    if (solution is None):
+        return {}
+    return dict([(key, solution[p]) for p, key in PARAMETERS if p in solution])
+
+
+def catalog_positions(catalog_fn):
+
+    # sky positions of all sources in a catalog, by NUMBER (empty if the catalog has none)
+    try:
+        catalog = astropy.table.Table.read(catalog_fn)
+    except (IOError, OSError, ValueError):
+        return {}
+    if (not all([c in catalog.colnames for c in POSITION_COLUMNS])):
+        return {}
+    return dict([(int(n), (float(ra), float(dec))) for n, ra, dec in zip(
+        catalog['NUMBER'], catalog[POSITION_COLUMNS[0]], catalog[POSITION_COLUMNS[1]])])
+
+
+if __name__ == "__main__":
+
+    # print the stored solutions of an image: warm_start.py store.db basename
+    conn = open_store(sys.argv[1])
+    for row in conn.execute(
+            "SELECT number, ra, dec, mag, re, n, ar, pa, chi2nu FROM solutions WHERE basename=? ORDER BY number",
+            (sys.argv[2],)):
+        print(" ".join([str(r) for r in row]))